@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time spent in paintEvent, on the GUI thread, per frame while a widget
+shows a flood of colored output: rasterizing rows there, and copying them
+from the back buffer of TerminalWidget.render_thread.
+
+    python bench/backbuffer.py [--seconds S] [--lines N]
+
+Needs a QApplication, run it with ``xvfb-run`` on a box without display.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from PyQt4.QtGui import QApplication
+
+from pyqterm.frontend import TerminalWidget
+
+
+FLOOD = (b"i=0; while [ $i -lt %d ]; do i=$((i+1)); "
+         b"printf '\\033[3%%dm%%s \\033[0m%%s\\n' $((i %% 8)) $i "
+         b"'the quick brown fox jumps over the lazy dog'; done\n")
+
+
+def pump(app, seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        app.processEvents()
+        time.sleep(0.002)
+
+
+def run(app, render_thread, seconds, lines):
+    TerminalWidget.render_thread = render_thread
+    widget = TerminalWidget(command="/bin/sh")
+    widget.resize(1200, 800)
+    widget.show()
+    pump(app, 0.5)
+    widget.collect()
+    widget.send(FLOOD % lines)
+    pump(app, seconds)
+    stats = widget.stats()
+    widget.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--lines", type=int, default=20000)
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    print("%-14s %8s %10s %10s %10s %10s" % (
+        "mode", "frames", "paint p50", "paint max", "rows/frame",
+        "render p50"))
+    for render_thread in (False, True):
+        stats = run(app, render_thread, args.seconds, args.lines)
+        paint = stats['paint_time']
+        rows = stats.get('rendered_rows', stats['painted_rows'])
+        render = stats.get('render_time')
+        print("%-14s %8d %8.2fms %8.2fms %10.1f %10s" % (
+            "render thread" if render_thread else "paintEvent",
+            paint['count'], paint['p50'] * 1e3, paint['max'] * 1e3,
+            rows['mean'],
+            "%8.2fms" % (render['p50'] * 1e3) if render else "-"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Byte streams as a pty delivers them for a few typical workloads. They are
+generated (deterministically) rather than shipped; raw recordings can be
+used instead, see ``suite.py --corpus``.
+"""
+import base64
+import random
+import struct
+import zlib
+
+
+def cat(size=2000000):
+    # cat of a large source file, \n already turned into \r\n by the tty
+    rnd = random.Random(1)
+    words = [b"def", b"return", b"self", b"import", b"for", b"in", b"if",
+             b"else:", b"None", b"(x)", b"[i]", b"=", b"+=", b"value",
+             b"result", b"# comment", b"'string'", b"0x1f"]
+    out, n = [], 0
+    while n < size:
+        indent = b"    " * rnd.randint(0, 3)
+        line = indent + b" ".join(rnd.choice(words) for _ in range(rnd.randint(0, 12)))
+        out.append(line + b"\r\n")
+        n += len(line) + 2
+    return b"".join(out)
+
+
+def vim(size=2000000, columns=80, lines=24):
+    # Full screen redraws, syntax colors, a scroll region and a status line
+    rnd = random.Random(2)
+    colors = [b"\x1b[33m", b"\x1b[36m", b"\x1b[1;34m", b"\x1b[35m", b"\x1b[0m"]
+    out, n = [b"\x1b[?1049h\x1b[1;%dr" % (lines - 1)], 0
+    while n < size:
+        if rnd.random() < 0.2:
+            # Page down: redraw every line
+            chunk = [b"\x1b[H\x1b[2J"]
+            for y in range(1, lines):
+                chunk.append(b"\x1b[%d;1H%s%4d \x1b[0m" % (y, colors[0], y))
+                for _ in range(rnd.randint(0, 8)):
+                    chunk.append(rnd.choice(colors) + b"token ")
+                chunk.append(b"\x1b[K")
+        else:
+            # Scroll by one line and draw the new one
+            chunk = [b"\x1b[%d;1H\r\n" % (lines - 1)]
+            for _ in range(rnd.randint(0, 8)):
+                chunk.append(rnd.choice(colors) + b"word ")
+            chunk.append(b"\x1b[0m\x1b[K")
+        chunk.append(b"\x1b[%d;1H\x1b[7m file.py [+] %d,%d \x1b[0m\x1b[K" % (
+            lines, rnd.randint(1, 9999), rnd.randint(1, 80)))
+        chunk.append(b"\x1b[%d;%dH" % (rnd.randint(1, lines - 1), rnd.randint(1, columns)))
+        chunk = b"".join(chunk)
+        out.append(chunk)
+        n += len(chunk)
+    return b"".join(out)
+
+
+def htop(size=2000000, columns=80, lines=24):
+    # The same layout rewritten with new numbers every refresh
+    rnd = random.Random(3)
+    out, n = [], 0
+    while n < size:
+        chunk = [b"\x1b[H"]
+        for cpu in range(4):
+            used = rnd.randint(0, 40)
+            chunk.append(b"\x1b[%d;1H  %d \x1b[1m[\x1b[32m%s\x1b[31m%s\x1b[0m%s\x1b[1m]\x1b[0m" % (
+                cpu + 1, cpu, b"|" * (used // 2), b"|" * (used - used // 2),
+                b" " * (40 - used)))
+        chunk.append(b"\x1b[6;1H\x1b[30;42m  PID USER      PRI  NI  VIRT   RES S CPU% MEM%   TIME+  Command\x1b[K\x1b[0m")
+        for y in range(7, lines):
+            row = b"%5d user       20   0 %5dM %5dM S %4.1f %4.1f  0:%02d.%02d  process-%d" % (
+                rnd.randint(1, 32000), rnd.randint(1, 9999), rnd.randint(1, 999),
+                rnd.random() * 100, rnd.random() * 10, rnd.randint(0, 59),
+                rnd.randint(0, 99), y)
+            if y == 7:
+                row = b"\x1b[30;46m" + row + b"\x1b[0m"
+            chunk.append(b"\x1b[%d;1H%s\x1b[K" % (y, row))
+        chunk = b"".join(chunk)
+        out.append(chunk)
+        n += len(chunk)
+    return b"".join(out)
+
+
+def ls(size=2000000, columns=80):
+    # ls -R --color: directory headers and colored names in columns
+    rnd = random.Random(4)
+    kinds = [b"\x1b[0m", b"\x1b[01;34m", b"\x1b[01;32m", b"\x1b[01;36m",
+             b"\x1b[01;31m", b"\x1b[00;33m"]
+    out, n, d = [], 0, 0
+    while n < size:
+        d += 1
+        chunk = [b"./src/module%d/sub%d:\r\n" % (d, d % 7)]
+        names = [b"name%05d.%s" % (rnd.randint(0, 99999), rnd.choice((b"py", b"c", b"txt", b"so")))
+                 for _ in range(rnd.randint(3, 40))]
+        per_line = columns // 16
+        for i, name in enumerate(names):
+            chunk.append(b"%s%s\x1b[0m%s" % (rnd.choice(kinds), name, b" " * (16 - len(name))))
+            if i % per_line == per_line - 1:
+                chunk.append(b"\r\n")
+        chunk.append(b"\r\n\r\n")
+        chunk = b"".join(chunk)
+        out.append(chunk)
+        n += len(chunk)
+    return b"".join(out)
+
+
+def png(width, height, seed):
+    # Tiny truecolor PNG, written by hand so no image library is needed
+    rnd = random.Random(seed)
+    raw = b"".join(b"\x00" + bytes(bytearray(rnd.randint(0, 255) for _ in range(width * 3)))
+                   for _ in range(height))
+
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data +
+                struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    return (b"\x89PNG\r\n\x1a\n" +
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) +
+            chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+
+def images(size=2000000):
+    # Small charts pushed as img: annotations between lines of text
+    charts = [base64.b64encode(png(64, 32, seed)) for seed in range(8)]
+    rnd = random.Random(5)
+    out, n = [], 0
+    while n < size:
+        chunk = b"".join([
+            b"step %d loss 0.%04d\r\n" % (n, rnd.randint(0, 9999)),
+            u"\ufff9img:png\n".encode("utf-8"), rnd.choice(charts),
+            u"\ufffa \ufffb\r\n".encode("utf-8"),
+        ])
+        out.append(chunk)
+        n += len(chunk)
+    return b"".join(out)
+
+
+workloads = [cat, vim, htop, ls, images]
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Costs of headless use: the time to import the backend, the package and
+the widget (each in a fresh interpreter), and how soon Session.wait_for
+sees output show up compared to polling the screen every --poll seconds.
+
+    python bench/headless.py [--rounds N] [--poll SECONDS]
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pyqterm.backend import Session
+from pyqterm.wait import row_text
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+IMPORTS = [
+    ("pyqterm.backend", "import pyqterm.backend"),
+    ("pyqterm", "import pyqterm"),
+    ("TerminalWidget", "from pyqterm import TerminalWidget"),
+]
+
+
+def import_time(statement, runs=5):
+    # Best of a few fresh interpreters, None if the import fails
+    code = ("import sys, time; sys.path.insert(0, %r); t = time.time(); "
+            "%s; sys.stdout.write(repr(time.time() - t))" % (ROOT, statement))
+    best = None
+    for _ in range(runs):
+        p = subprocess.Popen([sys.executable, "-c", code],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, _err = p.communicate()
+        if p.returncode:
+            return None
+        elapsed = float(out)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def poll(session, text, interval):
+    while True:
+        for row in session.frame.rows:
+            if text in row_text(row):
+                return
+        time.sleep(interval)
+
+
+def latencies(session, rounds, wait, prefix):
+    out = []
+    for i in range(rounds):
+        # The echoed command line doesn't contain the marker itself
+        marker = u"%s%d" % (prefix, i)
+        t = time.time()
+        session.write(('echo "%s""%d"\n' % (prefix, i)).encode("ascii"))
+        wait(session, marker)
+        out.append(time.time() - t)
+    return sorted(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--poll", type=float, default=0.01)
+    args = parser.parse_args()
+
+    for name, statement in IMPORTS:
+        elapsed = import_time(statement)
+        print("import %-16s %s" % (
+            name, "failed" if elapsed is None else "%8.1f ms" % (elapsed * 1e3)))
+
+    session = Session(cmd="/bin/sh", size=(80, 24))
+    session.start()
+    session.wait_for(re.compile(u"[$#] "), timeout=5)
+
+    waits = [
+        ("wait_for", lambda s, text: s.wait_for(text, timeout=5)),
+        ("poll %gs" % args.poll, lambda s, text: poll(s, text, args.poll)),
+    ]
+    print("%-16s %10s %10s %10s" % ("output seen by", "p50 ms", "p90 ms",
+                                    "max ms"))
+    for n, (name, wait) in enumerate(waits):
+        # Markers of every run are different, none is found early
+        out = latencies(session, args.rounds, wait, "mark%d_" % n)
+        print("%-16s %10.2f %10.2f %10.2f" % (
+            name, out[len(out) // 2] * 1e3, out[len(out) * 9 // 10] * 1e3,
+            out[-1] * 1e3))
+    session.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Frame time of painting a full screen: cell by cell, in spans, and from
+the row cache when nothing changed (scrolling back, tab switches).
+
+    python bench/paint.py [columns rows]
+
+Needs a QApplication, run it with ``xvfb-run`` on a box without display.
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from PyQt4.QtGui import QApplication, QFont, QImage, QPainter
+
+from pyqterm.backend import Session, TagStream
+from pyqterm.frontend import TerminalWidget
+from pyqterm.render import Renderer
+
+
+def plain(columns, rows):
+    line = (b"the quick brown fox jumps over the lazy dog " * 10)[:columns]
+    return b"\r\n".join([line] * rows)
+
+
+def colored(columns, rows):
+    # Like ls --color: short words in a few colors
+    rnd = random.Random(0)
+    out = []
+    for _ in range(rows):
+        line, width = [], 0
+        while width < columns - 16:
+            word = b"file%04d.txt" % rnd.randint(0, 9999)
+            line.append(b"\x1b[%dm%s\x1b[0m  " % (rnd.choice((31, 32, 34, 36)), word))
+            width += len(word) + 2
+        out.append(b"".join(line))
+    return b"\r\n".join(out)
+
+
+def rainbow(columns, rows):
+    # Worst case, every cell has another color
+    rnd = random.Random(0)
+    return b"\r\n".join(
+        b"".join(b"\x1b[3%d;4%dmx" % (rnd.randint(0, 7), rnd.randint(0, 7))
+                 for _ in range(columns))
+        for _ in range(rows))
+
+
+def screen(data, columns, rows):
+    stream = TagStream()
+    screen = Session.Screen(columns, rows)
+    stream.attach(screen)
+    stream.feed(data)
+    return screen
+
+
+def frame_time(renderer, screen, frames):
+    image = QImage(screen.columns * renderer.char_width,
+                   screen.lines * renderer.char_height,
+                   QImage.Format_RGB32)
+    t = time.time()
+    for _ in range(frames):
+        painter = QPainter(image)
+        renderer.paint(painter, enumerate(screen))
+        painter.end()
+    return (time.time() - t) / frames
+
+
+def main(columns=250, rows=80, frames=10):
+    app = QApplication(sys.argv)
+    font = QFont("Monospace")
+    font.setPixelSize(14)
+    renderer = Renderer(font, TerminalWidget.foreground_color_map,
+                        TerminalWidget.background_color_map)
+
+    print("%-10s %10s %10s %10s" % ("workload", "cells ms", "spans ms",
+                                    "cached ms"))
+    for workload in (plain, colored, rainbow):
+        s = screen(workload(columns, rows), columns, rows)
+        renderer.cache_rows = False
+        renderer.spans = False
+        cells = frame_time(renderer, s, frames)
+        renderer.spans = True
+        spans = frame_time(renderer, s, frames)
+        renderer.cache_rows = True
+        frame_time(renderer, s, 1)
+        cached = frame_time(renderer, s, frames)
+        print("%-10s %10.2f %10.2f %10.2f" % (workload.__name__, cells * 1e3,
+                                              spans * 1e3, cached * 1e3))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:3]))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checks that the bulk path of TagStream draws exactly what the per
+character path does, then compares their speed.
+
+    python bench/stream.py
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pyqterm.backend import Session, TagStream
+
+
+class CharStream(TagStream):
+    bulk = False
+
+
+def corpus(seed=0, size=200000):
+    rnd = random.Random(seed)
+    pieces = [
+        b"plain ascii text ",
+        u"utf-8 éè │─ 中文 ".encode("utf-8"),
+        b"\r\n", b"\t", b"\x08", b"\x07", b"\x00", b"\x7f", b"\x0e", b"\x0f",
+        b"\x1b[1;31m", b"\x1b[0m", b"\x1b[42m", b"\x1b[7m", b"\x1b[K",
+        b"\x1b[2J", b"\x1b[H", b"\x1b[5;10H", b"\x1b[3A", b"\x1b[4C",
+        b"\x1b[4h", b"\x1b[4l", b"\x1b[?7l", b"\x1b[?7h", b"\x1b[20h",
+        b"\x1b[20l", b"\x1b[2;20r", b"\x1b[r", b"\x1bM", b"\x1bD",
+        b"\x1b[1;\x18x", b"\x1b(0lqqk\x1b(B", b"\x1b[2@", b"\x1b[3P",
+        u"￹img:x\nAAAA￺".encode("utf-8"),
+        u"￹#ff8800￺colored￻".encode("utf-8"),
+        b"x" * 150,
+    ]
+    out = []
+    while sum(map(len, out)) < size:
+        out.append(rnd.choice(pieces))
+    return b"".join(out)
+
+
+def state(screen):
+    c = screen.cursor
+    return (list(map(tuple, screen)), c.x, c.y, tuple(c.attrs),
+            sorted(screen.dirty), sorted(screen.mode), screen.margins)
+
+
+def replay(stream_class, data, chunks):
+    stream = stream_class()
+    screen = Session.Screen(80, 24)
+    stream.attach(screen)
+    pos = 0
+    for n in chunks:
+        stream.feed(data[pos:pos + n])
+        pos += n
+    return screen
+
+
+def check(rounds=20):
+    for seed in range(rounds):
+        data = corpus(seed, 20000)
+        rnd = random.Random(seed)
+        chunks = [rnd.randint(1, 4096) for _ in range(len(data))]
+        a = state(replay(TagStream, data, chunks))
+        b = state(replay(CharStream, data, chunks))
+        if a != b:
+            print("MISMATCH seed=%d" % seed)
+            return False
+    print("bulk and per-character output identical (%d corpora)" % rounds)
+    return True
+
+
+def speed(size=2000000):
+    line = b"the quick brown fox jumps over the lazy dog 0123456789\r\n"
+    data = line * (size // len(line))
+    for stream_class in (CharStream, TagStream):
+        t = time.time()
+        replay(stream_class, data, [65536] * (len(data) // 65536 + 1))
+        dt = time.time() - t
+        print("%-10s %8.2f MB/s" % (stream_class.__name__,
+                                    len(data) / dt / 1e6))
+
+
+if __name__ == "__main__":
+    if not check():
+        sys.exit(1)
+    speed()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Throughput and latency of the parse and paint pipeline, without a pty and
+without a display.
+
+Every corpus is replayed through TagStream and Session.Screen in pty sized
+chunks, publishing a frame after each chunk like the parser thread does;
+then the frames are painted onto a QImage with the Qt offscreen platform.
+Results are written as JSON, so runs can be compared over time:
+
+    python bench/suite.py [--output results.json] [--corpus DIR] [--size N]
+
+``--corpus`` replays ``DIR/*.raw`` recordings instead of the generated
+workloads. PyQt4 has no offscreen platform, there painting is skipped
+unless a display is available (``xvfb-run`` provides one).
+"""
+import os
+import sys
+import glob
+import json
+import time
+import platform
+import argparse
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pyte
+
+from pyqterm.backend import Session
+
+import corpus
+
+
+CHUNK = 4096
+COLUMNS, LINES = 80, 24
+
+
+def load(args):
+    if args.corpus:
+        for path in sorted(glob.glob(os.path.join(args.corpus, "*.raw"))):
+            with open(path, "rb") as f:
+                yield os.path.splitext(os.path.basename(path))[0], f.read()
+    else:
+        for workload in corpus.workloads:
+            yield workload.__name__, workload(args.size)
+
+
+def replay(data):
+    """
+    Parse data chunk by chunk, returns the elapsed time and the frames
+    """
+    session = Session(size=(COLUMNS, LINES))
+    frames = []
+    feed, publish = session.stream.feed, session.proc_publish
+    t = time.time()
+    for pos in range(0, len(data), CHUNK):
+        feed(data[pos:pos + CHUNK])
+        frames.append(publish())
+    return time.time() - t, frames
+
+
+def parse(name, data):
+    elapsed, frames = replay(data)
+    return dict(corpus=name, bytes=len(data), seconds=elapsed,
+                mb_per_s=len(data) / elapsed / 1e6,
+                us_per_byte=elapsed / len(data) * 1e6), frames
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def paint(name, frames, renderer):
+    from PyQt4.QtGui import QImage, QPainter
+
+    image = QImage(COLUMNS * renderer.char_width, LINES * renderer.char_height,
+                   QImage.Format_RGB32)
+    renderer.row_cache.clear()
+    times, last = [], None
+    for frame in frames:
+        if frame is last:
+            continue
+        if last is None:
+            changed = range(len(frame.rows))
+        else:
+            changed = [y for y, (a, b) in enumerate(zip(last.rows, frame.rows))
+                       if a is not b]
+        last = frame
+        t = time.time()
+        painter = QPainter(image)
+        renderer.paint(painter, ((y, frame.rows[y]) for y in changed))
+        painter.end()
+        times.append((time.time() - t) * 1e3)
+    if not times:
+        return dict(corpus=name, frames=0)
+    return dict(corpus=name, frames=len(times),
+                mean_ms=sum(times) / len(times),
+                p50_ms=percentile(times, 0.5), p95_ms=percentile(times, 0.95),
+                max_ms=max(times))
+
+
+def painter():
+    # Renderer for offscreen painting, or the reason why there is none
+    try:
+        from PyQt4.QtCore import QT_VERSION
+        from PyQt4.QtGui import QApplication, QFont
+    except ImportError as e:
+        return None, str(e)
+    if QT_VERSION < 0x050000 and not os.environ.get("DISPLAY"):
+        return None, "Qt4 needs a display for fonts, run under xvfb-run"
+
+    from pyqterm.frontend import TerminalWidget
+    from pyqterm.render import Renderer
+
+    global app
+    app = QApplication.instance() or QApplication(sys.argv)
+    font = QFont("Monospace")
+    font.setPixelSize(14)
+    return Renderer(font, TerminalWidget.foreground_color_map,
+                    TerminalWidget.background_color_map), None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    parser.add_argument("--corpus", help="directory of *.raw recordings")
+    parser.add_argument("--size", type=int, default=1000000,
+                        help="bytes per generated workload")
+    parser.add_argument("--no-paint", action="store_true")
+    args = parser.parse_args()
+
+    renderer, reason = (None, "disabled") if args.no_paint else painter()
+    result = dict(
+        meta=dict(time=time.time(), python=platform.python_version(),
+                  platform=platform.platform(),
+                  pyte=getattr(pyte, "__version__", None),
+                  chunk=CHUNK, size=[COLUMNS, LINES]),
+        parse=[], paint=[])
+    if renderer is None:
+        result["meta"]["paint_skipped"] = reason
+
+    for name, data in load(args):
+        stats, frames = parse(name, data)
+        result["parse"].append(stats)
+        if renderer is not None:
+            result["paint"].append(paint(name, frames, renderer))
+
+    out = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cost of a dashboard of thumbnails compared to one terminal, per second of
+colored log output at --rate lines per second into every one of --count
+screens: all thumbnails are updated ThumbnailWidget.frame_rate times a
+second, and one of the screens is painted TerminalWidget.frame_rate times
+a second the way TerminalWidget does (all rows, as they scrolled, from
+the row cache where it can).
+
+    python bench/thumbnail.py [--count N] [--rate N] [--seconds N]
+
+Needs a QApplication, run it with ``xvfb-run`` on a box without display.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from PyQt4.QtGui import QApplication, QFont, QImage, QPainter
+
+from pyqterm.backend import Session, TagStream
+from pyqterm.frontend import TerminalWidget
+from pyqterm.render import Renderer
+from pyqterm.thumbnail import Thumbnail, ThumbnailWidget
+
+
+def log_lines(rnd, count):
+    out = []
+    for _ in range(count):
+        level = rnd.choice((b"\x1b[32mINFO\x1b[0m", b"\x1b[33mWARN\x1b[0m",
+                            b"\x1b[31mFAIL\x1b[0m"))
+        out.append(b"\r\n%s worker-%d handled request %08x in %d ms" % (
+            level, rnd.randint(0, 99), rnd.getrandbits(32),
+            rnd.randint(1, 999)))
+    return b"".join(out)
+
+
+def screen(rnd, columns, rows):
+    stream, screen = TagStream(), Session.Screen(columns, rows)
+    stream.attach(screen)
+    stream.feed(log_lines(rnd, rows))
+    return stream, screen
+
+
+def frames(rnd, screens, seconds, frame_rate, rate):
+    # Frames of all screens, as much output as a frame's time brings
+    # coming before each
+    for n in range(int(seconds * frame_rate)):
+        lines = rate * (n + 1) // frame_rate - rate * n // frame_rate
+        out = []
+        for stream, screen in screens:
+            stream.feed(log_lines(rnd, lines))
+            out.append(tuple(row.snapshot() for row in screen))
+        yield out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--rate", type=int, default=60)
+    parser.add_argument("--seconds", type=int, default=2)
+    parser.add_argument("--size", default="120x40")
+    args = parser.parse_args()
+    columns, rows = map(int, args.size.split("x"))
+
+    app = QApplication(sys.argv)
+    rnd = random.Random(0)
+    maps = (TerminalWidget.foreground_color_map,
+            TerminalWidget.background_color_map)
+
+    # Parsing and publishing is the same whoever shows the screens, only
+    # showing them is timed
+    screens = [screen(rnd, columns, rows) for _ in range(args.count)]
+    thumbnails = [Thumbnail(*maps) for _ in screens]
+    for thumbnail, (_stream, s) in zip(thumbnails, screens):
+        thumbnail.update(tuple(row.snapshot() for row in s))
+    thumb_time = 0.0
+    for shown in frames(rnd, screens, args.seconds,
+                        ThumbnailWidget.frame_rate, args.rate):
+        t = time.time()
+        for thumbnail, rows_ in zip(thumbnails, shown):
+            thumbnail.update(rows_)
+        thumb_time += time.time() - t
+
+    font = QFont("Monospace")
+    font.setPixelSize(14)
+    renderer = Renderer(font, *maps)
+    image = QImage(columns * renderer.char_width, rows * renderer.char_height,
+                   QImage.Format_RGB32)
+    paint_time = 0.0
+    for shown in frames(rnd, [screen(rnd, columns, rows)], args.seconds,
+                        TerminalWidget.frame_rate, args.rate):
+        t = time.time()
+        painter = QPainter(image)
+        renderer.paint(painter, enumerate(shown[0]))
+        painter.end()
+        paint_time += time.time() - t
+
+    print("%d lines/s into %d screens of %s" % (args.rate, args.count,
+                                                  args.size))
+    print("%3d thumbnails at %2d fps: %8.1f ms/s" % (
+        args.count, ThumbnailWidget.frame_rate,
+        thumb_time * 1e3 / args.seconds))
+    print("  one terminal at %2d fps: %8.1f ms/s" % (
+        TerminalWidget.frame_rate, paint_time * 1e3 / args.seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Aggregate parse throughput of many busy sessions with the in-process
+Parser and with ParserPool at a growing number of worker processes.
+
+The generated workloads are fed straight into the sessions' rings, as
+the reader stage would, without a pty; a run ends when every session has
+parsed everything and published its last frame. The final frames have
+to be the same whichever parser produced them.
+
+    python bench/workers.py [--sessions N] [--size N] [--workers 1,2,4]
+"""
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pyqterm.backend import Session
+from pyqterm.reactor import Parser
+from pyqterm.workers import ParserPool
+
+import corpus
+
+
+CHUNK = 4096
+
+
+def run(parser, data, count):
+    sessions = [Session(size=(80, 24), parser=parser) for _ in range(count)]
+    pos = [0] * count
+    t = time.time()
+    while True:
+        busy = False
+        for i, session in enumerate(sessions):
+            if pos[i] >= len(data):
+                continue
+            busy = True
+            n = session.ring.write(data[pos[i]:pos[i] + CHUNK])
+            if n:
+                pos[i] += n
+                session.parser.schedule(session)
+        if not busy:
+            break
+        if not any(s.ring.free() for s in sessions):
+            time.sleep(0.001)
+
+    # End of output, sessions report exited once it's all parsed
+    for session in sessions:
+        session.eof = True
+        session.parser.schedule(session)
+    while not all(s.exited for s in sessions):
+        time.sleep(0.001)
+    return time.time() - t, sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--size", type=int, default=200000,
+                        help="bytes of output per session and workload")
+    parser.add_argument("--workers", default=None,
+                        help="comma separated worker counts, default 1, 2, "
+                        "4, ... up to the number of CPUs")
+    args = parser.parse_args()
+
+    cpus = multiprocessing.cpu_count()
+    if args.workers:
+        counts = [int(n) for n in args.workers.split(",")]
+    else:
+        counts = [1]
+        while counts[-1] * 2 <= cpus:
+            counts.append(counts[-1] * 2)
+    pools = [(n, ParserPool(workers=n)) for n in counts]
+
+    print("%d sessions, %d CPUs" % (args.sessions, cpus))
+    print("%-10s %12s" % ("", "in process") +
+          "".join("%12s" % ("%d workers" % n) for n in counts))
+    for workload in corpus.workloads:
+        data = workload(args.size)
+        total = len(data) * args.sessions
+        elapsed, reference = run(Parser.instance(), data, args.sessions)
+        row = ["%10.2f" % (total / elapsed / 1e6)]
+        for n, pool in pools:
+            elapsed, sessions = run(pool, data, args.sessions)
+            for a, b in zip(reference, sessions):
+                assert a.frame.rows == b.frame.rows, workload.__name__
+            row.append("%10.2f" % (total / elapsed / 1e6))
+        print("%-10s" % workload.__name__ + "".join(
+            "%12s" % r for r in row) + "  MB/s")
+
+    for n, pool in pools:
+        pool.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,27 @@
 # -*- coding: utf-8 -*-
-from .frontend import TerminalWidget
\ No newline at end of file
+# TerminalWidget needs PyQt4, so it is imported the first time it is
+# asked for: headless users of pyqterm.backend never load Qt.
+import sys
+import types
+
+
+class _Package(types.ModuleType):
+
+    def __getattr__(self, name):
+        if name == 'TerminalWidget':
+            from .frontend import TerminalWidget
+            self.TerminalWidget = TerminalWidget
+            return TerminalWidget
+        raise AttributeError(name)
+
+
+try:
+    sys.modules[__name__].__class__ = _Package
+except TypeError:
+    # Python 2 modules can't change their class, the package is replaced
+    # by one sharing its contents; the original stays referenced, its
+    # globals are the ones of everything defined here
+    _package = _Package(__name__)
+    _package.__dict__.update(sys.modules[__name__].__dict__)
+    _package._original = sys.modules[__name__]
+    sys.modules[__name__] = _package
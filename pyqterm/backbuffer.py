@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Painting rows in a thread of their own. The widget hands the rows which
+# changed to its BackBuffer, whose thread rasterizes them and copies them
+# into an image as large as the widget; paintEvent only copies regions of
+# that image to the screen, however much text changed.
+# License: GPL2
+import time
+import threading
+
+from PyQt4.QtCore import QObject, pyqtSignal
+from PyQt4.QtGui import QImage, QPainter
+
+from .render import ImageRenderer
+
+
+class BackBuffer(QObject):
+    """
+    An image of the rows given to :meth:`render`, kept up to date by a
+    thread; ``painted(lines)`` is emitted once rows are in the image
+    """
+
+    painted = pyqtSignal(object)
+
+    def __init__(self, parent=None):
+        super(BackBuffer, self).__init__(parent)
+        self.renderer = None
+        self.image = QImage()
+        # Held while the image is written to, copied from or replaced
+        self.lock = threading.Lock()
+        # Rows waiting for the thread by line, newer ones replace them
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.closed = False
+        self.metrics = None
+        self.thread = threading.Thread(target=self.run, name="render")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def setup(self, font, foreground_color_map, background_color_map):
+        """
+        Paint rows with these from now on, rows in the image stay as
+        they are until they are given again
+        """
+        self.renderer = ImageRenderer(font, foreground_color_map,
+                                      background_color_map)
+
+    def resize(self, width, height, color):
+        image = QImage(width, height, QImage.Format_RGB32)
+        image.fill(color.rgb())
+        with self.lock:
+            self.image = image
+
+    def render(self, rows):
+        """
+        Paint ``(line, cells)`` pairs in the background
+        """
+        with self.cond:
+            self.pending.update(rows)
+            self.cond.notify()
+
+    def blit(self, painter, rect):
+        with self.lock:
+            painter.drawImage(rect, self.image, rect)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                rows, self.pending = sorted(self.pending.items()), {}
+
+            metrics = self.metrics
+            t = time.time()
+            self.paint(self.renderer, rows)
+            if metrics is not None:
+                metrics.observe('render_time', time.time() - t)
+                metrics.observe('rendered_rows', len(rows))
+            self.painted.emit([line for line, _row in rows])
+
+    def paint(self, renderer, rows):
+        # Rows are rasterized before the image is locked, so paintEvent
+        # never waits for more than copying them in
+        paint_row = renderer.paint_row if renderer.spans else renderer.paint_cells
+        surfaces = [(line, row, renderer.row_pixmap(row, paint_row))
+                    for line, row in rows]
+        char_height = renderer.char_height
+        with self.lock:
+            if self.image.isNull():
+                # Not sized yet, everything is given again on resize
+                return
+            painter = QPainter(self.image)
+            painter.setFont(renderer.font)
+            for line, row, surface in surfaces:
+                if surface is None:
+                    # Rows with images aren't cached
+                    paint_row(painter, line * char_height, row)
+                else:
+                    renderer.blit(painter, 0, line * char_height, surface)
+            painter.end()
@@ -5,27 +5,50 @@
 # which can be used by the widget.
 # License: GPL2
 import os
+import re
+import errno
 import fcntl
 import threading
-import time
 import termios
 import pty
 import signal
 import struct
-import select
-import subprocess
+import time
+import traceback
+from collections import namedtuple
+from itertools import repeat
 
 import pyte
+from pyte import modes as mo
+from pyte import graphics as g
+from pyte.screens import Char, Cursor, Savepoint
+
+from .reactor import Reactor, Parser, READ, WRITE
+from .images import ImageStore, images
+from .history import History
+from .record import Recorder
+from .metrics import Metrics
+from .search import Search
+from .watch import Watch
+from . import wait
+from .cells import CompactScreen
+from . import palette
 
 __version__ = "0.1"
 
 def synchronized(func):
     def wrapper(self, *args, **kwargs):
         try:
-            self.lock.acquire()
+            lock = self.lock
         except AttributeError:
-            self.lock = threading.RLock()
-            self.lock.acquire()
+            lock = self.lock = threading.RLock()
+        metrics = getattr(self, 'metrics', None)
+        if metrics is None:
+            lock.acquire()
+        else:
+            t = time.time()
+            lock.acquire()
+            metrics.observe('lock_wait', time.time() - t)
         try:
             result = func(self, *args, **kwargs)
         finally:
@@ -37,10 +60,89 @@ def synchronized(func):
 import cStringIO
 
 class TagStream(pyte.ByteStream):
+
+    # Runs of characters which are simply drawn: no C0/C1 controls, no
+    # DEL and no annotation markers
+    plain = re.compile(u'[^\x00-\x1f\x7f-\x9f\ufff9-\ufffb]+')
+
+    # Hand plain runs to the screens in one go, the per character path is
+    # kept for escape sequences and annotations
+    bulk = True
+
     def __init__(self,):
         super(TagStream, self).__init__()
         self.handlers['annotation'] = self._ann
 
+    def feed(self, chars):
+        if not isinstance(chars, bytes):
+            raise TypeError(
+                "%s requires input in bytes" % self.__class__.__name__)
+
+        for decoder in self.decoders:
+            decoder.setstate(self.buffer)
+
+            try:
+                chars = decoder.decode(chars)
+            except UnicodeDecodeError:
+                continue
+
+            self.buffer = decoder.getstate()
+            return self._feed(chars)
+
+    def _feed(self, chars):
+        if not self.bulk:
+            return pyte.Stream.feed(self, chars)
+
+        consume = self.consume
+        match = self.plain.match
+        i, n = 0, len(chars)
+        while i < n:
+            state = self.state
+            if state == 'stream' and not self.flags:
+                m = match(chars, i)
+                if m is not None:
+                    self._draw(m.group())
+                    i = m.end()
+                    continue
+            elif state == 'annotation':
+                end = chars.find(u'\ufffa', i)
+                if end < 0:
+                    end = n
+                if end > i:
+                    self.annotation.write(chars[i:end])
+                    i = end
+                    continue
+
+            consume(chars[i])
+            i += 1
+
+    def _draw(self, text):
+        # Same as dispatching "draw" for every character of text, screens
+        # which know how to draw a whole run get it at once
+        for listener, only in self.listeners:
+            if only and "draw" not in only:
+                continue
+
+            draw_text = getattr(listener, "draw_text", None)
+            if draw_text is not None:
+                chunks = [text]
+            else:
+                draw_text = getattr(listener, "draw", None)
+                if draw_text is None:
+                    continue
+                chunks = text
+
+            before = getattr(listener, "__before__", None)
+            after = getattr(listener, "__after__", None)
+            for chunk in chunks:
+                if before is not None:
+                    before("draw")
+                draw_text(chunk)
+                if after is not None:
+                    after("draw")
+
+        self.reset()
+
     def _ann(self, char):
 
         if char == u'\ufffa':
@@ -62,49 +164,371 @@ class TagStream(pyte.ByteStream):
 
         super(TagStream, self)._stream(char)
 
+    def getstate(self):
+        """
+        Parser state in plain types, see :meth:`setstate`
+        """
+        annotation = None
+        if self.state == 'annotation':
+            annotation = self.annotation.getvalue()
+        return dict(state=self.state, flags=dict(self.flags),
+                    params=list(self.params), current=self.current,
+                    buffer=self.buffer, annotation=annotation)
+
+    def setstate(self, state):
+        self.state = state['state']
+        self.flags = state['flags']
+        self.params = state['params']
+        self.current = state['current']
+        self.buffer = state['buffer']
+        if state['annotation'] is not None:
+            self.annotation = cStringIO.StringIO()
+            self.annotation.write(state['annotation'])
+
 class TagScreen(pyte.Screen):
+
+    # Image payloads go here, cells only get the handle
+    images = images
+
+    # Scrollback, lines scrolling off the top of the screen go there
+    history = None
+
+    # Colors are palette keys, see palette
+    default_char = palette.default_char
+    default_line = repeat(default_char)
+
+    def reset(self):
+        super(TagScreen, self).reset()
+        self.cursor.attrs = self.default_char
+
+    def select_graphic_rendition(self, *attrs):
+        """
+        Set display attributes like pyte does, colors as palette keys;
+        bright, 256 and truecolor colors are understood as well
+        """
+        replace = {}
+        params = iter(attrs or [0])
+        for attr in params:
+            if attr in (38, 48):
+                color = palette.extended(params)
+                if color is not None:
+                    replace["fg" if attr == 38 else "bg"] = color
+            elif attr in palette.SGR_FG:
+                replace["fg"] = palette.SGR_FG[attr]
+            elif attr in palette.SGR_BG:
+                replace["bg"] = palette.SGR_BG[attr]
+            elif attr in g.TEXT:
+                attr = g.TEXT[attr]
+                replace[attr[1:]] = attr.startswith("+")
+            elif not attr:
+                replace = self.default_char._asdict()
+
+        self.cursor.attrs = self.cursor.attrs._replace(**replace)
+
     def annotate(self, text):
-        self.cursor.attrs = self.cursor.attrs._replace(fg=text or 'default')
+        if text and text.startswith(ImageStore.prefix):
+            text = self.images.add_annotation(text)
+        self.cursor.attrs = self.cursor.attrs._replace(
+            fg=palette.key(text) if text else palette.DEFAULT)
+
+    def index(self):
+        top, bottom = self.margins
+        if self.history is not None and top == 0 and self.cursor.y == bottom:
+            self.history.append(self[top])
+        super(TagScreen, self).index()
+
+    def draw(self, char):
+        super(TagScreen, self).draw(char)
+        # DiffScreen marks the line the cursor was on, when wrapping the
+        # character goes on the next one
+        dirty = getattr(self, 'dirty', None)
+        if dirty is not None:
+            dirty.add(self.cursor.y)
+
+    def draw_text(self, text):
+        """
+        Draw a run of printable characters, does exactly what calling
+        draw() for each of them would
+        """
+        draw = self.draw
+        raw, text = text, text.translate([self.g0_charset,
+                                          self.g1_charset][self.charset])
+        if len(text) != len(raw):
+            for char in raw:
+                draw(char)
+            return
+
+        dirty = getattr(self, 'dirty', None)
+        cursor = self.cursor
+        i, n = 0, len(text)
+        while i < n:
+            # Wrapping, insert mode and odd cursor positions are left
+            # to draw(), runs between them are written in place
+            x = cursor.x
+            if (x >= self.columns or mo.IRM in self.mode
+                    or mo.DECAWM not in self.mode):
+                draw(raw[i])
+                i += 1
+                continue
+
+            chunk = text[i:i + self.columns - x]
+            attrs = cursor.attrs
+            row = self[cursor.y]
+            if hasattr(row, 'draw'):
+                row.draw(x, chunk, attrs[1:])
+            else:
+                make, rest = attrs._make, attrs[1:]
+                row[x:x + len(chunk)] = [make((c,) + rest) for c in chunk]
+            cursor.x = x + len(chunk)
+            i += len(chunk)
+            if dirty is not None:
+                dirty.add(cursor.y)
+
+    def getstate(self):
+        """
+        Screen contents, cursor and modes in plain types, enough to
+        carry on from where the screen is; the history is not included
+        """
+        def cursor(c):
+            return (c.x, c.y, tuple(c.attrs), c.hidden)
+
+        return dict(
+            size=(self.lines, self.columns),
+            rows=[[tuple(c) for c in row] for row in self],
+            cursor=cursor(self.cursor), mode=sorted(self.mode),
+            margins=tuple(self.margins), tabstops=sorted(self.tabstops),
+            charset=self.charset, g0=self.g0_charset, g1=self.g1_charset,
+            savepoints=[(cursor(s.cursor),) + tuple(s[1:])
+                        for s in self.savepoints])
+
+    def setstate(self, state):
+        def cursor(x, y, attrs, hidden):
+            c = Cursor(x, y, Char._make(attrs))
+            c.hidden = hidden
+            return c
+
+        self.lines, self.columns = state['size']
+        self[:] = [[Char._make(c) for c in row] for row in state['rows']]
+        self.cursor = cursor(*state['cursor'])
+        self.mode = set(state['mode'])
+        self.margins = type(self.margins)(*state['margins'])
+        self.tabstops = set(state['tabstops'])
+        self.charset = state['charset']
+        self.g0_charset, self.g1_charset = state['g0'], state['g1']
+        self.savepoints = [Savepoint(cursor(*s[0]), *s[1:])
+                           for s in state['savepoints']]
+        dirty = getattr(self, 'dirty', None)
+        if dirty is not None:
+            dirty.update(range(self.lines))
+
+#: Immutable picture of a screen, published by the parser. Rows are
+#: sequences of cells (FrozenRow snapshots, or tuples); a row which didn't
+#: change is the very same object as in the previous frame, so readers can
+#: find changed rows by identity.
+Frame = namedtuple("Frame", "version rows cursor changed")
 
 class Session(object):
 
-    class Screen(TagScreen, pyte.DiffScreen):
+    class Screen(TagScreen, CompactScreen, pyte.DiffScreen):
         pass
 
-
-    def __init__(self, cmd="/bin/bash", env_term = "linux", timeout=60*60*24, size=(80,24)):
+    # Raw output waiting for the parser, reading stops when it is full
+    ring_size = 1 << 18
+    # Seconds of parsing per batch the batch size is adapted to
+    parse_slice = 0.004
+    batch_min = 1024
+    batch_max = 1 << 18
+    # Bytes of compressed scrollback kept per session
+    history_budget = 8 << 20
+    # Jump scrolling: once jump_threshold bytes of output are waiting to
+    # be parsed, frames are only published when the output stops, or
+    # jump_max_delay seconds after the last one
+    jump_scroll = True
+    jump_threshold = 1 << 14
+    jump_max_delay = 0.5
+    # Input the pty didn't take yet is queued, writers wait for room
+    # once this many bytes are
+    write_queue_max = 1 << 20
+    # Collect counters and histograms from the start, see stats()
+    collect_stats = False
+
+
+    def __init__(self, cmd="/bin/bash", env_term = "linux", timeout=60*60*24, size=(80,24),
+                 reactor=None, parser=None):
         # Session
         self.session = {}
         self.cmd = cmd
         self.env_term = env_term
         self.timeout = timeout
         self.size = size
+        self.pid = None
+        self.fd = None
+        # lock guards the screen, io_lock the pty descriptor
+        self.lock = threading.RLock()
+        self.io_lock = threading.RLock()
+        self.metrics = Metrics() if self.collect_stats else None
+        # Notified when the input queue drains
+        self.write_cond = threading.Condition(self.io_lock)
 
         # pyte
         self.stream = TagStream()
         self.screen = self.Screen(*self.size)
+        self.history = self.screen.history = History(self.history_budget)
         self.stream.attach(self.screen)
+        self.frame = Frame(0, (), None, frozenset())
+        self.proc_publish()
+
+        # I/O is driven by a reactor shared with other sessions, output
+        # goes through the ring to the parser thread
+        self.reactor = reactor
+        self.parser = parser or Parser.instance()
+        self.batch = self.batch_min
+        self.paused = False
+        self.eof = self.exited = False
+        # Bytes of output read and parsed so far
+        self.received = self.parsed = 0
+        # Jump scrolling state, when the last frame was published and
+        # how many batches were parsed without publishing one
+        self.jumping = False
+        self.published = time.time()
+        self.jumped = 0
+        self.recorder = None
+        self.input_queue = bytearray()
+
+        # Called from the parser thread after every parsed batch
+        self.callbacks = []
+        # Watches of the output, replaced rather than changed in place
+        self.watches = []
+
+        # Last, the parser may start looking at the session right away
+        self.ring = self.parser.attach(self)
+
+
+    def collect(self, on=True):
+        """
+        Start collecting stats afresh, or stop
+        """
+        self.metrics = Metrics() if on else None
+
+    def stats(self):
+        """
+        Counters and histograms collected so far, empty unless collecting
+        (see collect_stats): bytes read and read calls, parse time and
+        bytes per batch, time spent waiting for the screen lock, dirty
+        rows per frame and batches skipped by jump scrolling. Histograms
+        are dicts, see pyqterm.metrics.Histogram.snapshot(); times are in
+        seconds.
+        """
+        metrics = self.metrics
+        if metrics is None:
+            return {}
+        stats = metrics.snapshot()
+        stats['queued'] = self.queued
+        return stats
+
+    def search(self, text, ignore_case=False):
+        """
+        Look for text in the history and on the screen, a Search whose
+        matches follow the output until it is closed
+        """
+        return Search(self, text, ignore_case)
 
-        # Supervisor thread
-        self.signal_stop = 0
-        self.thread = threading.Thread(target = self.proc_thread)
+    def watch(self, patterns, callback, literal=False, ignore_case=False):
+        """
+        Look for patterns in the output from now on, callback(hit) is
+        called for every match as the output is read, before it is
+        parsed; a Watch, see pyqterm.watch for patterns and hits
+        """
+        watch = Watch(self, patterns, callback, literal, ignore_case)
+        with self.io_lock:
+            self.watches = self.watches + [watch]
+        return watch
 
+    def unwatch(self, watch):
+        with self.io_lock:
+            self.watches = [w for w in self.watches if w is not watch]
 
     def stop(self):
-        # Stop supervisor thread
-        self.signal_stop = 1
-        self.thread.join()
+        # Takes effect right away, there is no thread to wait for
+        self.proc_bury()
+
+    def subscribe(self, callback):
+        """
+        Have callback() called, from the parser thread, whenever the
+        screen may have changed
+        """
+        # Replaced rather than changed, the list may be being iterated
+        with self.io_lock:
+            self.callbacks = self.callbacks + [callback]
+
+    def unsubscribe(self, callback):
+        with self.io_lock:
+            self.callbacks = [c for c in self.callbacks if c != callback]
+
+    def wait_for(self, pattern, timeout=None):
+        """
+        Wait until text, or a compiled regular expression, shows up on
+        the screen, returns ``(row, column)`` of it; None if it didn't
+        before the timeout or the session exited
+        """
+        return wait.wait_for(self, pattern, timeout)
+
+    def snapshot(self, after=None, timeout=None):
+        """
+        The current Frame, which never changes; with after, waits for
+        the first frame with a version above after (None on timeout)
+        """
+        return wait.snapshot(self, after, timeout)
 
     def resize(self, w, h):
-        self.screen.resize(h,w)
-        try:
-            fcntl.ioctl(self.fd,
-                struct.unpack('i',
-                    struct.pack('I', termios.TIOCSWINSZ)
-                )[0],
-                struct.pack("HHHH", h, w, 0, 0))
-        except (IOError, OSError):
-            pass
+        self.parser.resize(self, w, h)
+        with self.io_lock:
+            if self.fd is None:
+                return
+            try:
+                fcntl.ioctl(self.fd,
+                    struct.unpack('i',
+                        struct.pack('I', termios.TIOCSWINSZ)
+                    )[0],
+                    struct.pack("HHHH", h, w, 0, 0))
+            except (IOError, OSError):
+                pass
+
+    def record(self, path):
+        """
+        Record output from now on to path, see pyqterm.record.Replay
+        for playing it back
+        """
+        with self.lock:
+            with self.io_lock:
+                self.stop_recording()
+                recorder = Recorder(path)
+                recorder.checkpoint(self.parsed, self.getstate())
+                # Read before recording started, but not parsed yet
+                pending = self.ring.peek()
+                if pending:
+                    recorder.data(pending, self.parsed)
+                self.recorder = recorder
+        return recorder
+
+    def stop_recording(self):
+        with self.io_lock:
+            recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.close()
+
+    @synchronized
+    def getstate(self):
+        """
+        Screen and parser state in plain (marshallable) types
+        """
+        return dict(screen=self.screen.getstate(),
+                    stream=self.stream.getstate())
+
+    @synchronized
+    def setstate(self, state):
+        self.screen.setstate(state['screen'])
+        self.stream.setstate(state['stream'])
 
     @synchronized
     def start(self):
@@ -126,18 +550,37 @@ class Session(object):
                 ls = []
             if len(ls) < 2:
                 ls = ['en_US', 'UTF-8']
+            # The command replaces the forked child, so the session is a
+            # single process
+            if isinstance(self.cmd, (list, tuple)):
+                args = list(self.cmd)
+            else:
+                args = [self.cmd]
+            # Nor should it keep other sessions' ptys open
+            try:
+                fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+            except OSError:
+                fds = range(3, 1024)
+            for fd in fds:
+                if fd > 2:
+                    try:
+                        os.close(fd)
+                    except OSError:
+                        pass
             try:
                 os.putenv('COLUMNS', str(w))
                 os.putenv('LINES', str(h))
                 os.putenv('TERM', self.env_term)
-                os.putenv('PATH', os.environ['PATH'])
+                os.putenv('PATH', os.environ.get('PATH', os.defpath))
                 os.putenv('LANG', ls[0] + '.UTF-8')
-                p = subprocess.Popen(self.cmd, shell=False)
-                child_pid, sts = os.waitpid(p.pid, 0)
-            except (IOError, OSError):
-                pass
-            # self.proc_finish(sid)
-            os._exit(0)
+                os.execvp(args[0], args)
+            except (IOError, OSError) as e:
+                # Leave the reason on the terminal
+                msg = '%s: %s\r\n' % (args[0], e.strerror)
+                if not isinstance(msg, bytes):
+                    msg = msg.encode('utf-8', 'replace')
+                os.write(2, msg)
+            os._exit(127)
         else:
             # Store session vars
             self.pid = pid
@@ -147,7 +590,9 @@ class Session(object):
             # Set terminal size
             self.resize(w, h)
 
-            self.thread.start()
+            if self.reactor is None:
+                self.reactor = Reactor.instance()
+            self.reactor.add(fd, self)
 
             return True
 
@@ -158,70 +603,293 @@ class Session(object):
         except (KeyError, IOError, OSError):
             pass
         try:
-            os.waitpid(self.fd, 0)
+            pid, sts = os.waitpid(self.pid, os.WNOHANG)
+            if not pid:
+                # Still shutting down, don't block on it
+                self.reactor.reap(self.pid)
         except (KeyError, IOError, OSError):
             pass
         return True
 
 
-    @synchronized
+    def proc_finish(self):
+        """
+        Detach from the reactor once the process is gone, the parser
+        notes the exit after the last buffered output
+        """
+        with self.io_lock:
+            if self.fd is None:
+                return False
+
+            self.reactor.remove(self.fd)
+            self.proc_waitfordeath()
+            self.fd = None
+            self.eof = True
+            # Nobody is going to read it
+            del self.input_queue[:]
+            self.write_cond.notify_all()
+
+        # No more output to decide what watches held back
+        for watch in self.watches:
+            watch.flush()
+        self.parser.schedule(self)
+        return True
+
+
     def proc_bury(self):
-        try:
-            os.kill(self.pid, signal.SIGTERM)
-        except (IOError, OSError):
-            pass
+        with self.io_lock:
+            if self.fd is None:
+                return False
+
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except (IOError, OSError):
+                pass
 
-        self.proc_waitfordeath()
+            self.proc_finish()
         return True
 
 
-    @synchronized
     def proc_read(self):
         """
-        Read from process
+        Reader stage, called by the reactor: drain the pty into the ring
         """
-        try:
-            d = os.read(self.fd, 65536)
-            if not d:
-                # Process finished, BSD
-                self.proc_waitfordeath()
+        d = b""
+        with self.io_lock:
+            if self.fd is None:
                 return False
-        except (IOError, OSError):
-            # Process finished, Linux
-            self.proc_waitfordeath()
-            return False
 
-        self.stream.feed(d)
+            free = self.ring.free()
+            if free:
+                try:
+                    d = os.read(self.fd, min(free, 65536))
+                    if not d:
+                        # Process finished, BSD
+                        self.proc_finish()
+                        return False
+                except (IOError, OSError) as e:
+                    if e.errno in (errno.EAGAIN, errno.EINTR):
+                        return True
+                    # Process finished, Linux
+                    self.proc_finish()
+                    return False
+
+                free -= self.ring.write(d)
+                metrics = self.metrics
+                if metrics is not None:
+                    metrics.count('reads')
+                    metrics.count('read_bytes', len(d))
+                if self.recorder is not None:
+                    self.recorder.data(d, self.received)
+                self.received += len(d)
+
+            if not free:
+                # Backpressure: leave the rest in the pty until the
+                # parser catches up
+                self.paused = True
+                self.reactor.modify(self.fd, self.proc_events())
+
+        if d:
+            # Outside the lock, callbacks may well write to the session
+            for watch in self.watches:
+                watch.feed(d)
+        self.parser.schedule(self)
+        return True
+
 
-    @synchronized
-    def write(self, d):
+    def proc_resume(self):
+        with self.io_lock:
+            if self.paused and self.ring.free() >= self.ring.capacity // 4:
+                self.paused = False
+                if self.fd is not None:
+                    self.reactor.modify(self.fd, self.proc_events())
+
+
+    def proc_events(self):
+        # What the reactor should wait for, io_lock held
+        return ((0 if self.paused else READ) |
+                (WRITE if self.input_queue else 0))
+
+
+    def proc_write(self):
         """
-        Write to process
+        Writer stage, called by the reactor when the pty takes input
         """
-        try:
-            os.write(self.fd, d)
-        except (IOError, OSError):
-            return False
+        with self.io_lock:
+            if self.fd is None:
+                return False
+            queue = self.input_queue
+            if queue:
+                try:
+                    del queue[:os.write(self.fd, bytes(queue[:65536]))]
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EAGAIN, errno.EINTR):
+                        # Reading finds out what happened
+                        del queue[:]
+            if len(queue) < self.write_queue_max:
+                self.write_cond.notify_all()
+            if not queue:
+                self.reactor.modify(self.fd, self.proc_events())
         return True
 
 
-    def proc_thread(self):
+    @synchronized
+    def proc_parse(self):
         """
-        Supervisor thread
+        Parser stage: feed the next batch from the ring to the stream,
+        returns True while there is more to parse
         """
-        while not self.signal_stop:
-            fds = [self.fd]
+        d = self.ring.read(self.batch)
+        if d:
+            t = time.time()
+            self.stream.feed(d)
+            elapsed = time.time() - t
+            self.proc_adapt(len(d), elapsed)
+            metrics = self.metrics
+            if metrics is not None:
+                metrics.observe('parse_time', elapsed)
+                metrics.observe('parse_bytes', len(d))
+            self.parsed += len(d)
+            recorder = self.recorder
+            if recorder is not None and recorder.due(self.parsed):
+                recorder.checkpoint(self.parsed, self.getstate())
+            self.proc_resume()
+            if self.proc_jump():
+                return True
+        elif self.eof and not self.exited:
+            self.stop_recording()
+            self.stream.feed(b'\n[ exited ]')
+            # Whoever sees exited sees the last frame as well
+            self.proc_publish()
+            self.exited = True
+        else:
+            return False
+
+        self.proc_publish()
+        self.published = time.time()
+        self.proc_notify()
+
+        return len(self.ring) > 0 or (self.eof and not self.exited)
+
+
+    @synchronized
+    def proc_resize(self, w, h):
+        self.screen.resize(h,w)
+        self.proc_publish()
+        if self.recorder is not None:
+            # Replays have to see the new size
+            self.recorder.checkpoint(self.parsed, self.getstate())
+        self.proc_notify()
+
+    def proc_notify(self):
+        # A subscriber which fails neither stops parsing nor the others
+        for callback in self.callbacks:
             try:
-                i, o, e = select.select(fds, [], [], 1.0)
-            except (IOError, OSError):
-                i = []
-            except select.error:
-                break
+                callback()
+            except Exception:
+                traceback.print_exc()
 
-            if i:
-                self.proc_read()
-                time.sleep(0.002)
+    @synchronized
+    def proc_publish(self):
+        """
+        Replace self.frame with a snapshot of the screen; only the dirty
+        rows are copied, the others are shared with the previous frame
+        """
+        screen, frame = self.screen, self.frame
+        # Lines which scrolled off before the frame, its rows come after
+        self.frame_total = self.history.total
+        c = screen.cursor
+        cursor = (c.x, c.y, c.hidden)
+        if len(frame.rows) != screen.lines or \
+                (frame.rows and len(frame.rows[0]) != screen.columns):
+            rows = tuple(row.snapshot() for row in screen)
+            changed = frozenset(range(screen.lines))
+        elif screen.dirty:
+            rows = list(frame.rows)
+            changed = frozenset(y for y in screen.dirty if y < screen.lines)
+            for y in changed:
+                rows[y] = screen[y].snapshot()
+            rows = tuple(rows)
+        elif cursor != frame.cursor:
+            rows, changed = frame.rows, frozenset()
+        else:
+            return frame
+        screen.dirty.clear()
 
-        self.proc_bury()
+        # A single reference assignment, readers never need the lock
+        self.frame = Frame(frame.version + 1, rows, cursor, changed)
+        if self.metrics is not None:
+            self.metrics.observe('dirty_rows', len(changed))
+        return self.frame
 
-        self.stream.feed('\n[ exited ]')
+
+    def proc_jump(self):
+        """
+        Whether to leave the batch just parsed unpublished: output is
+        flooding in, only the screen it ends with is worth painting
+        """
+        backlog = len(self.ring)
+        if not self.jump_scroll or not backlog:
+            # Gone quiet
+            self.jumping = False
+            return False
+        if backlog >= self.jump_threshold:
+            self.jumping = True
+        if (not self.jumping or
+                time.time() - self.published >= self.jump_max_delay):
+            return False
+        self.jumped += 1
+        if self.metrics is not None:
+            self.metrics.count('jumped')
+        return True
+
+    def proc_adapt(self, size, elapsed):
+        # Grow the batch while parsing it stays well inside the slice,
+        # shrink it when the screen was held for too long
+        if elapsed < self.parse_slice / 2 and size == self.batch:
+            self.batch = min(self.batch * 2, self.batch_max)
+        elif elapsed > self.parse_slice:
+            self.batch = max(self.batch // 2, self.batch_min)
+
+
+    def write(self, d, block=True):
+        """
+        Write to process, never waits for the parser. What the pty can't
+        take right away is queued, in order, and written as it drains;
+        with block, a write which doesn't fit the queue waits for room.
+        """
+        with self.io_lock:
+            if self.fd is None:
+                return False
+            if not self.input_queue:
+                # Keystrokes mostly find the queue empty and go straight in
+                try:
+                    d = d[os.write(self.fd, d):]
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EAGAIN, errno.EINTR):
+                        return False
+                if not d:
+                    return True
+
+            # The reactor drains the queue, it mustn't wait for itself
+            block = block and (
+                threading.current_thread() is not self.reactor.thread)
+            while d:
+                room = self.write_queue_max - len(self.input_queue)
+                if block and room <= 0:
+                    self.write_cond.wait()
+                    if self.fd is None:
+                        return False
+                    continue
+                n = len(d) if not block else room
+                self.input_queue += d[:n]
+                d = d[n:]
+                self.reactor.modify(self.fd, self.proc_events())
+        return True
+
+    @property
+    def queued(self):
+        """
+        Bytes of input waiting for the pty to take them
+        """
+        return len(self.input_queue)
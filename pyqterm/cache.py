@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Small LRU cache bounded by the total cost of its entries.
+# License: GPL2
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Least recently used entries are dropped once the summed cost of all
+    entries goes over ``budget``. The cost of an entry is given to
+    :meth:`put`, by default every entry costs 1.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, cost = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = value, cost
+            return value
+
+    def put(self, key, value, cost=1):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = value, cost
+            self.size += cost
+            while self.size > self.budget and len(self.entries) > 1:
+                _key, (_value, _cost) = self.entries.popitem(last=False)
+                self.size -= _cost
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
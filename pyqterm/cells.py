@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+# Compact screen rows. A row of Char namedtuples costs a tuple per cell;
+# here a row is two arrays of unsigned ints, one with the character of
+# every cell, one with indices into a table of interned attributes (all of
+# a Char but its data), shared by all screens. Rows still behave like the
+# lists of Chars pyte expects, the Chars are made as they are looked at.
+# Frames get snapshots of rows which share the arrays until the row
+# changes again.
+# Tables don't grow without end: once one is full, new rows and rows being
+# written to use a new one, and the old one goes with the last row using
+# it.
+# License: GPL2
+import threading
+from array import array
+from itertools import count, groupby
+
+from pyte.screens import Char
+
+
+class CellTable(object):
+    """
+    Interned cell attributes and the odd cell data longer than one
+    character, and the Chars made from them
+    """
+
+    # Codes with this bit set index strings instead of being a character
+    STRING = 1 << 31
+
+    # Chars made for looking at rows are shared, up to this many
+    cache_size = 1 << 16
+
+    # Attributes or strings a table takes before rows move on to a new one
+    limit = 1 << 16
+
+    # Tell tables apart in row keys, their indices mean different things
+    _generations = count()
+
+    def __init__(self):
+        self.generation = next(self._generations)
+        self.lock = threading.Lock()
+        self.attrs = []
+        self.attr_index = {}
+        self.strings = []
+        self.string_index = {}
+        self.chars = {}
+        # Once set, rows move on to a new table
+        self.full = False
+        # The Char last turned into a code and attributes, and those
+        self.memo = (None, 0, 0)
+
+    def intern(self, attrs):
+        idx = self.attr_index.get(attrs)
+        if idx is None:
+            with self.lock:
+                idx = self.attr_index.get(attrs)
+                if idx is None:
+                    idx = len(self.attrs)
+                    self.attrs.append(attrs)
+                    self.attr_index[attrs] = idx
+                    self.full = self.full or idx + 1 >= self.limit
+        return idx
+
+    def code(self, data):
+        if len(data) == 1:
+            return ord(data)
+        idx = self.string_index.get(data)
+        if idx is None:
+            with self.lock:
+                idx = self.string_index.get(data)
+                if idx is None:
+                    idx = len(self.strings)
+                    self.strings.append(data)
+                    self.string_index[data] = idx
+                    self.full = self.full or idx + 1 >= self.limit
+        return idx | self.STRING
+
+    def encode(self, char):
+        """
+        Code and attribute index of a Char
+        """
+        memo = self.memo
+        if memo[0] is char:
+            return memo[1], memo[2]
+        code, idx = self.code(char[0]), self.intern(tuple(char[1:]))
+        self.memo = (char, code, idx)
+        return code, idx
+
+    def char(self, code, idx):
+        key = (code, idx)
+        char = self.chars.get(key)
+        if char is None:
+            if len(self.chars) > self.cache_size:
+                self.chars.clear()
+            if code & self.STRING:
+                data = self.strings[code & ~self.STRING]
+            else:
+                data = unichr(code)
+            char = self.chars[key] = Char._make((data,) + self.attrs[idx])
+        return char
+
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+if hasattr(array, 'tobytes'):
+    _bytes = array.tobytes
+else:
+    _bytes = array.tostring
+
+
+class Row(object):
+    """
+    A screen line, with the part of the list interface pyte uses on
+    lines; items going in and out are Chars
+    """
+
+    __slots__ = ('codes', 'attrs', 'shared', 'table')
+
+    #: Table new rows and rows being written to intern their cells in
+    cells = CellTable()
+
+    def __init__(self, chars=(), codes=None, attrs=None, table=None):
+        if codes is None:
+            table = self.current()
+        self.table = table
+        if codes is None:
+            codes, attrs = self.encode(chars)
+        self.codes = codes
+        self.attrs = attrs
+        self.shared = False
+
+    @staticmethod
+    def current():
+        table = Row.cells
+        if table.full:
+            table = Row.cells = CellTable()
+        return table
+
+    def encode(self, chars):
+        encode = self.table.encode
+        if not isinstance(chars, list):
+            chars = list(chars)
+        if chars and chars.count(chars[0]) == len(chars):
+            # Blank lines, all of the same Char
+            code, idx = encode(chars[0])
+            return array('I', [code]) * len(chars), array('I', [idx]) * len(chars)
+        pairs = [encode(char) for char in chars]
+        return (array('I', [p[0] for p in pairs]),
+                array('I', [p[1] for p in pairs]))
+
+    def snapshot(self):
+        """
+        An immutable copy, which shares the arrays until this row changes
+        """
+        self.shared = True
+        return FrozenRow(codes=self.codes, attrs=self.attrs, table=self.table)
+
+    def own(self):
+        # Copy on write, into the current table
+        if self.table is not Row.cells or self.table.full:
+            table = self.current()
+            if table is not self.table:
+                self.move(table)
+                return
+        if self.shared:
+            self.codes = self.codes[:]
+            self.attrs = self.attrs[:]
+            self.shared = False
+
+    def move(self, table):
+        # The same cells, interned in table
+        old = self.table
+        attrs = dict((idx, table.intern(old.attrs[idx]))
+                     for idx in set(self.attrs))
+        codes = self.codes
+        if any(code & old.STRING for code in codes):
+            codes = [table.code(old.strings[code & ~old.STRING])
+                     if code & old.STRING else code for code in codes]
+        self.codes = array('I', codes)
+        self.attrs = array('I', map(attrs.__getitem__, self.attrs))
+        self.table = table
+        self.shared = False
+
+    def key(self):
+        """
+        Hashable and equal for rows with equal cells in the same table
+        """
+        return self.table.generation, _bytes(self.codes), _bytes(self.attrs)
+
+    def rstrip(self, char):
+        """
+        Length of the row without the cells equal to char at its end
+        """
+        code, idx = self.table.encode(char)
+        codes, attrs = self.codes, self.attrs
+        end = len(codes)
+        while end and codes[end - 1] == code and attrs[end - 1] == idx:
+            end -= 1
+        return end
+
+    def text(self, end=None):
+        """
+        Data of the cells up to end, a string, or a tuple of strings if
+        some cell holds more than one character
+        """
+        codes = self.codes[:end]
+        if any(code & self.table.STRING for code in codes):
+            return tuple(c.data for c in self[:end])
+        return u"".join(map(unichr, codes))
+
+    def runs(self, end=None):
+        """
+        Attributes of the cells up to end as ``(attrs, count)`` pairs of
+        runs of cells with the same attributes; attrs is all of a Char
+        but its data
+        """
+        table = self.table.attrs
+        return [(table[idx], len(list(group)))
+                for idx, group in groupby(self.attrs[:end])]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        return iter(list(map(self.table.char, self.codes, self.attrs)))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(map(self.table.char, self.codes[index],
+                            self.attrs[index]))
+        return self.table.char(self.codes[index], self.attrs[index])
+
+    def __setitem__(self, index, value):
+        self.own()
+        if isinstance(index, slice):
+            self.codes[index], self.attrs[index] = self.encode(value)
+        else:
+            self.codes[index], self.attrs[index] = self.table.encode(value)
+
+    def __delitem__(self, index):
+        self.own()
+        del self.codes[index]
+        del self.attrs[index]
+
+    def insert(self, index, char):
+        self.own()
+        code, idx = self.table.encode(char)
+        self.codes.insert(index, code)
+        self.attrs.insert(index, idx)
+
+    def pop(self, index=-1):
+        char = self[index]
+        del self[index]
+        return char
+
+    def append(self, char):
+        self.insert(len(self.codes), char)
+
+    def extend(self, chars):
+        self.own()
+        codes, attrs = self.encode(chars)
+        self.codes.extend(codes)
+        self.attrs.extend(attrs)
+
+    def draw(self, x, text, attrs):
+        """
+        Write text from column x on, every character a cell with attrs
+        (all of a Char but its data); the same as assigning the Chars
+        """
+        self.own()
+        n = len(text)
+        self.codes[x:x + n] = array('I', [ord(c) for c in text])
+        self.attrs[x:x + n] = array('I', [self.table.intern(attrs)]) * n
+
+    def fill(self, start, stop, char):
+        """
+        Set the cells from start up to stop to char
+        """
+        self.own()
+        code, idx = self.table.encode(char)
+        n = max(min(stop, len(self.codes)) - start, 0)
+        self.codes[start:start + n] = array('I', [code]) * n
+        self.attrs[start:start + n] = array('I', [idx]) * n
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __eq__(self, other):
+        if isinstance(other, Row) and other.table is self.table:
+            return self.codes == other.codes and self.attrs == other.attrs
+        if isinstance(other, Row):
+            return list(self) == list(other)
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, list(self))
+
+
+class FrozenRow(Row):
+    """
+    Snapshot of a row, as frames hold them
+    """
+
+    __slots__ = ()
+
+    def own(self):
+        raise TypeError("%s is immutable" % self.__class__.__name__)
+
+    def snapshot(self):
+        return self
+
+    def __hash__(self):
+        return hash(self.key())
+
+
+def as_row(line):
+    if isinstance(line, Row) and not isinstance(line, FrozenRow):
+        return line
+    return Row(line)
+
+
+class CompactScreen(object):
+    """
+    Mixin for pyte screens which keeps every line as a :class:`Row`,
+    whatever pyte puts in: ``class Screen(CompactScreen, pyte.Screen)``
+    """
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [as_row(line) for line in value]
+        else:
+            value = as_row(value)
+        super(CompactScreen, self).__setitem__(index, value)
+
+    def __setslice__(self, i, j, value):
+        # Python 2 does self[i:j] = value through here
+        self.__setitem__(slice(i, j), value)
+
+    def insert(self, index, line):
+        super(CompactScreen, self).insert(index, as_row(line))
+
+    def append(self, line):
+        super(CompactScreen, self).append(as_row(line))
+
+    def extend(self, lines):
+        super(CompactScreen, self).extend([as_row(line) for line in lines])
+
+    # Erasing sets a whole run of cells at once, not a Char per column;
+    # otherwise the same as pyte does, DiffScreen's part included
+
+    def erase_characters(self, count=None):
+        cursor = self.cursor
+        self.mark_dirty(cursor.y)
+        stop = min(cursor.x + (count or 1), self.columns)
+        self[cursor.y].fill(cursor.x, stop, cursor.attrs)
+
+    def erase_in_line(self, type_of=0, private=False):
+        cursor = self.cursor
+        self.mark_dirty(cursor.y)
+        start, stop = ((cursor.x, self.columns), (0, cursor.x + 1),
+                       (0, self.columns))[type_of]
+        self[cursor.y].fill(start, stop, cursor.attrs)
+
+    def mark_dirty(self, y):
+        dirty = getattr(self, 'dirty', None)
+        if dirty is not None:
+            dirty.add(y)
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# Frontend side of the session server (pyqterm.server): sessions running
+# in another process, which TerminalWidget.attach() shows just like local
+# ones. Screen updates arrive in the reactor thread.
+# License: GPL2
+import os
+import sys
+import time
+import errno
+import socket
+import marshal
+import threading
+import traceback
+import subprocess
+from collections import deque
+
+from .backend import Frame
+from .history import History
+from .images import images
+from .reactor import Reactor
+from .search import Search
+from . import wait
+from . import protocol
+
+
+def connect(path=None, spawn=True, timeout=5.0):
+    """
+    A SessionClient for the server listening at path; unless spawn is
+    false a server is started when there is none
+    """
+    path = path or protocol.default_path()
+    try:
+        return SessionClient(path)
+    except (IOError, OSError):
+        if not spawn:
+            raise
+
+    # Its own session, so it outlives the frontend and its terminal
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [root] + [p for p in [env.get("PYTHONPATH")] if p])
+    devnull = open(os.devnull, "r+b")
+    subprocess.Popen([sys.executable, "-m", "pyqterm.server", "--socket", path],
+                     stdin=devnull, stdout=devnull, stderr=devnull,
+                     env=env, close_fds=True, preexec_fn=os.setsid)
+    devnull.close()
+
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return SessionClient(path)
+        except (IOError, OSError):
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+class SessionClient(object):
+    """
+    Connection to a session server
+    """
+
+    # Seconds to wait for the server to answer a request
+    timeout = 5.0
+
+    def __init__(self, path=None, reactor=None):
+        self.path = path or protocol.default_path()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.path)
+            # Only a server of the same user gets to see the input
+            protocol.check_peer(self.sock)
+        except (IOError, OSError):
+            self.sock.close()
+            raise
+        self.fd = self.sock.fileno()
+        self.inbuf = bytearray()
+        self.decoder = protocol.Decoder()
+        self.sessions = {}
+        self.replies = deque()
+        self.cond = threading.Condition(threading.Lock())
+        self.send_lock = threading.Lock()
+        self.call_lock = threading.Lock()
+        self.connected = True
+        self.reactor = reactor or Reactor.instance()
+        self.reactor.add(self.fd, self)
+
+    def create(self, cmd="/bin/bash", size=(80, 24)):
+        """
+        Start a session in the server and attach to it
+        """
+        return self.call(protocol.request(protocol.CREATE, cmd, *size),
+                         protocol.ATTACHED)
+
+    def attach(self, sid):
+        session = self.call(protocol.request(protocol.ATTACH, sid),
+                            protocol.ATTACHED)
+        if session is None:
+            raise KeyError(sid)
+        return session
+
+    def list(self):
+        """
+        ``(sid, pid, cmd, exited)`` of every session in the server
+        """
+        return self.call(protocol.request(protocol.LIST), protocol.SESSIONS)
+
+    def close(self):
+        """
+        Disconnect, the sessions keep running in the server
+        """
+        self.reactor.remove(self.fd)
+        self.disconnect()
+
+    def send(self, data):
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def call(self, data, kind):
+        with self.call_lock:
+            with self.cond:
+                self.send(data)
+                deadline = time.time() + self.timeout
+                while not self.replies:
+                    if not self.connected:
+                        raise IOError("session server went away")
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        raise IOError("no answer from session server")
+                    self.cond.wait(wait)
+                reply_kind, reply = self.replies.popleft()
+        if reply_kind != kind:
+            raise IOError("unexpected answer from session server")
+        return reply
+
+    def disconnect(self):
+        with self.cond:
+            if not self.connected:
+                return
+            self.connected = False
+            self.cond.notify_all()
+        self.sock.close()
+        sessions, self.sessions = list(self.sessions.values()), {}
+        for session in sessions:
+            session.closed()
+
+    def proc_read(self):
+        try:
+            d = self.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return True
+            d = b""
+        if not d:
+            self.reactor.remove(self.fd)
+            self.disconnect()
+            return False
+
+        self.inbuf += d
+        messages, used = protocol.split(self.inbuf)
+        del self.inbuf[:used]
+        changed = set()
+        for kind, payload in messages:
+            self.dispatch(kind, payload, changed)
+        # Subscribers hear about everything that came in at once
+        for session in changed:
+            session.notify()
+        return True
+
+    def dispatch(self, kind, payload, changed):
+        decoder = self.decoder
+        if kind == protocol.FRAME:
+            sid, version, lines, columns, cursor, rows = decoder.frame(payload)
+            session = self.sessions.get(sid)
+            if session is not None:
+                session.update(version, lines, columns, cursor, rows)
+                changed.add(session)
+        elif kind == protocol.HISTORY:
+            sid, lines = decoder.history(payload)
+            session = self.sessions.get(sid)
+            if session is not None:
+                for line in lines:
+                    session.history.append(line)
+        elif kind == protocol.ATTRS:
+            decoder.add_attrs(payload)
+        elif kind == protocol.IMAGE:
+            handle, data = protocol.image(payload)
+            images.add(data)
+        elif kind == protocol.CLOSED:
+            sid, = marshal.loads(payload)
+            session = self.sessions.pop(sid, None)
+            if session is not None:
+                session.closed()
+        elif kind in (protocol.ATTACHED, protocol.SESSIONS):
+            reply = marshal.loads(payload)
+            if kind == protocol.ATTACHED:
+                sid, pid, cmd = reply
+                reply = None
+                if sid:
+                    reply = self.sessions.get(sid)
+                    if reply is None:
+                        reply = self.sessions[sid] = \
+                            RemoteSession(self, sid, pid, cmd)
+            with self.cond:
+                self.replies.append((kind, reply))
+                self.cond.notify_all()
+
+
+class RemoteSession(object):
+    """
+    A session living in the session server, with the part of the Session
+    interface widgets use: frames, history, subscribers, write and resize.
+    Closing a widget only detaches from it; stop() ends it.
+    """
+
+    # Jump scrolling happens in the server, these only mirror Session
+    jump_scroll = True
+    jumped = 0
+
+    def __init__(self, client, sid, pid, cmd):
+        self.client = client
+        self.sid = sid
+        self.pid = pid
+        self.cmd = cmd
+        self.frame = Frame(0, (), None, frozenset())
+        self.history = History()
+        # Lines which scrolled off before the frame, under lock with it
+        self.frame_total = 0
+        self.lock = threading.RLock()
+        self.callbacks = []
+        self.eof = self.exited = False
+
+    def collect(self, on=True):
+        # Parsing happens in the server, there is nothing to measure here
+        pass
+
+    def stats(self):
+        return {}
+
+    def search(self, text, ignore_case=False):
+        return Search(self, text, ignore_case)
+
+    def wait_for(self, pattern, timeout=None):
+        return wait.wait_for(self, pattern, timeout)
+
+    def snapshot(self, after=None, timeout=None):
+        return wait.snapshot(self, after, timeout)
+
+    def subscribe(self, callback):
+        self.callbacks = self.callbacks + [callback]
+
+    def unsubscribe(self, callback):
+        self.callbacks = [c for c in self.callbacks if c != callback]
+
+    def notify(self):
+        for callback in self.callbacks:
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+
+    def update(self, version, lines, columns, cursor, rows):
+        with self.lock:
+            # The server sends history before the frame it scrolled off
+            self.frame_total = self.history.total
+            self.frame = protocol.patch(self.frame, version, lines, columns,
+                                        cursor, rows)
+
+    def closed(self):
+        self.eof = self.exited = True
+        self.notify()
+
+    def request(self, data):
+        try:
+            self.client.send(data)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def write(self, d, block=True):
+        return self.request(protocol.message(
+            protocol.WRITE, protocol.SID.pack(self.sid) + d))
+
+    def resize(self, w, h):
+        self.request(protocol.request(protocol.RESIZE, self.sid, w, h))
+
+    def start(self):
+        return True
+
+    def stop(self):
+        self.request(protocol.request(protocol.STOP, self.sid))
+
+    def detach(self):
+        self.client.sessions.pop(self.sid, None)
+        self.request(protocol.request(protocol.DETACH, self.sid))
+
+    def proc_bury(self):
+        self.detach()
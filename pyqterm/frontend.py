@@ -1,13 +1,18 @@
 # -*- coding: utf-8 -*-
 import sys, os
 import time
+from bisect import bisect_left, bisect_right
 
-from PyQt4.QtCore import QRect, Qt, pyqtSignal, QByteArray
+from PyQt4.QtCore import QRect, Qt, pyqtSignal, QByteArray, QObject, QTimer
 from PyQt4.QtGui import (
        QApplication, QClipboard, QWidget, QPainter, QFont, QBrush, QColor, 
-       QPen, QPixmap, QImage, QContextMenuEvent)
+       QPen, QPixmap, QImage, QContextMenuEvent, QRegion, QFontDatabase)
 
 from .backend import Session
+from .backbuffer import BackBuffer
+from .metrics import Metrics
+from . import palette
+from .render import Renderer
 
 
 
@@ -15,6 +20,51 @@ DEBUG = False
 
 
 
+class RepaintScheduler(QObject):
+    """
+    Merges change notifications, which come from the parser thread, into
+    at most one repaint per frame interval on the GUI thread
+    """
+
+    requested = pyqtSignal()
+
+    def __init__(self, widget, frame_rate=60):
+        super(RepaintScheduler, self).__init__(widget)
+        self.widget = widget
+        self.interval = 1000.0 / frame_rate
+        self.pending = False
+        self.last = 0.0
+        self.notifications = 0
+        self.frames = 0
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.frame)
+        # Queued, notify() is called from other threads
+        self.requested.connect(self.schedule)
+
+    def notify(self):
+        self.notifications += 1
+        if not self.pending:
+            self.pending = True
+            self.requested.emit()
+
+    def schedule(self):
+        if not self.timer.isActive():
+            wait = self.last + self.interval - time.time() * 1000
+            self.timer.start(max(0, int(wait)))
+
+    def frame(self):
+        self.pending = False
+        self.last = time.time() * 1000
+        self.frames += 1
+        self.widget.update_rows()
+
+    def stats(self):
+        return dict(notifications=self.notifications, frames=self.frames,
+                    merged=self.notifications - self.frames)
+
+
+
 class TerminalWidget(QWidget):
 
     
@@ -81,65 +131,142 @@ class TerminalWidget(QWidget):
 
 
     session_closed = pyqtSignal()
+    # stats() every stats_interval seconds while collecting
+    stats_updated = pyqtSignal(object)
+
+    # Repaints per second at most
+    frame_rate = 60
+
+    # Only show where floods of output end up, see Session.jump_scroll
+    jump_scroll = True
+
+    # A pyqterm.pool.SessionPool to take already running sessions from
+    pool = None
 
-    class Screen(object):
-        def __init__(self, widget):
-            self.widget = widget
+    # Search results, the one jumped to stands out
+    match_color = QColor(255, 255, 0, 90)
+    current_match_color = QColor(255, 128, 0, 160)
 
-        def draw(self, char):
-            self.widget.update()
+    # Rasterize rows in a thread of the widget's own into a back buffer,
+    # paintEvent only copies from there. Ignored where the platform can't
+    # render text outside the GUI thread, rows are painted there instead.
+    render_thread = False
+
+    # Collect stats of the widget and its session from the start
+    collect_stats = False
+    stats_interval = 1.0
 
     def __init__(self, parent=None, command="/bin/bash", 
-                 font_name="Monospace", font_size=18):
+                 font_name="Monospace", font_size=18, session=None):
         super(TerminalWidget, self).__init__(parent)
         self.setFocusPolicy(Qt.WheelFocus)
         self.setAutoFillBackground(False)
         self.setAttribute(Qt.WA_OpaquePaintEvent, True)
         self.setCursor(Qt.IBeamCursor)
+        self._renderer = self._back = None
         font = QFont(font_name)
         font.setPixelSize(font_size)
         self.setFont(font)
         self._session = None
-        self._draw_screen = self.Screen(self)
+        self._mirror = False
+        self._columns = self._rows = 0
+        self._margins = []
+        self._frame = None
+        self._dirty = set()
+        self._scroll = 0
+        self._search = self._match = None
+        self._scheduler = RepaintScheduler(self, self.frame_rate)
+        self.metrics = None
+        self._stats_timer = QTimer(self)
+        self._stats_timer.timeout.connect(self._emit_stats)
         self.setupPainters()
-        self.execute()
+        if session is None:
+            self.execute()
+        else:
+            self.attach(session, mirror=True)
+        if self.collect_stats:
+            self.collect()
 
     def setupPainters(self):
-        self._pen, self._brash = {}, {}
-        for idx,color in self.foreground_color_map.items():
-            self._pen[idx] = QPen(QColor(color))
-
-        for idx,color in self.background_color_map.items():
-            self._brash[idx] = QBrush(QColor(color))
+        self._renderer = Renderer(self.font(), self.foreground_color_map,
+                                  self.background_color_map)
+        if (self.render_thread
+                and QFontDatabase.supportsThreadedFontRendering()):
+            if self._back is None:
+                self._back = BackBuffer(self)
+                self._back.painted.connect(self._update_lines)
+            self._setup_back()
+
+    def _setup_back(self):
+        self._back.setup(self.font(), self.foreground_color_map,
+                         self.background_color_map)
+        if self._session is not None:
+            self._invalidate()
 
     def pen(self, color):
-        if color in self._pen:
-            return self._pen[color]
-
-        _color = self.foreground_color_map.get(color, color)
-        pen = QPen(QColor(_color))
-        self._pen[color] = pen
-        return pen
+        return self._renderer.pen(color)
 
     def brash(self, color):
-        if color in self._brash:
-            return self._brash[color]
-
-        _color = self.background_color_map.get(color, color)
-        brash = QBrush(QColor(_color))
-        self._brash[color] = brash
-        return brash
+        return self._renderer.brash(color)
         
     def execute(self, command="/bin/bash"):
-        self._session = Session(cmd=command)
-        self._session.stream.attach(self._draw_screen)
-
-        self._session.start()
-        self._screen = self._session.screen
+        if self.pool is not None:
+            session = self.pool.get(command)
+        else:
+            session = Session(cmd=command)
+            session.start()
+        self.attach(session)
+
+    def attach(self, session, mirror=False):
+        """
+        Show session from now on, a local Session or one in a session
+        server (pyqterm.client.RemoteSession)
+
+        Any number of widgets can show the same session, it is parsed
+        once for all of them. One owns it: its size is the session's and
+        closing it ends the session. The others are mirrors, they show
+        the session at whatever size it has and leave it alone on close.
+        """
+        if self._session is not None:
+            self._session.unsubscribe(self._scheduler.notify)
+            self.search(None)
+        self._session = session
+        self._mirror = mirror
+        if not mirror:
+            session.jump_scroll = self.jump_scroll
+        session.subscribe(self._scheduler.notify)
+        if self.metrics is not None:
+            session.collect()
+        self._frame = None
+        self._scroll = 0
+        if self._columns and not mirror:
+            session.resize(self._columns, self._rows)
+        self.update_rows()
+
+    def session(self):
+        return self._session
+
+    def mirror(self, parent=None):
+        """
+        A new widget showing the session of this one, see attach()
+        """
+        font = self.font()
+        return self.__class__(parent, font_name=font.family(),
+                              font_size=font.pixelSize(),
+                              session=self._session)
+
+    def set_frame_rate(self, frame_rate):
+        """
+        Repaint at most frame_rate times per second, every widget showing
+        a session has its own rate
+        """
+        self._scheduler.interval = 1000.0 / frame_rate
 
             
     def send(self, s):
-        self._session.write(s)
+        # Keystrokes and pastes never wait for the queue to drain, the
+        # paste is in memory already anyway
+        self._session.write(s, block=False)
 
     def stop(self):
         self._session.stop()
@@ -151,34 +278,57 @@ class TerminalWidget(QWidget):
     def setFont(self, font):
         super(TerminalWidget, self).setFont(font)
         self._update_metrics()
+        if self._renderer is not None:
+            self._renderer.setFont(font)
+        if self._back is not None:
+            self._setup_back()
 
         
     def resizeEvent(self, event):
-        self._columns, self._rows = self._pixel2pos(self.width(), self.height())
-        self._session.resize(self._columns, self._rows)
-
+        if self._mirror:
+            # Mirrors show the session as large as its owner made it
+            self._layout(self._columns, self._rows)
+        else:
+            self._layout(*self._pixel2pos(self.width(), self.height()))
+            self._session.resize(self._columns, self._rows)
+
+        if self._back is not None:
+            self._back.resize(self.width(), self.height(),
+                              self._renderer.background[palette.DEFAULT])
+            self._dirty.update(range(self._rows))
+        self.update_rows()
+
+    def _layout(self, columns, rows):
+        # Cells shown and the margins around them: what is left of the
+        # last character, or for mirrors what the session doesn't cover
+        self._columns, self._rows = columns, rows
+        top = rows * self._char_height
+        left = columns * self._char_width
         self._margins = [
             QRect(
                 0,
-                self._rows * self._char_height,
+                top,
                 self.width(),
-                self._char_height,
+                max(self.height() - top, self._char_height),
             ),
             QRect(
-                self._columns * self._char_width,
+                left,
                 0,
-                self._char_width,
+                max(self.width() - left, self._char_width),
                 self.height(),
             ),
         ]
 
-        # XXX: should pyte handle this for me?
-        self._screen.dirty.update(range(self._rows))
-
 
 
     def closeEvent(self, event):
-        self._session.proc_bury()
+        if self._back is not None:
+            self._back.close()
+        self._session.unsubscribe(self._scheduler.notify)
+        self.search(None)
+        if not self._mirror:
+            # Mirrors leave the session going for the others
+            self._session.proc_bury()
 
     def _update_metrics(self):
         fm = self.fontMetrics()
@@ -187,17 +337,230 @@ class TerminalWidget(QWidget):
 
     def update_screen(self):
         self.update()
+
+    def update_rows(self):
+        """
+        Pick up the latest frame of the session and invalidate the rows
+        which changed since the last one
+        """
+        frame, old = self._session.frame, self._frame
+        if self._mirror:
+            size = (len(frame.rows[0]) if frame.rows else 0, len(frame.rows))
+            if size != (self._columns, self._rows):
+                # The owner resized the session
+                self._layout(*size)
+                self._dirty.update(range(len(frame.rows)))
+                self.update()
+        if old is None or len(old.rows) != len(frame.rows):
+            self._dirty.update(range(len(frame.rows)))
+        elif frame is not old:
+            # Unchanged rows are shared between frames
+            self._dirty.update(y for y, (a, b) in
+                               enumerate(zip(old.rows, frame.rows)) if a is not b)
+        self._frame = frame
+
+        if self._back is not None:
+            self._render()
+        elif self._scroll:
+            self.update()
+        else:
+            self._update_lines(self._dirty)
+
+    def _update_lines(self, lines):
+        if self._scroll:
+            self.update()
+            return
+
+        region = QRegion()
+        width, height = self.width(), self._char_height
+        lines = sorted(lines)
+        while lines:
+            # One rectangle per run of adjacent rows
+            start = stop = lines.pop(0)
+            while lines and lines[0] == stop + 1:
+                stop = lines.pop(0)
+            region = region.united(
+                QRect(0, start * height, width, (stop - start + 1) * height))
+        if not region.isEmpty():
+            self.update(region)
+
+    def _render(self):
+        # The render thread asks for a repaint once the rows are painted
+        lines = range(self._rows) if self._scroll else self._dirty
+        self._back.render(list(self._rows_to_paint(set(lines))))
+        self._dirty.clear()
+
+    def _invalidate(self):
+        # Everything shown changed (scrolling, fonts)
+        if self._back is None:
+            self.update()
+        else:
+            self._dirty.update(range(self._rows))
+            self._render()
+
+    def repaint_stats(self):
+        """
+        Change notifications, repaints, how many notifications were
+        merged into an earlier repaint and how many parsed batches were
+        never shown because of jump scrolling
+        """
+        stats = self._scheduler.stats()
+        stats['jumped'] = self._session.jumped
+        return stats
         
+    def collect(self, on=True):
+        """
+        Start collecting stats of the widget and its session afresh, or
+        stop; while collecting stats_updated is emitted every
+        stats_interval seconds
+        """
+        self.metrics = Metrics() if on else None
+        if self._back is not None:
+            self._back.metrics = self.metrics
+        self._session.collect(on)
+        if on:
+            self._stats_timer.start(int(self.stats_interval * 1000))
+        else:
+            self._stats_timer.stop()
+
+    def stats(self):
+        """
+        repaint_stats() and, while collecting, paint time and painted
+        rows per frame, with the stats of the session under 'session'
+        """
+        stats = self.repaint_stats()
+        if self.metrics is not None:
+            stats.update(self.metrics.snapshot())
+        stats['session'] = self._session.stats()
+        return stats
+
+    def _emit_stats(self):
+        self.stats_updated.emit(self.stats())
+
+    def scroll_history(self, lines):
+        """
+        Move the view back (positive) or forward (negative) through the
+        scrollback, the live screen is at 0
+        """
+        scroll = max(0, min(self._scroll + lines, len(self._session.history)))
+        if scroll != self._scroll:
+            self._scroll = scroll
+            self._invalidate()
+
+    def search(self, text, ignore_case=False):
+        """
+        Highlight text wherever it is in the history and on the screen,
+        following the output; None stops. Returns the pyqterm.search.Search
+        """
+        if self._search is not None:
+            self._search.close()
+        self._search = self._match = None
+        if text:
+            self._search = self._session.search(text, ignore_case)
+        self.update()
+        return self._search
+
+    def find_next(self):
+        """
+        Scroll to the next match, False if there is none
+        """
+        return self._find(1)
+
+    def find_previous(self):
+        return self._find(-1)
+
+    def _find(self, step):
+        matches = self._search.matches if self._search is not None else ()
+        if not matches:
+            return False
+        if self._match is None:
+            # The most recent match first when searching backwards
+            i = 0 if step > 0 else len(matches) - 1
+        elif step > 0:
+            i = bisect_right(matches, self._match)
+        else:
+            i = bisect_left(matches, self._match) - 1
+        if not 0 <= i < len(matches):
+            return False
+        self._match = matches[i]
+
+        # Bring the line into view, in the middle unless it is already
+        history = self._session.history
+        row = self._match[0] - (history.total - self._scroll)
+        if not 0 <= row < self._rows:
+            self._scroll = max(0, min(history.total - self._match[0] +
+                                      self._rows // 2, len(history)))
+            self._invalidate()
+        self.update()
+        return True
+
+    def _paint_matches(self, painter, lines):
+        search = self._search
+        matches = search.matches
+        top = self._session.history.total - self._scroll
+        width = len(search.text) * self._char_width
+        height = self._char_height
+        for line in lines:
+            i = bisect_left(matches, (top + line, -1))
+            while i < len(matches) and matches[i][0] == top + line:
+                match = matches[i]
+                color = (self.current_match_color if match == self._match
+                         else self.match_color)
+                painter.fillRect(match[1] * self._char_width, line * height,
+                                 width, height, color)
+                i += 1
+
+    def _row(self, line):
+        # Cells shown in a row of the widget, taking the scrollback
+        # position into account; history lines are stored trimmed
+        if self._scroll:
+            history = self._session.history
+            index = len(history) - self._scroll + line
+            if index < len(history):
+                row = history[index]
+                return row + [history.default_char] * (self._columns - len(row))
+            line = index - len(history)
+
+        rows = self._frame.rows
+        if line >= len(rows):
+            return None
+        return rows[line]
+
     def paintEvent(self, event):
+        # Paints the frame picked by update_rows(), the parser keeps going
+        # meanwhile and never waits for us
         painter = QPainter(self)
-        if self._screen.dirty:
-            self._paint_screen(painter, self._screen.dirty)
 
-        if self._margins:
-            bot, right = self._margins
-            painter.fillRect(right, self.brash('default'))
-            painter.fillRect(bot, self.brash('default'))
-            self._margins = []
+        # Rows which were exposed (tab switch, resize, scrolling) come
+        # from the row cache, only changed rows get rasterized again
+        rect = event.rect()
+        lines = set(range(rect.top() // self._char_height,
+                          min(rect.bottom() // self._char_height + 1, self._rows)))
+        if self._back is not None:
+            # The render thread painted the rows, they are only copied
+            highlight = list(lines) if self._search is not None else None
+            lines = set()
+        else:
+            if self._scroll:
+                # Output moves the whole view while looking at the history
+                lines.update(range(self._rows))
+            lines.update(self._dirty)
+            self._dirty.clear()
+            # Painting takes the lines it paints out of the set
+            highlight = list(lines) if self._search is not None else None
+        metrics = self.metrics
+        if metrics is None:
+            self._paint_screen(painter, lines, rect)
+        else:
+            metrics.observe('painted_rows', len(lines))
+            t = time.time()
+            self._paint_screen(painter, lines, rect)
+            metrics.observe('paint_time', time.time() - t)
+        if highlight:
+            self._paint_matches(painter, highlight)
+
+        for margin in self._margins:
+            painter.fillRect(margin, self.brash(palette.DEFAULT))
 
 
     def _pixel2pos(self, x, y):
@@ -211,51 +574,46 @@ class TerminalWidget(QWidget):
         y = row * self._char_height
         return x, y
 
-    def _paint_screen(self, painter, lines):
-        # Speed hacks: local name lookups are faster
-        vars().update(QColor=QColor, QBrush=QBrush, QPen=QPen, QRect=QRect)
-        char_width = self._char_width
-        char_height = self._char_height
-        painter_drawText = painter.drawText
-        painter_fillRect = painter.fillRect
-        painter_setPen = painter.setPen
-        align = Qt.AlignTop | Qt.AlignLeft
-        # set defaults
+    def _paint_screen(self, painter, lines, rect):
+        if self._back is not None:
+            self._back.blit(painter, rect)
+        else:
+            self._renderer.paint(painter, self._rows_to_paint(lines))
+
+    def _rows_to_paint(self, lines):
         while lines:
             line = lines.pop()
 
-            if line >= len(self._screen):
-                continue
-
-            y = char_height * line
-            for col,item in enumerate(self._screen[line]):
-                x = col * char_width
-
-                if item.fg and item.fg.startswith('img:'):
-                    self.draw_Image(painter, x, y+char_height, item.fg)
-                    continue
-
-                painter_setPen(self.pen(item.fg))
-
-                rect = QRect(x, y, char_width, char_height)
-                painter_fillRect(rect, self.brash(item.bg))
-                painter_drawText(rect, align, item.data)
+            row = self._row(line)
+            if row is not None:
+                yield line, row
 
 
     def draw_Image(self, painter, x, y, img):
-        import base64
-        _head, img = img.split('\n',1)
-        data = base64.b64decode(img)
-        qimg = QImage.fromData(data)
-        painter.drawImage(x, y, qimg)
+        self._renderer.draw_Image(painter, x, y, img)
 
 
     return_pressed = pyqtSignal()
 
+    def wheelEvent(self, event):
+        # Three lines per wheel step
+        self.scroll_history(event.delta() // 40)
+        event.accept()
+
     def keyPressEvent(self, event):
         text = unicode(event.text())
         key = event.key()
 
+        if (event.modifiers() & Qt.ShiftModifier and
+                key in (Qt.Key_PageUp, Qt.Key_PageDown)):
+            page = self._rows if key == Qt.Key_PageUp else -self._rows
+            self.scroll_history(page)
+            event.accept()
+            return
+
+        # Typing brings the live screen back
+        self.scroll_history(-self._scroll)
+
         if text and key != Qt.Key_Backspace:
             self.send(text.encode("utf-8"))
         else:
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+# Scrollback for lines which scrolled off the top of the screen.
+# Lines are not kept as lists of Char tuples: each line is its text plus
+# runs of indices into a table of interned attributes, and every
+# block_lines lines are sealed into one marshalled (and compressed) blob,
+# along with the table of their attributes; every block has a table of
+# its own, so attributes go when the blocks using them are dropped.
+# Sealed blocks of a history which was searched get a bloom filter of the
+# trigrams in their text, made by a thread of its own, so later searches
+# only decompress the blocks which may hold what they look for; neither
+# sealing nor the first search pays for the filters.
+# License: GPL2
+import time
+import marshal
+import threading
+import zlib
+from collections import deque
+
+from pyte.screens import Char
+
+from .cache import LRUCache
+from . import palette
+
+
+def trigrams(text):
+    text = text.lower()
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def bit_positions(gram, mask):
+    h = hash(gram)
+    return h & mask, (h >> 16) & mask
+
+
+class History(object):
+    """
+    Memory bounded scrollback buffer.
+
+    Indices run from 0 (oldest line still held) to ``len(history) - 1``
+    (the line which scrolled off last). Once the sealed blocks take more
+    than ``budget`` bytes the oldest ones are dropped; :attr:`total`
+    counts every line ever appended, so ``total - len(history)`` lines
+    were dropped so far.
+    """
+
+    default_char = palette.default_char
+
+    # Bits of block filter per distinct trigram, 4 lets about one in six
+    # trigrams of a search through a block which doesn't have them
+    filter_ratio = 4
+
+    def __init__(self, budget=8 << 20, block_lines=256, compress=True):
+        self.budget = budget
+        self.block_lines = block_lines
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # Attributes of a cell without its data, interned for the
+            # open block
+            self.attrs = []
+            self.attr_index = {}
+            # Sealed blocks, block_lines lines each, their filters (None
+            # until the FilterBuilder gets to them) and the open block
+            self.blocks = deque()
+            self.filters = deque()
+            self.texts, self.runs = [], []
+            self.size = 0
+            self.total = 0
+            self.dropped = 0
+            self.decoded = LRUCache(8)
+            # Searched once, so filters are worth making, and when the
+            # last block was sealed
+            self.searched = False
+            self.sealed = 0
+
+    def __len__(self):
+        return self.total - self.dropped
+
+    def append(self, line):
+        with self.lock:
+            text, runs = self.encode(line)
+            self.texts.append(text)
+            self.runs.append(runs)
+            self.total += 1
+            if len(self.texts) >= self.block_lines:
+                self.seal()
+
+    def seal(self):
+        blob = marshal.dumps((self.texts, self.runs, self.attrs))
+        if self.compress:
+            blob = zlib.compress(blob, 1)
+        self.blocks.append(blob)
+        self.filters.append(None)
+        self.size += len(blob)
+        self.texts, self.runs = [], []
+        self.attrs, self.attr_index = [], {}
+        self.trim()
+        self.sealed = time.time()
+        if self.searched:
+            FilterBuilder.instance().add(self)
+
+    def trim(self):
+        while self.size > self.budget and self.blocks:
+            self.size -= len(self.blocks.popleft())
+            self.size -= len(self.filters.popleft() or b"")
+            self.dropped += self.block_lines
+            self.decoded.clear()
+
+    def bloom(self, texts):
+        """
+        Bloom filter of the (lowercased) trigrams in texts
+        """
+        grams = set()
+        for text in texts:
+            grams.update(trigrams(u"".join(text)))
+        bits = 64
+        while bits < len(grams) * self.filter_ratio:
+            bits <<= 1
+        bloom, mask = bytearray(bits // 8), bits - 1
+        for gram in grams:
+            for b in bit_positions(gram, mask):
+                bloom[b >> 3] |= 1 << (b & 7)
+        return bloom
+
+    def find(self, needle, start=0, stop=None, ignore_case=False):
+        """
+        ``(line, column)`` of every occurrence of needle in the lines
+        from start to stop, lines numbered like :attr:`total` counts them.
+        Blocks whose filter lacks a trigram of needle are skipped, those
+        without a filter yet are looked through; the lock is only held
+        for one block at a time.
+        """
+        if not self.searched:
+            self.searched = True
+            FilterBuilder.instance().add(self)
+        grams = trigrams(needle)
+        if ignore_case:
+            needle = needle.lower()
+        out = []
+        line = start
+        while needle:
+            blob = None
+            with self.lock:
+                line = max(line, self.dropped)
+                end = self.total if stop is None else min(stop, self.total)
+                if line >= end:
+                    break
+                n = (line - self.dropped) // self.block_lines
+                first = self.dropped + n * self.block_lines
+                if n == len(self.blocks):
+                    texts = self.texts[:end - first]
+                elif self.filters[n] is None:
+                    blob = self.blocks[n]
+                elif not self.may_have(self.filters[n], grams):
+                    line = first + self.block_lines
+                    continue
+                else:
+                    texts = self.block(n)[0][:end - first]
+
+            if blob is not None:
+                texts = self.unpack(blob)[0][:end - first]
+
+            for i in range(line - first, len(texts)):
+                text = texts[i]
+                if not isinstance(text, type(u"")):
+                    text = u"".join(text)
+                if ignore_case:
+                    text = text.lower()
+                column = text.find(needle)
+                while column >= 0:
+                    out.append((first + i, column))
+                    column = text.find(needle, column + 1)
+            line = first + len(texts)
+        return out
+
+    def encode(self, line):
+        """
+        Turn a screen line into ``(text, runs)``, runs being a flat tuple
+        of ``attribute index, length`` pairs. Trailing blanks are dropped.
+        """
+        if hasattr(line, 'runs'):
+            return self.encode_row(line)
+        end = len(line)
+        default = self.default_char
+        while end and line[end - 1] == default:
+            end -= 1
+        cells = line[:end]
+
+        data = [c.data for c in cells]
+        if all(len(d) == 1 for d in data):
+            text = u"".join(data)
+        else:
+            text = tuple(data)
+
+        runs = []
+        attr_index = self.attr_index
+        last, count = None, 0
+        for cell in cells:
+            key = cell[1:]
+            idx = attr_index.get(key)
+            if idx is None:
+                idx = attr_index[key] = len(self.attrs)
+                self.attrs.append(key)
+            if idx == last:
+                count += 1
+            else:
+                if count:
+                    runs.extend((last, count))
+                last, count = idx, 1
+        if count:
+            runs.extend((last, count))
+        return text, tuple(runs)
+
+    def encode_row(self, row):
+        # Compact rows (see cells.Row) have their text and runs at hand
+        end = row.rstrip(self.default_char)
+        runs = []
+        attr_index = self.attr_index
+        for key, count in row.runs(end):
+            idx = attr_index.get(key)
+            if idx is None:
+                idx = attr_index[key] = len(self.attrs)
+                self.attrs.append(key)
+            runs.extend((idx, count))
+        return row.text(end), tuple(runs)
+
+    def decode(self, text, runs, attrs):
+        line = []
+        make = Char._make
+        pos = 0
+        for i in range(0, len(runs), 2):
+            rest, count = attrs[runs[i]], runs[i + 1]
+            line.extend(make((d,) + rest) for d in text[pos:pos + count])
+            pos += count
+        return line
+
+    def block(self, n):
+        # Texts, runs and attributes of a sealed block
+        block = self.decoded.get(n)
+        if block is None:
+            block = self.unpack(self.blocks[n])
+            self.decoded.put(n, block)
+        return block
+
+    def unpack(self, blob):
+        if self.compress:
+            blob = zlib.decompress(blob)
+        return marshal.loads(blob)
+
+    def locate(self, index):
+        # Block holding the line and its position in there, the open block
+        # is numbered len(self.blocks)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("history index out of range")
+        return divmod(index, self.block_lines)
+
+    def text(self, index):
+        """
+        Text of a line without decoding its attributes
+        """
+        with self.lock:
+            n, i = self.locate(index)
+            texts = self.texts if n == len(self.blocks) else self.block(n)[0]
+            return u"".join(texts[i])
+
+    def __getitem__(self, index):
+        with self.lock:
+            return self.line(index)
+
+    def line(self, index):
+        n, i = self.locate(index)
+        if n == len(self.blocks):
+            texts, runs, attrs = self.texts, self.runs, self.attrs
+        else:
+            texts, runs, attrs = self.block(n)
+        return self.decode(texts[i], runs[i], attrs)
+
+    def since(self, total, limit=None):
+        """
+        Lines appended after :attr:`total` was total, as far as they are
+        still held (the last limit of them at most), and the new total
+        """
+        with self.lock:
+            start = max(total, self.dropped)
+            if limit is not None:
+                start = max(start, self.total - limit)
+            return ([self.line(i - self.dropped)
+                     for i in range(start, self.total)], self.total)
+
+    def build_filters(self, idle=0):
+        """
+        Make the filters of the blocks which have none, a block at a time
+        with the lock held only to pick it up and to file its filter.
+        Stops while blocks were sealed less than idle seconds ago, output
+        is coming in: returns how long to wait then, None when done.
+        """
+        n = 0
+        while True:
+            wait = self.sealed + idle - time.time()
+            if wait > 0:
+                return wait
+            with self.lock:
+                filters = self.filters
+                while n < len(filters) and filters[n] is not None:
+                    n += 1
+                if n == len(filters):
+                    return None
+                blob = self.blocks[n]
+                first = self.dropped + n * self.block_lines
+            bloom = self.bloom(self.unpack(blob)[0])
+            with self.lock:
+                n = (first - self.dropped) // self.block_lines
+                if 0 <= n < len(self.blocks) and self.blocks[n] is blob:
+                    self.filters[n] = bloom
+                    self.size += len(bloom)
+                    self.trim()
+                # Where the next block is, now that old ones may be gone
+                n = max((first - self.dropped) // self.block_lines + 1, 0)
+
+    @staticmethod
+    def may_have(bloom, grams):
+        mask = len(bloom) * 8 - 1
+        return all(bloom[b >> 3] & (1 << (b & 7))
+                   for gram in grams for b in bit_positions(gram, mask))
+
+    def lines(self, start, stop):
+        return [self[i] for i in range(max(start, 0), min(stop, len(self)))]
+
+
+class FilterBuilder(object):
+    """
+    Thread making the block filters of the histories handed to
+    :meth:`add`, away from the parser and the GUI, once their output
+    paused for idle seconds
+    """
+
+    idle = 0.5
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = deque()
+        self.thread = threading.Thread(target=self.run, name="filters")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, history):
+        with self.cond:
+            if history not in self.pending:
+                self.pending.append(history)
+                self.cond.notify()
+
+    def run(self):
+        wait = None
+        while True:
+            with self.cond:
+                if wait is not None:
+                    self.cond.wait(wait)
+                while not self.pending:
+                    self.cond.wait()
+                history = self.pending.popleft()
+            wait = history.build_filters(self.idle)
+            if wait is not None:
+                # Busy, after the others
+                with self.cond:
+                    self.pending.append(history)
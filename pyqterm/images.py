@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Inline images are stored once, keyed by a hash of their content; the
+# screen cells only carry the short handle.
+# License: GPL2
+import base64
+import binascii
+import hashlib
+
+from .cache import LRUCache
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+class ImageStore(object):
+    """
+    Content addressed store for the images of ``img:`` annotations.
+
+    Images are kept as encoded bytes, the least recently used ones are
+    evicted once the store holds more than ``budget`` bytes.
+    """
+
+    prefix = 'img:'
+
+    def __init__(self, budget=16 << 20):
+        self.cache = LRUCache(budget)
+
+    def add(self, data):
+        """
+        Store encoded image data, returns its handle
+        """
+        handle = self.prefix + hashlib.sha1(data).hexdigest()[:20]
+        if handle not in self.cache:
+            self.cache.put(handle, data, len(data))
+        return handle
+
+    def add_annotation(self, text):
+        """
+        Store the base64 payload of an ``img:`` annotation, returns the
+        handle or None if the payload can't be decoded
+        """
+        try:
+            _head, payload = text.split('\n', 1)
+            data = base64.b64decode(payload)
+        except (ValueError, TypeError, binascii.Error):
+            return None
+        return self.add(data)
+
+    def get(self, handle):
+        return self.cache.get(handle)
+
+
+#: Store shared by all screens
+images = ImageStore()
+
+
+def is_image(fg):
+    """
+    Whether the fg of a cell is an image handle rather than a color
+    """
+    return isinstance(fg, string_types) and fg.startswith(ImageStore.prefix)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Counters and histograms for finding out where a slow terminal spends its
+# time. Whoever collects holds a Metrics in its ``metrics`` attribute, which
+# is None while collection is off, so instrumented code only pays for an
+# attribute check then.
+# License: GPL2
+import math
+import threading
+
+
+class Histogram(object):
+    """
+    Distribution of positive values in power of two buckets, so adding a
+    value costs the same however many were added before
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        # Bucket e holds values from 2 ** (e - 1) up to 2 ** e
+        e = math.frexp(value)[1] if value > 0 else None
+        self.buckets[e] = self.buckets.get(e, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Upper bound of the value p percent of the values are below
+        """
+        if not self.count:
+            return 0
+        wanted = self.count * p / 100.0
+        seen = 0
+        for e in sorted(self.buckets, key=lambda e: -1e9 if e is None else e):
+            seen += self.buckets[e]
+            if seen >= wanted:
+                return 0 if e is None else min(math.ldexp(1, e), self.max)
+        return self.max
+
+    def snapshot(self):
+        count = self.count
+        return dict(count=count, total=self.total, max=self.max,
+                    mean=self.total / float(count) if count else 0,
+                    p50=self.percentile(50), p90=self.percentile(90),
+                    p99=self.percentile(99))
+
+
+class Metrics(object):
+    """
+    Named counters and histograms, safe to update from any thread
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(value)
+
+    def snapshot(self):
+        """
+        Counters as numbers and histograms as dicts of count, total, mean,
+        max and the 50th, 90th and 99th percentiles, by name
+        """
+        with self.lock:
+            out = dict(self.counters)
+            for name, histogram in self.histograms.items():
+                out[name] = histogram.snapshot()
+        return out
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Cell colors are small integers, resolved once while parsing: 0 to 255
+# are the xterm 256 color palette, DEFAULT is the default foreground or
+# background, and truecolor is TRUECOLOR | 0xrrggbb. Painting looks the
+# palette colors up by index; whatever else an annotation puts into a
+# cell (image handles, color names) stays a string.
+# License: GPL2
+from pyte.screens import Char
+
+DEFAULT = 256
+TRUECOLOR = 1 << 24
+
+#: Colors pyte and annotations name
+NAMES = dict(black=0, red=1, green=2, brown=3, blue=4, magenta=5, cyan=6,
+             white=7, default=DEFAULT)
+
+#: SGR parameters setting the foreground and the background: the eight
+#: colors, their bright variants and the default
+SGR_FG = dict([(30 + i, i) for i in range(8)] +
+              [(90 + i, 8 + i) for i in range(8)] + [(39, DEFAULT)])
+SGR_BG = dict([(40 + i, i) for i in range(8)] +
+              [(100 + i, 8 + i) for i in range(8)] + [(49, DEFAULT)])
+
+#: A blank cell in the default colors, screens are filled with these
+default_char = Char(" ", fg=DEFAULT, bg=DEFAULT)
+
+# The sixteen colors as xterm has them
+_BASE = (0x000000, 0xcd0000, 0x00cd00, 0xcdcd00, 0x0000ee, 0xcd00cd,
+         0x00cdcd, 0xe5e5e5, 0x7f7f7f, 0xff0000, 0x00ff00, 0xffff00,
+         0x5c5cff, 0xff00ff, 0x00ffff, 0xffffff)
+_LEVELS = (0, 95, 135, 175, 215, 255)
+
+
+def rgb(r, g, b):
+    return TRUECOLOR | (r & 255) << 16 | (g & 255) << 8 | (b & 255)
+
+
+def split(color):
+    """
+    ``(r, g, b)`` of a palette index below DEFAULT or a truecolor
+    """
+    if color & TRUECOLOR:
+        value = color & 0xffffff
+    elif color < 16:
+        value = _BASE[color]
+    elif color < 232:
+        n = color - 16
+        return _LEVELS[n // 36], _LEVELS[n // 6 % 6], _LEVELS[n % 6]
+    else:
+        level = 8 + (color - 232) * 10
+        return level, level, level
+    return value >> 16, value >> 8 & 255, value & 255
+
+
+def key(color):
+    """
+    Key of a color as pyte and annotations give them: a name, ``#rgb``
+    or ``#rrggbb``; anything else is returned as it is
+    """
+    if isinstance(color, int):
+        return color
+    if color in NAMES:
+        return NAMES[color]
+    if color[:1] == "#" and len(color) in (4, 7):
+        try:
+            value = int(color[1:], 16)
+        except ValueError:
+            return color
+        if len(color) == 4:
+            return rgb((value >> 8) * 17, (value >> 4 & 15) * 17,
+                       (value & 15) * 17)
+        return TRUECOLOR | value
+    return color
+
+
+def extended(params):
+    """
+    Color of the rest of an SGR 38 or 48: ``5;n`` for a palette index,
+    ``2;r;g;b`` for truecolor; params is an iterator, only the color's
+    parameters are taken from it. None if they are incomplete.
+    """
+    mode = next(params, None)
+    if mode == 5:
+        n = next(params, None)
+        if n is not None and 0 <= n < DEFAULT:
+            return n
+    elif mode == 2:
+        r, g, b = next(params, None), next(params, None), next(params, None)
+        if b is not None:
+            return rgb(r, g, b)
+    return None
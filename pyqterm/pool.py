@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Sessions started ahead of time, so opening a terminal waits neither for
+# fork nor for the shell to come up.
+# License: GPL2
+import threading
+import time
+import traceback
+from collections import deque
+
+from .backend import Session
+
+
+class SessionPool(object):
+    """
+    Keeps ``count`` sessions running ``cmd`` started at ``size``. A thread
+    of its own starts a replacement whenever one is handed out.
+
+    Assign a pool to ``TerminalWidget.pool`` to have widgets take their
+    sessions from it.
+    """
+
+    # Seconds to wait before trying again when a session failed to start
+    retry_delay = 1.0
+
+    def __init__(self, count=2, cmd="/bin/bash", env_term="linux",
+                 size=(80, 24)):
+        self.count = count
+        self.cmd = cmd
+        self.env_term = env_term
+        self.size = size
+        self.sessions = deque()
+        self.cond = threading.Condition(threading.Lock())
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="pyqterm-pool")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self, cmd=None, size=None):
+        """
+        A started session running cmd (the pool's command by default),
+        resized to ``(columns, lines)`` if size is given. One is started
+        on the spot when the pool is empty or runs something else.
+        """
+        session = None
+        if cmd is None or cmd == self.cmd:
+            with self.cond:
+                while self.sessions:
+                    session = self.sessions.popleft()
+                    if session.fd is not None:
+                        break
+                    # The shell exited while waiting
+                    session = None
+                self.cond.notify()
+
+        if session is None:
+            session = Session(cmd=cmd or self.cmd, env_term=self.env_term,
+                              size=size or self.size)
+            session.start()
+        elif size is not None and tuple(size) != tuple(self.size):
+            session.resize(*size)
+        return session
+
+    def close(self):
+        """
+        Stop the refill thread and every session still waiting
+        """
+        with self.cond:
+            self.running = False
+            sessions = list(self.sessions)
+            self.sessions.clear()
+            self.cond.notify()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        for session in sessions:
+            session.stop()
+
+    def run(self):
+        """
+        Refill thread
+        """
+        while True:
+            with self.cond:
+                while self.running and len(self.sessions) >= self.count:
+                    self.cond.wait()
+                if not self.running:
+                    break
+
+            session = Session(cmd=self.cmd, env_term=self.env_term,
+                              size=self.size)
+            try:
+                session.start()
+            except (IOError, OSError):
+                traceback.print_exc()
+                time.sleep(self.retry_delay)
+                continue
+
+            with self.cond:
+                if self.running:
+                    self.sessions.append(session)
+                    session = None
+            if session is not None:
+                session.stop()
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+# Wire format between the session server and its frontends. Every message
+# is a header (kind, payload length) followed by the payload. Requests and
+# other rare messages are marshalled tuples; screen updates are binary:
+# only the rows which changed, each one as its text plus runs of indices
+# into a table of cell attributes, which is sent once per connection.
+# License: GPL2
+import errno
+import marshal
+import os
+import socket
+import stat
+import struct
+import sys
+import tempfile
+
+from pyte.screens import Char
+
+from .backend import Frame
+from .images import is_image
+from .palette import default_char
+
+
+HEADER = struct.Struct("<BI")
+
+# Frontend to server
+CREATE = 1          # (cmd, columns, lines)
+ATTACH = 2          # (sid,)
+DETACH = 3          # (sid,)
+WRITE = 4           # sid, then the bytes
+RESIZE = 5          # (sid, columns, lines)
+STOP = 6            # (sid,)
+LIST = 7            # ()
+
+# Server to frontend
+ATTACHED = 64       # (sid, pid, cmd), sid is 0 when there is no such session
+SESSIONS = 65       # ((sid, pid, cmd, exited), ...)
+ATTRS = 66          # ((index, attributes), ...), index 0 starts the
+                    # table over
+IMAGE = 67          # handle length, handle, image data
+HISTORY = 68        # sid, count, rows
+FRAME = 69          # FRAME_HEADER, rows
+CLOSED = 70         # (sid,)
+
+SID = struct.Struct("<I")
+HISTORY_HEADER = struct.Struct("<II")
+#: sid, version, lines, columns, cursor x, y and hidden, number of rows
+FRAME_HEADER = struct.Struct("<IIHHHHBH")
+#: line, flags, text length in bytes, number of runs
+ROW = struct.Struct("<HBII")
+
+# Some cell holds more than one character, cells are separated by NUL
+SPLIT = 1
+
+
+# Not in the socket module of Python 2
+SO_PEERCRED = getattr(socket, "SO_PEERCRED",
+                      17 if sys.platform.startswith("linux") else None)
+PEERCRED = struct.Struct("3i")
+
+
+def default_path():
+    """
+    The socket in a directory only the user can get into: pyqterm in
+    $XDG_RUNTIME_DIR, or pyqterm-<uid> in the temporary directory
+    """
+    base = os.environ.get("XDG_RUNTIME_DIR")
+    if base and os.path.isdir(base):
+        path = os.path.join(base, "pyqterm")
+    else:
+        path = os.path.join(tempfile.gettempdir(), "pyqterm-%d" % os.getuid())
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # Made by someone else before us, or a link to somewhere else
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+            st.st_mode & 0o077:
+        raise IOError(errno.EPERM, "%s is not a private directory" % path)
+    return os.path.join(path, "server.sock")
+
+
+def peer_uid(sock):
+    """
+    The user at the other end of a Unix socket, None where the system
+    doesn't tell
+    """
+    if SO_PEERCRED is None:
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, PEERCRED.size)
+    return PEERCRED.unpack(creds)[1]
+
+
+def check_peer(sock):
+    uid = peer_uid(sock)
+    if uid is not None and uid != os.getuid():
+        raise IOError(errno.EPERM, "peer is user %d" % uid)
+
+
+def listen(path):
+    """
+    A listening socket at path, made where no server listens already;
+    only the user can connect to it
+    """
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise IOError(errno.EEXIST, "%s is not a socket" % path)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error as e:
+            if e.args[0] not in (errno.ECONNREFUSED, errno.ENOENT):
+                raise
+            # Left behind by a server which is gone
+            os.unlink(path)
+        else:
+            raise IOError(errno.EADDRINUSE,
+                          "a server is listening at %s" % path)
+        finally:
+            probe.close()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Private from the start, not once it is bound
+    umask = os.umask(0o177)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    sock.listen(16)
+    return sock
+
+
+def message(kind, payload):
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+def request(kind, *args):
+    return message(kind, marshal.dumps(args))
+
+
+def split(buf):
+    """
+    Complete messages at the start of buf as ``(kind, payload)`` pairs,
+    and how many bytes they took
+    """
+    out, pos, size = [], 0, len(buf)
+    while pos + HEADER.size <= size:
+        kind, length = HEADER.unpack_from(buf, pos)
+        end = pos + HEADER.size + length
+        if end > size:
+            break
+        out.append((kind, bytes(buf[pos + HEADER.size:end])))
+        pos = end
+    return out, pos
+
+
+class Encoder(object):
+    """
+    Server side of a connection: turns rows into ROW records, interning
+    attributes and collecting the ones (and the images) the frontend
+    hasn't seen yet
+    """
+
+    # Attributes interned before the table is started over, with the
+    # next rows
+    limit = 1 << 16
+
+    def __init__(self):
+        self.attrs = {}
+        self.new_attrs = []
+        self.new_images = []
+
+    def row(self, y, cells):
+        if hasattr(cells, 'runs'):
+            # Compact rows (see cells.Row) have their text and runs at hand
+            text, flags = cells.text(), 0
+            if not isinstance(text, type(u"")):
+                text, flags = u"\x00".join(text), SPLIT
+            runs = []
+            for key, count in cells.runs():
+                runs.extend((self.intern(key), count))
+        else:
+            text, flags, runs = self.split(cells)
+
+        text = text.encode("utf-8")
+        return b"".join((ROW.pack(y, flags, len(text), len(runs) // 2), text,
+                         struct.pack("<%dI" % len(runs), *runs)))
+
+    def split(self, cells):
+        data = [c.data for c in cells]
+        text = u"".join(data)
+        flags = 0
+        if len(text) != len(data):
+            text, flags = u"\x00".join(data), SPLIT
+
+        runs = []
+        last, count = None, 0
+        for cell in cells:
+            idx = self.intern(cell[1:])
+            if idx == last:
+                count += 1
+            else:
+                if count:
+                    runs.extend((last, count))
+                last, count = idx, 1
+        if count:
+            runs.extend((last, count))
+        return text, flags, runs
+
+    def intern(self, key):
+        attrs = self.attrs
+        idx = attrs.get(key)
+        if idx is None:
+            idx = attrs[key] = len(attrs)
+            self.new_attrs.append((idx, tuple(key)))
+            if is_image(key[0]):
+                self.new_images.append(key[0])
+        return idx
+
+    def frame(self, sid, frame, changed):
+        x, y, hidden = frame.cursor
+        rows = frame.rows
+        columns = len(rows[0]) if rows else 0
+        return message(FRAME, b"".join(
+            [FRAME_HEADER.pack(sid, frame.version, len(rows), columns,
+                               x, y, hidden, len(changed))] +
+            [self.row(line, rows[line]) for line in changed]))
+
+    def history(self, sid, lines):
+        return message(HISTORY, b"".join(
+            [HISTORY_HEADER.pack(sid, len(lines))] +
+            [self.row(0, line) for line in lines]))
+
+    def flush(self, images):
+        """
+        ATTRS and IMAGE messages for what the rows encoded since the last
+        flush introduced, they have to be sent before those rows
+        """
+        out = []
+        if self.new_attrs:
+            out.append(message(ATTRS, marshal.dumps(tuple(self.new_attrs))))
+            self.new_attrs = []
+        for handle in self.new_images:
+            data = images.get(handle)
+            if data is not None:
+                handle = handle.encode("ascii")
+                out.append(message(IMAGE, struct.pack("<B", len(handle)) +
+                                   handle + data))
+        self.new_images = []
+        if len(self.attrs) >= self.limit:
+            # Rows encoded from now on come after what was flushed, the
+            # other side starts over when index 0 turns up again
+            self.attrs = {}
+        return out
+
+
+class Decoder(object):
+    """
+    Frontend side of a connection
+    """
+
+    # Decoded cells are shared, up to this many different ones
+    cache_size = 1 << 16
+
+    def __init__(self):
+        self.attrs = {}
+        self.cells = {}
+
+    def add_attrs(self, payload):
+        for idx, key in marshal.loads(payload):
+            if idx == 0:
+                # The encoder started over
+                self.attrs = {}
+                self.cells.clear()
+            self.attrs[idx] = tuple(key)
+
+    def rows(self, payload, pos, count):
+        """
+        ``(line, cells)`` of count rows starting at pos
+        """
+        attrs, make = self.attrs, Char._make
+        cache = self.cells
+        if len(cache) > self.cache_size:
+            cache.clear()
+        get = cache.get
+        out = []
+        for _ in range(count):
+            y, flags, length, nruns = ROW.unpack_from(payload, pos)
+            pos += ROW.size
+            text = payload[pos:pos + length].decode("utf-8")
+            pos += length
+            runs = struct.unpack_from("<%dI" % (nruns * 2), payload, pos)
+            pos += nruns * 8
+            data = text.split(u"\x00") if flags & SPLIT else text
+
+            cells, start = [], 0
+            for i in range(0, len(runs), 2):
+                idx, n = runs[i], runs[i + 1]
+                key = attrs[idx]
+                for d in data[start:start + n]:
+                    cell = get((d, idx))
+                    if cell is None:
+                        cell = cache[d, idx] = make((d,) + key)
+                    cells.append(cell)
+                start += n
+            out.append((y, cells))
+        return out
+
+    def frame(self, payload):
+        """
+        ``(sid, version, lines, columns, cursor, rows)``
+        """
+        sid, version, lines, columns, x, y, hidden, count = \
+            FRAME_HEADER.unpack_from(payload)
+        rows = self.rows(payload, FRAME_HEADER.size, count)
+        return sid, version, lines, columns, (x, y, bool(hidden)), rows
+
+    def history(self, payload):
+        sid, count = HISTORY_HEADER.unpack_from(payload)
+        return sid, [cells for y, cells in
+                     self.rows(payload, HISTORY_HEADER.size, count)]
+
+
+def patch(frame, version, lines, columns, cursor, rows):
+    """
+    The frame a FRAME message turns frame into; rows which weren't sent
+    stay the very same objects
+    """
+    old = frame.rows
+    if len(old) != lines or (old and len(old[0]) != columns):
+        new = [(default_char,) * columns] * lines
+    else:
+        new = list(old)
+    for y, cells in rows:
+        new[y] = tuple(cells)
+    return Frame(version, tuple(new), cursor,
+                 frozenset(y for y, cells in rows))
+
+
+def image(payload):
+    """
+    Handle and data of an IMAGE message
+    """
+    n = struct.unpack_from("<B", payload)[0]
+    return payload[1:1 + n].decode("ascii"), payload[1 + n:]
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+# One I/O thread for all sessions. Instead of a supervisor thread per
+# Session which polls its own pty, the reactor keeps every pty descriptor
+# in a single epoll set (select() where epoll is not available) and calls
+# back into the owning Session when there is something to do.
+# The parser runs in a thread of its own, so a session being parsed never
+# holds up reading (or writing to) any pty.
+# License: GPL2
+import os
+import errno
+import fcntl
+import select
+import threading
+import traceback
+from collections import deque
+
+from .ring import ByteRing
+
+
+# Same values as EPOLLIN/EPOLLOUT/EPOLLERR/EPOLLHUP (and POLL*)
+READ = 0x001
+WRITE = 0x004
+ERROR = 0x008 | 0x010
+
+
+class EpollPoller(object):
+    threadsafe = True
+
+    def __init__(self):
+        self.epoll = select.epoll()
+
+    def register(self, fd, events):
+        self.epoll.register(fd, events)
+
+    def modify(self, fd, events):
+        self.epoll.modify(fd, events)
+
+    def unregister(self, fd):
+        self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        return self.epoll.poll(timeout)
+
+
+class SelectPoller(object):
+    # The sets are rebuilt on every poll(), so the reactor has to be woken
+    # up when they change from another thread.
+    threadsafe = False
+
+    def __init__(self):
+        self.fds = {}
+
+    def register(self, fd, events):
+        self.fds[fd] = events
+
+    def modify(self, fd, events):
+        self.fds[fd] = events
+
+    def unregister(self, fd):
+        del self.fds[fd]
+
+    def poll(self, timeout):
+        fds = list(self.fds.items())
+        r = [fd for fd, ev in fds if ev & READ]
+        w = [fd for fd, ev in fds if ev & WRITE]
+        try:
+            r, w, x = select.select(r, w, [], timeout)
+        except select.error as e:
+            # A descriptor was closed under us, let the owner find out
+            if e.args[0] != errno.EBADF:
+                raise
+            return [(fd, ERROR) for fd, ev in fds]
+        events = {}
+        for fd in r:
+            events[fd] = READ
+        for fd in w:
+            events[fd] = events.get(fd, 0) | WRITE
+        return list(events.items())
+
+
+class Reactor(object):
+    """
+    Multiplexes the descriptors of any number of sessions in one thread.
+
+    A handler is registered with :meth:`add` and gets ``proc_read()``
+    called whenever its descriptor is readable or hung up, and
+    ``proc_write()`` whenever it is writable while WRITE is asked for.
+    Registration changes are picked up immediately, a self-pipe wakes
+    the loop when the poller can't be changed from the outside.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        # Shared reactor used by sessions which weren't given one
+        with cls._instance_lock:
+            if cls._instance is None or not cls._instance.running:
+                cls._instance = cls()
+                cls._instance.start()
+            return cls._instance
+
+    def __init__(self):
+        self.handlers = {}
+        self.events = {}
+        self.zombies = set()
+        self.lock = threading.Lock()
+        self.running = False
+
+        if hasattr(select, "epoll"):
+            self.poller = EpollPoller()
+        else:
+            self.poller = SelectPoller()
+
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.poller.register(self._wakeup_r, READ)
+
+        self.thread = threading.Thread(target=self.run, name="pyqterm-reactor")
+        self.thread.daemon = True
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def wakeup(self):
+        try:
+            os.write(self._wakeup_w, b"x")
+        except (IOError, OSError):
+            # Pipe is full, the loop is going to wake up anyway
+            pass
+
+    def add(self, fd, handler, events=READ):
+        with self.lock:
+            self.handlers[fd] = handler
+            self.events[fd] = events
+            self.poller.register(fd, events)
+        self.wakeup()
+
+    def remove(self, fd):
+        with self.lock:
+            if self.handlers.pop(fd, None) is None:
+                return
+            if not self.events.pop(fd):
+                return
+            try:
+                self.poller.unregister(fd)
+            except (IOError, OSError, ValueError):
+                pass
+        self.wakeup()
+
+    def modify(self, fd, events):
+        with self.lock:
+            if fd not in self.handlers or self.events[fd] == events:
+                return
+            old, self.events[fd] = self.events[fd], events
+            # epoll reports a hangup whatever the mask is, so a descriptor
+            # nobody wants to hear from leaves the poller for a while
+            if not events:
+                self.poller.unregister(fd)
+            elif not old:
+                self.poller.register(fd, events)
+            else:
+                self.poller.modify(fd, events)
+        if not self.poller.threadsafe:
+            self.wakeup()
+
+    def reap(self, pid):
+        """
+        Collect the exit status of a child which didn't die right away
+        """
+        with self.lock:
+            self.zombies.add(pid)
+        self.wakeup()
+
+    def _reap(self):
+        with self.lock:
+            zombies = list(self.zombies)
+        for pid in zombies:
+            try:
+                done, sts = os.waitpid(pid, os.WNOHANG)
+            except (IOError, OSError):
+                done = pid
+            if done:
+                with self.lock:
+                    self.zombies.discard(pid)
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except (IOError, OSError):
+            pass
+
+    def run(self):
+        """
+        Reactor thread
+        """
+        while self.running:
+            timeout = 1.0 if self.zombies else None
+            try:
+                events = self.poller.poll(timeout)
+            except (IOError, OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, ev in events:
+                if fd == self._wakeup_r:
+                    self._drain_wakeup()
+                    continue
+
+                handler = self.handlers.get(fd)
+                if handler is None:
+                    continue
+
+                try:
+                    if ev & (READ | ERROR):
+                        handler.proc_read()
+                    if ev & WRITE and self.events.get(fd, 0) & WRITE:
+                        handler.proc_write()
+                except Exception:
+                    traceback.print_exc()
+                    self.remove(fd)
+
+            if self.zombies:
+                self._reap()
+
+        for fd in (self._wakeup_r, self._wakeup_w):
+            os.close(fd)
+
+
+class Parser(object):
+    """
+    Parser stage shared by sessions: calls ``proc_parse()`` on every
+    scheduled session, round robin, until it reports there is nothing
+    left to parse.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None or not cls._instance.running:
+                cls._instance = cls()
+                cls._instance.start()
+            return cls._instance
+
+    def __init__(self):
+        self.queue = deque()
+        self.scheduled = set()
+        self.cond = threading.Condition(threading.Lock())
+        self.running = False
+        self.thread = threading.Thread(target=self.run, name="pyqterm-parser")
+        self.thread.daemon = True
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def attach(self, session):
+        """
+        The ring the reader stage of session writes its output to
+        """
+        return ByteRing(session.ring_size)
+
+    def resize(self, session, w, h):
+        session.proc_resize(w, h)
+
+    def schedule(self, session):
+        with self.cond:
+            if session in self.scheduled:
+                return
+            self.scheduled.add(session)
+            self.queue.append(session)
+            self.cond.notify()
+
+    def run(self):
+        """
+        Parser thread
+        """
+        while True:
+            with self.cond:
+                while self.running and not self.queue:
+                    self.cond.wait()
+                if not self.running:
+                    break
+                session = self.queue.popleft()
+                self.scheduled.discard(session)
+
+            try:
+                more = session.proc_parse()
+            except Exception:
+                traceback.print_exc()
+                more = False
+
+            if more:
+                self.schedule(session)
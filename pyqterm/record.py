@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+# Recording of raw pty output and replay of it.
+# The log is a flat, append-only file of records, each a fixed header
+# (kind, timestamp, payload length) followed by the payload: chunks of
+# output exactly as they were read and, every now and then, a checkpoint
+# of the screen and parser state (Session.getstate(), marshalled). A
+# separate index of fixed size entries points at the checkpoints, so a
+# replay starts from the last checkpoint before the wanted time instead
+# of from the very beginning.
+# License: GPL2
+import marshal
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from collections import deque
+
+
+DATA = 0
+CHECKPOINT = 1
+
+#: kind, time, payload length
+HEADER = struct.Struct("<BdI")
+
+#: checkpoint time and log offset, the stream position it was taken at,
+#: log offset and stream position of the first data record not (fully)
+#: parsed at that point
+ENTRY = struct.Struct("<dQQQQ")
+
+
+class Recorder(object):
+    """
+    Writes the output a session reads to ``path``, the checkpoint index to
+    ``path + ".idx"``. Existing files are overwritten.
+
+    Stream positions count bytes of output; :meth:`data` is called with
+    the position of a chunk as it is read, :meth:`checkpoint` with the
+    position up to which the state was parsed. A checkpoint is due every
+    ``interval`` seconds or ``interval_bytes`` bytes of output.
+    """
+
+    interval = 10.0
+    interval_bytes = 1 << 20
+
+    def __init__(self, path):
+        self.path = path
+        self.log = open(path, "wb")
+        self.index = open(path + ".idx", "wb")
+        self.lock = threading.Lock()
+        self.offset = 0
+        # (offset, position, length, time) of data records the parser
+        # hasn't got through yet
+        self.pending = deque()
+        self.last_time = None
+        self.last_position = None
+        self.parsed_time = time.time()
+        self.error = None
+
+    def data(self, chunk, position):
+        with self.lock:
+            if self.log is None:
+                return
+            t = time.time()
+            if self.write(DATA, t, chunk):
+                self.pending.append(
+                    (self.offset - len(chunk) - HEADER.size, position,
+                     len(chunk), t))
+
+    def due(self, position):
+        if self.last_position is None:
+            return True
+        return position > self.last_position and (
+            position - self.last_position >= self.interval_bytes or
+            time.time() - self.last_time >= self.interval)
+
+    def checkpoint(self, position, state):
+        """
+        Record state, which is what parsing up to position led to
+        """
+        with self.lock:
+            if self.log is None:
+                return
+            pending = self.pending
+            while pending and pending[0][1] + pending[0][2] <= position:
+                self.parsed_time = pending.popleft()[3]
+            if pending and pending[0][1] < position:
+                self.parsed_time = pending[0][3]
+
+            # Stamped with the arrival of the last byte parsed, so every
+            # byte after the checkpoint arrived no earlier than that
+            t = self.parsed_time
+            offset = self.offset
+            payload = zlib.compress(marshal.dumps(state), 1)
+            if not self.write(CHECKPOINT, t, payload):
+                return
+            if pending:
+                data_offset, data_position = pending[0][:2]
+            else:
+                data_offset, data_position = self.offset, position
+            try:
+                self.index.write(ENTRY.pack(t, offset, position,
+                                            data_offset, data_position))
+                self.index.flush()
+            except (IOError, OSError) as e:
+                self.fail(e)
+                return
+            self.last_time, self.last_position = time.time(), position
+
+    def write(self, kind, t, payload):
+        try:
+            self.log.write(HEADER.pack(kind, t, len(payload)))
+            self.log.write(payload)
+            # Replays may map the file while it is being recorded
+            self.log.flush()
+        except (IOError, OSError) as e:
+            self.fail(e)
+            return False
+        self.offset += HEADER.size + len(payload)
+        return True
+
+    def fail(self, e):
+        # A full disk stops the recording, not the session
+        self.error = e
+        self.close(locked=True)
+
+    def close(self, locked=False):
+        if not locked:
+            self.lock.acquire()
+        try:
+            for f in (self.log, self.index):
+                if f is not None:
+                    try:
+                        f.close()
+                    except (IOError, OSError):
+                        pass
+            self.log = self.index = None
+        finally:
+            if not locked:
+                self.lock.release()
+
+
+class Replay(object):
+    """
+    Reads a recording made by :class:`Recorder`. The log is memory mapped,
+    so only the parts replayed are ever read from disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        if size:
+            self.data = mmap.mmap(self.file.fileno(), size,
+                                  access=mmap.ACCESS_READ)
+        else:
+            self.data = b""
+
+        try:
+            with open(path + ".idx", "rb") as f:
+                index = f.read()
+        except (IOError, OSError):
+            index = b""
+        self.checkpoints = [
+            ENTRY.unpack_from(index, i)
+            for i in range(0, len(index) - ENTRY.size + 1, ENTRY.size)]
+        # Checkpoints written after the log was mapped are unusable
+        self.checkpoints = [e for e in self.checkpoints if e[1] < size]
+        self.times = [e[0] for e in self.checkpoints]
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def records(self, offset=0):
+        """
+        ``(kind, time, start, end)`` of every complete record from offset
+        on, start and end delimit the payload
+        """
+        data, size = self.data, len(self.data)
+        while offset + HEADER.size <= size:
+            kind, t, length = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            offset = start + length
+            if offset > size:
+                # Still being written
+                return
+            yield kind, t, start, offset
+
+    @property
+    def start(self):
+        for kind, t, start, end in self.records():
+            return t
+
+    @property
+    def end(self):
+        t = None
+        offset = self.checkpoints[-1][1] if self.checkpoints else 0
+        for kind, t, start, end in self.records(offset):
+            pass
+        return t
+
+    def chunks(self, start=None, stop=None, offset=0):
+        """
+        ``(time, bytes)`` of the output that arrived between start and
+        stop, for playing a recording back at its own pace
+        """
+        data = self.data
+        for kind, t, begin, end in self.records(offset):
+            if kind != DATA or (start is not None and t < start):
+                continue
+            if stop is not None and t > stop:
+                return
+            yield t, data[begin:end]
+
+    def seek(self, session, t):
+        """
+        Bring the screen of session (one which was never started) to
+        where it was at time t: the state is restored from the last
+        checkpoint before t and only the output after it is parsed
+        """
+        i = bisect_right(self.times, t) - 1
+        if i < 0:
+            return False
+
+        _, offset, position, data_offset, data_position = self.checkpoints[i]
+        _, _, start, end = next(self.records(offset))
+        state = marshal.loads(zlib.decompress(self.data[start:end]))
+
+        with session.lock:
+            session.setstate(state)
+            feed = session.stream.feed
+            skip = position - data_position
+            for _, chunk in self.chunks(stop=t, offset=data_offset):
+                if skip:
+                    chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+                if chunk:
+                    feed(chunk)
+            session.proc_publish()
+        return True
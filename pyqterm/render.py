@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# Rasterizes screen rows with a QPainter. The renderer doesn't know about
+# the widget, so rows can be painted on any paint device; ImageRenderer
+# caches images rather than pixmaps, so it works outside the GUI thread.
+# License: GPL2
+from itertools import groupby
+from operator import attrgetter, ne
+
+from PyQt4.QtCore import QRect, Qt
+from PyQt4.QtGui import (
+       QBrush, QColor, QFont, QFontMetrics, QImage, QPainter, QPen, QPixmap)
+
+from .cache import LRUCache
+from .images import images, is_image
+from . import palette
+
+
+class Renderer(object):
+
+    # Paint runs of cells with the same colors with one fill and one text
+    # call instead of one of each per cell. Rows whose spans are shorter
+    # than min_span cells on average are painted cell by cell, grouping
+    # them would only add to the cost.
+    spans = True
+    min_span = 2
+
+    # Decoded inline images, keyed by image store handle
+    pixmap_cache = LRUCache(32 << 20)
+
+    # Rendered rows are kept as pixmaps keyed by their cells, unchanged
+    # rows are blitted from there. The budget is in bytes of pixels.
+    cache_rows = True
+    row_cache_budget = 32 << 20
+
+    # Pens and brushes kept for colors outside of the palette
+    color_cache_size = 256
+
+    align = Qt.AlignTop | Qt.AlignLeft
+    colors = staticmethod(attrgetter('fg', 'bg'))
+
+    def __init__(self, font, foreground_color_map, background_color_map):
+        self.foreground_color_map = foreground_color_map
+        self.background_color_map = background_color_map
+        self.row_cache = LRUCache(self.row_cache_budget)
+        self.setFont(font)
+        self.setupPainters()
+
+    def setFont(self, font):
+        # Glyphs have to stay on the cell grid, so no kerning
+        self.font = QFont(font)
+        self.font.setKerning(False)
+        fm = QFontMetrics(self.font)
+        self.char_height = fm.height()
+        self.char_width = fm.width("W")
+        self.fits = _Fits(fm, self.char_width)
+        self.row_cache.clear()
+
+    def setupPainters(self):
+        # Pens and brushes of the palette are looked up by index, the
+        # few other colors (truecolor, names) are cached
+        self.row_cache.clear()
+        self.foreground = self.palette_colors(self.foreground_color_map)
+        self.background = self.palette_colors(self.background_color_map)
+        self._pens = [QPen(color) for color in self.foreground]
+        self._brashes = [QBrush(color) for color in self.background]
+        self._pen = LRUCache(self.color_cache_size)
+        self._brash = LRUCache(self.color_cache_size)
+
+    @staticmethod
+    def palette_colors(color_map):
+        """
+        QColors of the palette keys up to palette.DEFAULT; the first
+        eight colors and the default are taken from color_map
+        """
+        colors = [QColor(*palette.split(i)) for i in range(palette.DEFAULT)]
+        for i in range(8):
+            if i in color_map:
+                colors[i] = QColor(color_map[i])
+        colors.append(QColor(color_map['default']))
+        return colors
+
+    def color(self, color, colors):
+        color = palette.key(color)
+        if not isinstance(color, int):
+            return QColor(color)
+        if color < len(colors):
+            return colors[color]
+        return QColor(*palette.split(color))
+
+    def pen(self, color):
+        try:
+            return self._pens[color]
+        except (IndexError, TypeError):
+            pass
+        pen = self._pen.get(color)
+        if pen is None:
+            pen = self._pen.put(color, QPen(self.color(color, self.foreground)))
+        return pen
+
+    def brash(self, color):
+        try:
+            return self._brashes[color]
+        except (IndexError, TypeError):
+            pass
+        brash = self._brash.get(color)
+        if brash is None:
+            brash = self._brash.put(
+                color, QBrush(self.color(color, self.background)))
+        return brash
+
+    def paint(self, painter, rows):
+        """
+        Paint ``(line, cells)`` pairs, line being the row on the device
+        """
+        painter.setFont(self.font)
+        paint_row = self.paint_row if self.spans else self.paint_cells
+        char_height = self.char_height
+        for line, row in rows:
+            y = line * char_height
+            if self.cache_rows:
+                pixmap = self.row_pixmap(row, paint_row)
+                if pixmap is not None:
+                    self.blit(painter, 0, y, pixmap)
+                    continue
+            paint_row(painter, y, row)
+
+    def row_pixmap(self, row, paint_row):
+        # The cells themselves are the key, so a hit is always exact
+        key = row.key() if hasattr(row, 'key') else tuple(row)
+        pixmap = self.row_cache.get(key)
+        if pixmap is None:
+            # Images hang below their row, those rows are painted directly
+            if any(is_image(fg) for fg in set(c.fg for c in row)):
+                return None
+
+            pixmap = self.surface(len(row) * self.char_width, self.char_height)
+            painter = QPainter(pixmap)
+            painter.setFont(self.font)
+            paint_row(painter, 0, row)
+            painter.end()
+            self.row_cache.put(key, pixmap, pixmap.width() * pixmap.height() * 4)
+        return pixmap
+
+    def paint_row(self, painter, y, row):
+        char_width = self.char_width
+        char_height = self.char_height
+        if self.short_spans(row):
+            return self.paint_cells(painter, y, row)
+
+        fillRect = painter.fillRect
+        x, pen = 0, None
+        for (fg, bg), cells in groupby(row, self.colors):
+            text = u''.join([c.data for c in cells])
+            width = len(text) * char_width
+
+            if is_image(fg):
+                for col in range(len(text)):
+                    self.draw_Image(painter, x + col * char_width,
+                                    y + char_height, fg)
+                x += width
+                continue
+
+            rect = QRect(x, y, width, char_height)
+            fillRect(rect, self.brash(bg))
+            if not text.isspace():
+                if fg != pen:
+                    painter.setPen(self.pen(fg))
+                    pen = fg
+                self.draw_text(painter, rect, text)
+            x += width
+
+    def short_spans(self, row):
+        # Compact rows are counted on their attribute indices, which
+        # change at least as often as the colors do
+        keys = getattr(row, 'attrs', None)
+        if keys is None:
+            keys = list(map(self.colors, row))
+        changes = sum(map(ne, keys[1:], keys[:-1]))
+        return (changes + 1) * self.min_span > len(keys)
+
+    def paint_cells(self, painter, y, row):
+        # One cell at a time, the way rows were painted before spans
+        char_width = self.char_width
+        char_height = self.char_height
+        painter_drawText = painter.drawText
+        painter_fillRect = painter.fillRect
+        painter_setPen = painter.setPen
+        align = self.align
+        for col,item in enumerate(row):
+            x = col * char_width
+
+            if is_image(item.fg):
+                self.draw_Image(painter, x, y+char_height, item.fg)
+                continue
+
+            painter_setPen(self.pen(item.fg))
+
+            rect = QRect(x, y, char_width, char_height)
+            painter_fillRect(rect, self.brash(item.bg))
+            painter_drawText(rect, align, item.data)
+
+    def draw_text(self, painter, rect, text):
+        if len(text) == 1 or all(map(self.fits.__getitem__, text)):
+            painter.drawText(rect, self.align, text)
+            return
+
+        # Some glyph is wider or narrower than a cell (fallback font),
+        # put every character into its own cell to keep the columns
+        x, y = rect.x(), rect.y()
+        char_width = self.char_width
+        char_height = self.char_height
+        for col, char in enumerate(text):
+            if not char.isspace():
+                painter.drawText(QRect(x + col * char_width, y,
+                                       char_width, char_height),
+                                 self.align, char)
+
+    def draw_Image(self, painter, x, y, img):
+        # Decoded once, then painted from the shared pixmap cache
+        pixmap = self.pixmap_cache.get(img)
+        if pixmap is None:
+            data = images.get(img)
+            if data is None:
+                return
+            pixmap = self.surface()
+            pixmap.loadFromData(data)
+            self.pixmap_cache.put(img, pixmap,
+                                  pixmap.width() * pixmap.height() * 4)
+        self.blit(painter, x, y, pixmap)
+
+    def surface(self, width=0, height=0):
+        # What cached rows and images are kept in
+        return QPixmap(width, height)
+
+    def blit(self, painter, x, y, surface):
+        painter.drawPixmap(x, y, surface)
+
+
+class ImageRenderer(Renderer):
+    """
+    Renderer for threads other than the GUI thread, which can't use
+    pixmaps: rows and images are cached as QImages
+    """
+
+    pixmap_cache = LRUCache(32 << 20)
+
+    def surface(self, width=0, height=0):
+        return QImage(width, height, QImage.Format_RGB32)
+
+    def blit(self, painter, x, y, surface):
+        painter.drawImage(x, y, surface)
+
+
+class _Fits(dict):
+    # Whether a character's glyph is exactly one cell wide
+    def __init__(self, metrics, char_width):
+        self.metrics = metrics
+        self.char_width = char_width
+
+    def __missing__(self, char):
+        fits = self[char] = self.metrics.width(char) == self.char_width
+        return fits
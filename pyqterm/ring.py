@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Bounded byte buffers used to hand pty output from the reader stage
+# to the parser stage.
+# License: GPL2
+import struct
+import threading
+
+
+class ByteRing(object):
+    """
+    Fixed size circular byte buffer for one producer and one consumer.
+
+    :meth:`write` never blocks and never drops data, it takes as much as
+    fits and tells the caller how much that was; the caller is expected
+    to stop producing until :meth:`free` grows again.
+    """
+
+    def __init__(self, capacity=1 << 20):
+        self.capacity = capacity
+        self.buf = bytearray(capacity)
+        self.head = 0
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def free(self):
+        return self.capacity - self.size
+
+    def write(self, data):
+        with self.lock:
+            n = min(len(data), self.capacity - self.size)
+            if not n:
+                return 0
+            tail = (self.head + self.size) % self.capacity
+            first = min(n, self.capacity - tail)
+            self.buf[tail:tail + first] = data[:first]
+            if first < n:
+                self.buf[:n - first] = data[first:n]
+            self.size += n
+            return n
+
+    def read(self, n):
+        with self.lock:
+            d = self._peek(n)
+            self.head = (self.head + len(d)) % self.capacity
+            self.size -= len(d)
+            return d
+
+    def peek(self, n=None):
+        """
+        Up to n bytes (everything by default) without consuming them
+        """
+        with self.lock:
+            return self._peek(self.size if n is None else n)
+
+    def _peek(self, n):
+        n = min(n, self.size)
+        if not n:
+            return b""
+        head = self.head
+        end = head + n
+        if end <= self.capacity:
+            return bytes(self.buf[head:end])
+        return bytes(self.buf[head:]) + bytes(self.buf[:end - self.capacity])
+
+    def clear(self):
+        with self.lock:
+            self.head = self.size = 0
+
+
+class SharedRing(object):
+    """
+    The same for a producer and a consumer in different processes: the
+    ring lives at offset in a shared mmap, behind a header holding the
+    number of bytes ever written and read. Each side only updates its
+    own counter, after the data, so no lock is needed.
+    """
+
+    header = struct.Struct("<QQ")
+    count = struct.Struct("<Q")
+
+    @classmethod
+    def size(cls, capacity):
+        return cls.header.size + capacity
+
+    def __init__(self, mem, offset, capacity):
+        self.mem = mem
+        self.offset = offset
+        self.start = offset + self.header.size
+        self.capacity = capacity
+
+    def __len__(self):
+        written, read = self.header.unpack_from(self.mem, self.offset)
+        return written - read
+
+    def free(self):
+        return self.capacity - len(self)
+
+    def written(self):
+        """
+        Bytes ever written, a position in the stream going through
+        """
+        return self.count.unpack_from(self.mem, self.offset)[0]
+
+    def consumed(self):
+        return self.count.unpack_from(self.mem, self.offset + 8)[0]
+
+    def write(self, data):
+        written, read = self.header.unpack_from(self.mem, self.offset)
+        n = min(len(data), self.capacity - (written - read))
+        if not n:
+            return 0
+        tail = self.start + written % self.capacity
+        first = min(n, self.start + self.capacity - tail)
+        self.mem[tail:tail + first] = data[:first]
+        if first < n:
+            self.mem[self.start:self.start + n - first] = data[first:n]
+        self.count.pack_into(self.mem, self.offset, written + n)
+        return n
+
+    def read(self, n):
+        d = self.peek(n)
+        if d:
+            read = self.count.unpack_from(self.mem, self.offset + 8)[0]
+            self.count.pack_into(self.mem, self.offset + 8, read + len(d))
+        return d
+
+    def peek(self, n=None):
+        written, read = self.header.unpack_from(self.mem, self.offset)
+        size = written - read
+        n = size if n is None else min(n, size)
+        if not n:
+            return b""
+        head = self.start + read % self.capacity
+        first = min(n, self.start + self.capacity - head)
+        d = self.mem[head:head + first]
+        if first < n:
+            d += self.mem[self.start:self.start + n - first]
+        return d
+
+    def clear(self):
+        # Consumer side
+        written = self.count.unpack_from(self.mem, self.offset)[0]
+        self.count.pack_into(self.mem, self.offset + 8, written)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Searching the scrollback and the screen of a session while output keeps
+# coming: the history is searched once through its block filters (see
+# History.find), after that only the lines appended since and the screen
+# rows which changed are looked at.
+# License: GPL2
+import threading
+
+
+class Search(object):
+    """
+    Live results of looking for text in a session (a Session or a
+    RemoteSession), updated after every frame until :meth:`close`.
+
+    :attr:`matches` is a sorted list of ``(line, column)``. Lines are
+    numbered like ``History.total`` counts them: line ``n`` below
+    ``history.total`` is ``history[n - history.total + len(history)]``,
+    row y of the frame is line ``session.frame_total + y``, the lines
+    which had scrolled off when it was published.
+    """
+
+    def __init__(self, session, text, ignore_case=False):
+        self.session = session
+        self.text = text
+        self.ignore_case = ignore_case
+        self.needle = text.lower() if ignore_case else text
+        self.lock = threading.Lock()
+        self.history_matches = []
+        self.scanned = 0
+        # Rows of the last frame looked at and their matches
+        self.rows = ()
+        self.row_matches = []
+        self.matches = []
+        self.update()
+        session.subscribe(self.update)
+
+    def close(self):
+        self.session.unsubscribe(self.update)
+
+    def update(self):
+        # The frame and the number of lines above it in one go, screen
+        # rows are numbered after those; not under self.lock, the parser
+        # calls this holding the session's lock
+        session = self.session
+        with session.lock:
+            frame, total = session.frame, session.frame_total
+        with self.lock:
+            history = session.history
+            found = history.find(self.text, self.scanned, total,
+                                 self.ignore_case)
+            self.scanned = max(self.scanned, total)
+
+            matches = self.history_matches
+            dropped = total - len(history)
+            if matches and matches[0][0] < dropped:
+                # Scrolled out of the history altogether
+                matches = [m for m in matches if m[0] >= dropped]
+            self.history_matches = matches = matches + found
+
+            rows, old = frame.rows, self.rows
+            row_matches = []
+            for y, row in enumerate(rows):
+                if y < len(old) and row is old[y]:
+                    row_matches.append(self.row_matches[y])
+                else:
+                    row_matches.append(self.find_in_row(row))
+            self.rows, self.row_matches = rows, row_matches
+
+            screen = [(total + y, column)
+                      for y, columns in enumerate(row_matches)
+                      for column in columns]
+            # A single reference assignment, readers never need the lock
+            self.matches = matches + screen
+
+    def find_in_row(self, row):
+        text = u"".join(c.data for c in row)
+        if self.ignore_case:
+            text = text.lower()
+        columns = []
+        column = text.find(self.needle)
+        while column >= 0:
+            columns.append(column)
+            column = text.find(self.needle, column + 1)
+        return columns
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+# Session server: owns the ptys, parsers and screens of any number of
+# sessions in a process of its own, frontends attach over a Unix socket
+# (see pyqterm.client). Sessions keep running when frontends go away.
+#
+#   python -m pyqterm.server [--socket PATH]
+#
+# License: GPL2
+import os
+import sys
+import errno
+import socket
+import struct
+import argparse
+import threading
+import itertools
+import marshal
+from functools import partial
+
+from .backend import Session
+from .images import images
+from .reactor import Reactor, READ, WRITE
+from . import protocol
+
+
+class SessionServer(object):
+    """
+    Listens on the Unix socket at path, everything else happens in the
+    reactor thread and (for the screens) in the parser thread
+    """
+
+    # Scrollback lines sent to a frontend which attaches to a session
+    attach_history = 5000
+
+    def __init__(self, path=None, reactor=None):
+        self.path = path or protocol.default_path()
+        self.reactor = reactor or Reactor.instance()
+        self.sessions = {}
+        self.ids = itertools.count(1)
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+        self.sock = protocol.listen(self.path)
+        self.sock.setblocking(False)
+        self.reactor.add(self.sock.fileno(), self)
+
+    def serve_forever(self):
+        self.done.wait()
+
+    def stop(self):
+        self.reactor.remove(self.sock.fileno())
+        self.sock.close()
+        for connection in list(self.connections):
+            connection.close()
+        with self.lock:
+            sessions, self.sessions = list(self.sessions.values()), {}
+        for session in sessions:
+            session.stop()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        self.done.set()
+
+    def proc_read(self):
+        while True:
+            try:
+                sock, addr = self.sock.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    return True
+                raise
+            try:
+                protocol.check_peer(sock)
+            except (IOError, OSError):
+                # Someone else, however they got to the socket
+                sock.close()
+                continue
+            self.connections.add(Connection(self, sock))
+
+    def create(self, cmd, size):
+        session = Session(cmd=cmd, size=size)
+        with self.lock:
+            session.sid = next(self.ids)
+            self.sessions[session.sid] = session
+        session.subscribe(partial(self.exited, session))
+        session.start()
+        return session
+
+    def exited(self, session):
+        # Parser thread: sessions whose process ended go, once their
+        # frontends have the last frame
+        if session.exited and self.get(session.sid) is session:
+            self.drop(session.sid)
+
+    def get(self, sid):
+        with self.lock:
+            return self.sessions.get(sid)
+
+    def drop(self, sid):
+        if self.get(sid) is None:
+            return
+        for connection in list(self.connections):
+            connection.closed(sid)
+        with self.lock:
+            session = self.sessions.pop(sid, None)
+        if session is not None:
+            session.stop()
+
+    def list(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return tuple((s.sid, s.pid, s.cmd, s.exited) for s in sessions)
+
+
+class Connection(object):
+    """
+    One frontend. Updates are encoded when the socket can take them, from
+    whatever the screens look like by then, so a slow frontend gets fewer
+    frames instead of a growing backlog.
+    """
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.reactor = server.reactor
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.fd = sock.fileno()
+        self.inbuf = bytearray()
+        self.out = bytearray()
+        self.encoder = protocol.Encoder()
+        self.lock = threading.Lock()
+        # sid -> [last frame sent, history lines sent, callback]
+        self.attached = {}
+        self.pending = set()
+        self.reactor.add(self.fd, self)
+
+    def close(self):
+        with self.lock:
+            attached, self.attached = self.attached, {}
+            self.pending.clear()
+        for sid, (frame, total, callback) in attached.items():
+            session = self.server.get(sid)
+            if session is not None:
+                session.unsubscribe(callback)
+        self.reactor.remove(self.fd)
+        self.sock.close()
+        self.server.connections.discard(self)
+
+    def notify(self, sid):
+        # Parser thread
+        with self.lock:
+            if sid in self.attached:
+                self.pending.add(sid)
+                self.reactor.modify(self.fd, READ | WRITE)
+
+    def send(self, data):
+        with self.lock:
+            if self.out is not None:
+                self.out += data
+                self.reactor.modify(self.fd, READ | WRITE)
+
+    def proc_read(self):
+        try:
+            d = self.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return True
+            d = b""
+        if not d:
+            self.close()
+            return False
+
+        self.inbuf += d
+        messages, used = protocol.split(self.inbuf)
+        del self.inbuf[:used]
+        for kind, payload in messages:
+            try:
+                self.dispatch(kind, payload)
+            except (ValueError, TypeError, EOFError, IndexError,
+                    struct.error):
+                # Not something a frontend sends, nothing after it can
+                # be trusted either
+                self.close()
+                return False
+        return True
+
+    def dispatch(self, kind, payload):
+        server = self.server
+        if kind == protocol.WRITE:
+            session = server.get(protocol.SID.unpack_from(payload)[0])
+            if session is not None:
+                session.write(payload[protocol.SID.size:])
+            return
+
+        args = marshal.loads(payload)
+        if kind == protocol.CREATE:
+            cmd, columns, lines = args
+            self.attach(server.create(cmd, (columns, lines)).sid)
+        elif kind == protocol.ATTACH:
+            self.attach(args[0])
+        elif kind == protocol.DETACH:
+            self.detach(args[0])
+        elif kind == protocol.RESIZE:
+            session = server.get(args[0])
+            if session is not None:
+                session.resize(args[1], args[2])
+        elif kind == protocol.STOP:
+            server.drop(args[0])
+        elif kind == protocol.LIST:
+            self.send(protocol.message(protocol.SESSIONS,
+                                       marshal.dumps(server.list())))
+
+    def attach(self, sid):
+        session = self.server.get(sid)
+        if session is None:
+            self.send(protocol.request(protocol.ATTACHED, 0, None, None))
+            return
+        self.send(protocol.request(protocol.ATTACHED, sid, session.pid,
+                                   session.cmd))
+        callback = partial(self.notify, sid)
+        total = max(session.history.total - self.server.attach_history, 0)
+        with self.lock:
+            self.attached[sid] = [None, total, callback]
+            self.pending.add(sid)
+            self.reactor.modify(self.fd, READ | WRITE)
+        session.subscribe(callback)
+
+    def detach(self, sid):
+        with self.lock:
+            state = self.attached.pop(sid, None)
+            self.pending.discard(sid)
+        session = self.server.get(sid)
+        if state is not None and session is not None:
+            session.unsubscribe(state[2])
+
+    def closed(self, sid):
+        with self.lock:
+            if sid not in self.attached:
+                return
+            # Whatever of the session the frontend hasn't seen goes first
+            out = self.update(sid)
+            del self.attached[sid]
+            self.pending.discard(sid)
+            if self.out is not None:
+                self.out += b"".join(out)
+                self.out += protocol.request(protocol.CLOSED, sid)
+                self.reactor.modify(self.fd, READ | WRITE)
+
+    def update(self, sid):
+        """
+        Messages bringing the frontend's copy of a session up to date
+        """
+        session = self.server.get(sid)
+        state = self.attached.get(sid)
+        if session is None or state is None:
+            return []
+
+        out = []
+        lines, state[1] = session.history.since(state[1])
+        if lines:
+            out.append(self.encoder.history(sid, lines))
+
+        frame, old = session.frame, state[0]
+        if old is None or len(old.rows) != len(frame.rows) or (
+                frame.rows and len(old.rows[0]) != len(frame.rows[0])):
+            changed = range(len(frame.rows))
+        else:
+            changed = [y for y, (a, b) in enumerate(zip(old.rows, frame.rows))
+                       if a is not b]
+        if frame is not old:
+            out.append(self.encoder.frame(sid, frame, changed))
+            state[0] = frame
+        return self.encoder.flush(images) + out
+
+    def proc_write(self):
+        with self.lock:
+            if not self.out:
+                pending, self.pending = self.pending, set()
+                for sid in pending:
+                    self.out += b"".join(self.update(sid))
+            if self.out:
+                try:
+                    del self.out[:self.sock.send(self.out)]
+                except socket.error as e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+                        self.out = None
+            if self.out is not None and not self.out and not self.pending:
+                self.reactor.modify(self.fd, READ)
+
+        if self.out is None:
+            # Frontend went away
+            self.close()
+            return False
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pyqterm session server")
+    parser.add_argument("--socket", help="Unix socket path, default %s" %
+                        protocol.default_path())
+    args = parser.parse_args()
+    server = SessionServer(args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
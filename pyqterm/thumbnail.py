@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# Thumbnails of sessions, for dashboards showing many of them at once.
+# Every cell is one pixel: its background, or where it has a character,
+# the foreground mixed into it. Pixels are made from the cells straight,
+# no text is rasterized, and only rows which changed are made again.
+# License: GPL2
+import sys
+from array import array
+from functools import partial
+from itertools import groupby
+
+from PyQt4.QtCore import Qt, pyqtSignal
+from PyQt4.QtGui import QImage, QPainter, QWidget
+
+from . import palette
+from .frontend import RepaintScheduler, TerminalWidget
+from .render import Renderer
+
+if hasattr(array, 'tobytes'):
+    _bytes = array.tobytes
+else:
+    _bytes = array.tostring
+
+# Byte by byte, whether a character is written: 1 for all but blanks and
+# control characters
+_INK = bytes(bytearray([0] * 33 + [1] * 223))
+
+# QImage.Format_RGB32 pixels are 0xffrrggbb in the machine's byte order:
+# the bytes of opaque black, and where in a pixel which color's byte is
+if sys.byteorder == 'little':
+    _OPAQUE, _CHANNELS = b"\0\0\0\xff", ((0, 0), (1, 8), (2, 16))
+else:
+    _OPAQUE, _CHANNELS = b"\xff\0\0\0", ((1, 16), (2, 8), (3, 0))
+
+
+class Thumbnail(object):
+    """
+    An image of screen rows, one pixel per cell, see :meth:`update`
+    """
+
+    # How much of the foreground is in the pixel of a character
+    ink = 0.5
+
+    # Pixels kept by colors and by attributes, each; truecolor output
+    # brings no end of them
+    cache_size = 4096
+
+    # Palettes and pixels of colors, shared by thumbnails with the same
+    # color maps
+    _colors = {}
+
+    def __init__(self, foreground_color_map, background_color_map):
+        key = (id(foreground_color_map), id(background_color_map), self.ink)
+        colors = self._colors.get(key)
+        if colors is None or colors[0] is not foreground_color_map or \
+                colors[1] is not background_color_map:
+            colors = self._colors[key] = (
+                foreground_color_map, background_color_map,
+                [c.rgb() for c in Renderer.palette_colors(foreground_color_map)],
+                [c.rgb() for c in Renderer.palette_colors(background_color_map)],
+                {}, {})
+        # Pixels of blank and written cells by colors, and by generation
+        # of cell table and index of compact rows' attributes
+        _fg, _bg, self.foreground, self.background, self.pairs, \
+            self.attr_pairs = colors
+        self.rows = ()
+        # Pixels of the rows shown by their cells, which snapshots of
+        # compact rows share until they change: rows moved by scrolling
+        # are only copied
+        self.cache = {}
+        self.columns = 0
+        self.pixels = bytearray()
+        self.data = b""
+        self.image = QImage()
+
+    def update(self, rows):
+        """
+        Show rows, the rows of a frame; rows which are the same objects as
+        last time are left alone. Returns the lines which changed.
+        """
+        columns = len(rows[0]) if rows else 0
+        width = columns * 4
+        old = self.rows
+        if columns != self.columns or len(rows) != len(old):
+            self.columns = columns
+            blank = array('I', [self.background[palette.DEFAULT]])
+            self.pixels = bytearray(_bytes(blank) * (columns * len(rows)))
+            old = ()
+        cache, self.cache = self.cache, {}
+        lines = []
+        for y, row in enumerate(rows):
+            cells = getattr(row, 'codes', row)
+            entry = cache.get(id(cells))
+            if entry is None or entry[0] is not cells:
+                entry = (cells, self.row_pixels(row)[:width])
+            self.cache[id(cells)] = entry
+            if y >= len(old) or row is not old[y]:
+                pixels = entry[1]
+                self.pixels[y * width:y * width + len(pixels)] = pixels
+                lines.append(y)
+        self.rows = rows
+        if lines:
+            # The image uses the bytes, they are kept with it
+            self.data = bytes(self.pixels)
+            self.image = QImage(self.data, columns, len(rows),
+                                QImage.Format_RGB32)
+        return lines
+
+    def row_pixels(self, row):
+        """
+        Pixels of a row, four bytes each
+        """
+        codes = getattr(row, 'codes', None)
+        if codes is None:
+            # Rows of Chars
+            return _bytes(array('I', [self.pair(c.fg, c.bg)[c.data > u" "]
+                                      for c in row]))
+
+        # Compact rows go by runs of cells with the same attributes, whose
+        # pixels are picked by whether cells are written all at once
+        try:
+            ink = bytearray(iter(codes)).translate(_INK)
+        except ValueError:
+            # Beyond latin-1
+            ink = bytearray([code > 32 for code in codes])
+        attrs = row.attrs
+        if attrs and attrs.count(attrs[0]) == len(attrs):
+            runs = [(attrs[0], len(attrs))]
+        else:
+            runs = [(idx, len(list(group))) for idx, group in groupby(attrs)]
+        pairs, generation, table = \
+            self.attr_pairs, row.table.generation, row.table.attrs
+        if len(pairs) >= self.cache_size:
+            pairs.clear()
+        colored = []
+        for idx, count in runs:
+            pair = pairs.get((generation, idx))
+            if pair is None:
+                pair = pairs[(generation, idx)] = self.pair(*table[idx][:2])
+            colored.append((pair, count))
+
+        x = 0
+        if len(runs) * 16 > len(codes):
+            # Short runs, cell by cell
+            pixels = array('I')
+            for pair, count in colored:
+                pixels.extend(map(pair.__getitem__, ink[x:x + count]))
+                x += count
+            return _bytes(pixels)
+        # Long runs a color of all their pixels at a time, translating
+        # whether cells are written into the byte of either pixel
+        pixels = bytearray(_OPAQUE * len(codes))
+        for pair, count in colored:
+            written = ink[x:x + count]
+            for i, channel in pair[2]:
+                pixels[x * 4 + i:(x + count) * 4:4] = written.translate(channel)
+            x += count
+        return pixels
+
+    def pair(self, fg, bg):
+        """
+        Pixels of a blank and of a written cell in these colors, and
+        translation tables from whether a cell is written to each of
+        their bytes
+        """
+        pair = self.pairs.get((fg, bg))
+        if pair is None:
+            if len(self.pairs) >= self.cache_size:
+                self.pairs.clear()
+            back = self.rgb(bg, self.background)
+            fore = self.rgb(fg, self.foreground)
+            ink = self.ink
+            mixed = 0xff000000
+            for shift in (16, 8, 0):
+                mixed |= int((fore >> shift & 255) * ink +
+                             (back >> shift & 255) * (1 - ink)) << shift
+            channels = tuple(
+                (i, bytes(bytearray([back >> shift & 255,
+                                     mixed >> shift & 255] + [0] * 254)))
+                for i, shift in _CHANNELS)
+            pair = self.pairs[(fg, bg)] = (back, mixed, channels)
+        return pair
+
+    def rgb(self, color, colors):
+        color = palette.key(color)
+        if not isinstance(color, int):
+            # Image handles, names which aren't colors
+            return colors[palette.DEFAULT]
+        if color < len(colors):
+            return colors[color]
+        r, g, b = palette.split(color)
+        return 0xff000000 | r << 16 | g << 8 | b
+
+
+class ThumbnailWidget(QWidget):
+    """
+    A session's thumbnail stretched over the widget, at frame_rate
+    updates per second at most, whatever the widgets showing the session
+    in full do; none while it can't be seen, it catches up when it is
+    painted again. Clicking it emits clicked().
+    """
+
+    clicked = pyqtSignal()
+
+    # Updates per second at most
+    frame_rate = 5
+
+    foreground_color_map = TerminalWidget.foreground_color_map
+    background_color_map = TerminalWidget.background_color_map
+
+    def __init__(self, session, parent=None):
+        super(ThumbnailWidget, self).__init__(parent)
+        self.setAttribute(Qt.WA_OpaquePaintEvent, True)
+        self.thumbnail = Thumbnail(self.foreground_color_map,
+                                   self.background_color_map)
+        self._session = session
+        self._scheduler = RepaintScheduler(self, self.frame_rate)
+        self._stale = False
+        session.subscribe(self._scheduler.notify)
+        # Widgets deleted without being closed, along with their parent
+        self.destroyed.connect(partial(session.unsubscribe,
+                                       self._scheduler.notify))
+        self.update_rows()
+
+    def session(self):
+        return self._session
+
+    def update_rows(self):
+        if not self.isVisible() or self.visibleRegion().isEmpty():
+            # Hidden, or scrolled out of view
+            self._stale = True
+        elif self.thumbnail.update(self._session.frame.rows):
+            self.update()
+
+    def paintEvent(self, event):
+        if self._stale:
+            self._stale = False
+            self.thumbnail.update(self._session.frame.rows)
+        painter = QPainter(self)
+        image = self.thumbnail.image
+        if image.isNull():
+            painter.fillRect(self.rect(), self.palette().dark())
+        else:
+            painter.drawImage(self.rect(), image)
+
+    def mousePressEvent(self, event):
+        self.clicked.emit()
+        event.accept()
+
+    def closeEvent(self, event):
+        self._session.unsubscribe(self._scheduler.notify)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Waiting for frames, for headless use of sessions (tests, automation).
+# Waiters subscribe to the session and sleep on a condition which its
+# callbacks notify, so they wake up as a frame is published rather than
+# polling; this works the same for sessions parsed in process, in worker
+# processes or in the session server.
+# License: GPL2
+import threading
+import time
+
+
+def until(session, predicate, timeout=None):
+    """
+    Call predicate(frame) with the session's frame, and again with every
+    new one, until it returns something but None, which is returned. None
+    once the session exited or after timeout seconds.
+    """
+    cond = threading.Condition()
+
+    def changed():
+        with cond:
+            cond.notify()
+
+    deadline = None if timeout is None else time.time() + timeout
+    session.subscribe(changed)
+    try:
+        with cond:
+            while True:
+                # Exited is looked at first, the last frame comes before
+                exited = session.exited
+                result = predicate(session.frame)
+                if result is not None or exited:
+                    return result
+                if deadline is None:
+                    cond.wait()
+                else:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        return None
+                    cond.wait(left)
+    finally:
+        session.unsubscribe(changed)
+
+
+def wait_for(session, pattern, timeout=None):
+    """
+    Wait for text, or a compiled regular expression, to show up in a row
+    of the screen; ``(row, column)`` of the first match, or None
+    """
+    if hasattr(pattern, 'search'):
+        def find(text):
+            m = pattern.search(text)
+            return m.start() if m else -1
+    else:
+        def find(text):
+            return text.find(pattern)
+
+    # Rows which didn't change between frames are the same objects
+    rows, columns = [], []
+
+    def search(frame):
+        found = None
+        for y, row in enumerate(frame.rows):
+            if y < len(rows) and row is rows[y]:
+                column = columns[y]
+            else:
+                column = find(row_text(row))
+                if y < len(rows):
+                    rows[y], columns[y] = row, column
+                else:
+                    rows.append(row)
+                    columns.append(column)
+            if column >= 0 and found is None:
+                found = (y, column)
+        return found
+
+    return until(session, search, timeout)
+
+
+def snapshot(session, after=None, timeout=None):
+    """
+    The session's frame; with after, the first frame of a version above
+    after, or None if it doesn't come in time
+    """
+    if after is None:
+        return session.frame
+    return until(session, lambda frame: frame if frame.version > after
+                 else None, timeout)
+
+
+def row_text(row):
+    if hasattr(row, 'text'):
+        text = row.text()
+        return text if isinstance(text, type(u"")) else u"".join(text)
+    return u"".join(c.data for c in row)
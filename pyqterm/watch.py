@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# Watching the output of a session for patterns as it is read, the way
+# expect does: prompts, error messages, markers of finished commands. All
+# patterns of a watch are combined into one regular expression, which is
+# run over the new output and the end of what came before, so matches
+# spanning reads are found; a watch keeps no more than its window of the
+# output, whatever was read and however many patterns there are. Matches
+# which more output could still make longer are held back until it comes,
+# the output goes quiet or it ends.
+# License: GPL2
+import re
+import time
+import threading
+import codecs
+import traceback
+from collections import namedtuple
+
+#: A match: the name of the pattern, the text matched and where it is in
+#: the output, counted in characters since the watch started
+Hit = namedtuple("Hit", "name text start end")
+
+
+class Watch(object):
+    """
+    Patterns looked for in the output of a session (see Session.watch),
+    ``callback(hit)`` is called with a :data:`Hit` for every match, from
+    the thread reading the output, until :meth:`close`.
+
+    Patterns are a dict of names to regular expressions, or a list of
+    them, named by themselves. Matches don't overlap, the earliest one
+    wins and the first pattern given of those matching there. Patterns
+    can't refer to their own groups by number, they are wrapped in groups
+    of the watch.
+
+    With literal=True patterns are plain text, any number of them are
+    matched by a single expression shaped like a trie of them; where
+    several match the longest wins.
+
+    A literal match is held back while the output after its start is the
+    beginning of a longer pattern, a regular expression match while it
+    reaches the end of the output read so far: either is reported once
+    more output decides it, after ``linger`` seconds without output, or
+    at :meth:`flush`, which the session calls when the output ends.
+    """
+
+    # Matches up to this many characters are found across reads, that
+    # much of the output is rescanned with every read and kept; literal
+    # patterns need no more than the longest of them
+    window = 1024
+
+    # Patterns per combined expression, Python 2 allows 100 named groups
+    group_limit = 99
+
+    # Seconds without output after which held back matches are reported
+    linger = 0.1
+
+    def __init__(self, session, patterns, callback, literal=False,
+                 ignore_case=False):
+        self.session = session
+        self.callback = callback
+        self.literal = literal
+        self.ignore_case = ignore_case
+        if hasattr(patterns, 'items'):
+            patterns = sorted(patterns.items())
+        else:
+            patterns = [(p, p) for p in patterns]
+        self.names = {}
+        self.regexes = []
+        # Beginnings of literal patterns which are no patterns themselves
+        # but start longer ones, a match followed by one of them may grow
+        self.prefixes = set()
+        flags = re.UNICODE | (re.IGNORECASE if ignore_case else 0)
+        if literal:
+            for name, text in reversed(patterns):
+                text = text.lower() if ignore_case else text
+                self.names[text] = name
+                self.prefixes.update(text[:i] for i in range(1, len(text)))
+            self.regexes.append(re.compile(trie([t for _n, t in patterns]),
+                                           flags))
+            self.window = max([len(t) for _n, t in patterns] + [1])
+        for i in range(0, 0 if literal else len(patterns), self.group_limit):
+            parts = []
+            for j, (name, pattern) in enumerate(
+                    patterns[i:i + self.group_limit]):
+                group = "w%d" % (i + j)
+                self.names[group] = name
+                parts.append("(?P<%s>%s)" % (group, pattern))
+            self.regexes.append(re.compile("|".join(parts), flags))
+
+        self.lock = threading.Lock()
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        # The end of the output looked at so far, where it starts, where
+        # the next match may start and up to where matches were reported
+        self.tail = u""
+        self.base = 0
+        self.next = 0
+        self.done = 0
+        self.closed = False
+        # Where the match held back starts, when output came last and the
+        # timer reporting it if none comes
+        self.held = None
+        self.fed = 0
+        self.timer = None
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            self.cancel()
+        self.session.unwatch(self)
+
+    def feed(self, data):
+        """
+        Look for matches in data, the next bytes of output
+        """
+        with self.lock:
+            self.fed = time.time()
+            hits = self.scan(self.decoder.decode(data))
+            if self.held is None:
+                self.cancel()
+            elif self.timer is None:
+                self.wait(self.linger)
+        self.report(hits)
+
+    def flush(self):
+        """
+        Report the match held back, no more output is taken to come
+        """
+        with self.lock:
+            self.cancel()
+            hits = self.scan(u"", final=True)
+        self.report(hits)
+
+    def wait(self, delay):
+        self.timer = threading.Timer(delay, self.quiet)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def quiet(self):
+        with self.lock:
+            delay = self.fed + self.linger - time.time()
+            if delay > 0 and self.held is not None:
+                # Output came since, it may still decide
+                self.wait(delay)
+                return
+        self.flush()
+
+    def report(self, hits):
+        for hit in hits:
+            if self.closed:
+                break
+            try:
+                self.callback(hit)
+            except Exception:
+                traceback.print_exc()
+
+    def scan(self, text, final=False):
+        if not text and (not final or self.held is None):
+            return []
+        buf, base = self.tail + text, self.base
+        done = base + len(buf)
+        hits = []
+        pos = max(self.next - base, 0)
+        found = [None] * len(self.regexes)
+        while True:
+            best = None
+            for i, regex in enumerate(self.regexes):
+                m = found[i]
+                if m is None or m.start() < pos:
+                    m = found[i] = regex.search(buf, pos)
+                if m is not None and (best is None or m.start() < best.start()):
+                    best = m
+            if best is None:
+                break
+            start, end = best.span()
+            if end == start:
+                # Nothing to report, and no progress either
+                pos = end + 1
+                continue
+            pos = end
+            if base + end <= self.done:
+                # Seen and decided before
+                continue
+            if not final and self.growing(best, buf) and \
+                    end - start < self.window:
+                done = base + start
+                break
+            hits.append(Hit(self.name(best), best.group(),
+                            base + start, base + end))
+            self.next = base + end
+
+        self.done = done
+        self.held = done if done < base + len(buf) else None
+        # What is held back stays, it is looked at again
+        tail = buf[min(max(len(buf) - self.window, 0), done - base):]
+        self.base = base + len(buf) - len(tail)
+        self.tail = tail
+        return hits
+
+    def growing(self, match, buf):
+        # Whether more output may make the match longer
+        if not self.literal:
+            return match.end() == len(buf)
+        rest = buf[match.start():]
+        return (rest.lower() if self.ignore_case else rest) in self.prefixes
+
+    def name(self, match):
+        if not self.literal:
+            return self.names[match.lastgroup]
+        text = match.group()
+        return self.names[text.lower() if self.ignore_case else text]
+
+
+def trie(words):
+    """
+    A regular expression matching any of words, the longest where several
+    do, with the alternatives of every prefix shared
+    """
+    root = {}
+    for word in words:
+        node = root
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+    return _trie(root) if root else "(?!)"
+
+
+def _trie(node):
+    out = []
+    # Runs without branches are written out, recursion is per branch
+    while len(node) == 1 and '' not in node:
+        char, node = next(iter(node.items()))
+        out.append(re.escape(char))
+    alternatives = [re.escape(char) + _trie(node[char])
+                    for char in sorted(c for c in node if c)]
+    if alternatives:
+        group = "(?:%s)" % "|".join(alternatives) \
+            if len(alternatives) > 1 or '' in node else alternatives[0]
+        out.append(group + ("?" if '' in node else ""))
+    return "".join(out)
@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+# Parser stage spread over worker processes, for many busy sessions on
+# many cores. Every session gets a slot in one of the workers: the output
+# it reads goes into a ring in memory shared with that worker, the rows
+# the worker's screen changed come back through another shared ring,
+# encoded the way the session server sends them (pyqterm.protocol).
+# Pipes only carry commands and doorbells, nothing is pickled.
+# License: GPL2
+import os
+import mmap
+import time
+import errno
+import fcntl
+import select
+import signal
+import marshal
+import threading
+import traceback
+import multiprocessing
+from collections import deque
+
+from .backend import Session, TagStream, TagScreen, Frame
+from .cells import CellTable, Row
+from .images import ImageStore, images
+from .reactor import Reactor, Parser
+from .ring import SharedRing
+from . import protocol
+
+
+# Main process to worker
+ADD = 16            # (slot, columns, lines)
+DATA = 17           # no payload, there is output in some ring
+RESIZE = 18         # (slot, position, columns, lines)
+EOF = 19            # (slot, position), parse what is left and let go of
+                    # the slot
+# Commands which come with a position are carried out once the worker
+# parsed that many bytes of the session's ring, as they were written by
+# then: the pipe and the ring aren't in step otherwise
+QUIT = 20           # ()
+
+# Worker to main process, besides ATTRS, IMAGE, HISTORY and FRAME with
+# the slot for a sid
+EXITED = 80         # (slot,)
+
+DOORBELL = protocol.message(DATA, b"")
+
+
+class ParserPool(object):
+    """
+    Parser stage running in ``workers`` processes (one per CPU by
+    default), a drop-in for Parser::
+
+        pool = ParserPool.instance()
+        session = Session(parser=pool)
+
+    Sessions are handed out round robin over the workers, ``slots`` per
+    worker; sessions beyond that are parsed by the in-process Parser.
+    The screen of a session in a worker isn't in this process, only its
+    frames and history are: recording and getstate() need the in-process
+    Parser.
+    """
+
+    # Sessions per worker
+    slots = 64
+    # Capacity of the rings going to the workers, sessions with larger
+    # rings stay in process
+    ring_size = Session.ring_size
+    # Capacity of the ring coming back from a worker
+    out_size = 8 << 20
+    # Bytes parsed for one session before the worker moves to the next
+    batch = 1 << 16
+    # A session's frames are sent this often at most, the first one after
+    # a quiet spell right away
+    publish_interval = 1.0 / 60
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        with cls._instance_lock:
+            if cls._instance is None or not cls._instance.running:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self, workers=None, reactor=None):
+        self.reactor = reactor or Reactor.instance()
+        self.lock = threading.Lock()
+        # slot -> session and back
+        self.sessions = {}
+        self.slot_of = {}
+        # Slots an EOF was sent for
+        self.ending = set()
+        self.running = True
+        if workers is None:
+            try:
+                workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                workers = 1
+        self.workers = [Worker(self, i) for i in range(workers)]
+        # Interleaved, so sessions spread over the workers
+        self.free = deque(worker.index * self.slots + slot
+                          for slot in range(self.slots)
+                          for worker in self.workers)
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+        for worker in self.workers:
+            worker.stop()
+
+    def worker(self, slot):
+        return self.workers[slot // self.slots]
+
+    def attach(self, session):
+        slot = None
+        with self.lock:
+            if (self.running and self.free and
+                    session.ring_size <= self.ring_size):
+                slot = self.free.popleft()
+                self.sessions[slot] = session
+                self.slot_of[session] = slot
+        if slot is None:
+            session.parser = Parser.instance()
+            return session.parser.attach(session)
+
+        worker = self.worker(slot)
+        screen = session.screen
+        worker.send(protocol.request(ADD, slot, screen.columns, screen.lines))
+        return worker.ring(slot)
+
+    def resize(self, session, w, h):
+        with self.lock:
+            slot = self.slot_of.get(session)
+        if slot is None:
+            return
+        with session.lock:
+            screen = session.screen
+            if (screen.columns, screen.lines) == (w, h):
+                # pyte homes the cursor on any resize
+                return
+            # Only for the record, frames come from the worker's screen
+            screen.resize(h, w)
+        worker = self.worker(slot)
+        worker.send(protocol.request(RESIZE, slot,
+                                     worker.ring(slot).written(), w, h))
+
+    def schedule(self, session):
+        with self.lock:
+            slot = self.slot_of.get(session)
+            if slot is None:
+                return
+            eof = session.eof and slot not in self.ending
+            if eof:
+                self.ending.add(slot)
+        if eof:
+            worker = self.worker(slot)
+            worker.send(protocol.request(EOF, slot,
+                                         worker.ring(slot).written()))
+        else:
+            # A doorbell which doesn't fit is one too many
+            self.worker(slot).send(DOORBELL, wait=False)
+
+    def release(self, slot):
+        with self.lock:
+            session = self.sessions.pop(slot, None)
+            self.slot_of.pop(session, None)
+            self.ending.discard(slot)
+            self.free.append(slot)
+        return session
+
+
+class Worker(object):
+    """
+    One worker process. The main process side lives in the reactor,
+    :meth:`run` is the worker process itself.
+    """
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.base = index * pool.slots
+        self.slot_size = SharedRing.size(pool.ring_size)
+        offset = pool.slots * self.slot_size
+        # Anonymous shared mapping, the forked worker sees the same pages
+        self.mem = mmap.mmap(-1, offset + SharedRing.size(pool.out_size))
+        self.out = SharedRing(self.mem, offset, pool.out_size)
+        self.decoder = protocol.Decoder()
+        self.lock = threading.Lock()
+
+        ctl, self.ctl = os.pipe()
+        self.bell, bell = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            code = 0
+            try:
+                self.run(ctl, bell)
+            except SystemExit:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            os._exit(code)
+
+        os.close(ctl)
+        os.close(bell)
+        for fd in (self.ctl, self.bell):
+            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        pool.reactor.add(self.bell, self)
+
+    def ring(self, slot):
+        return SharedRing(self.mem, (slot - self.base) * self.slot_size,
+                          self.pool.ring_size)
+
+    def send(self, data, wait=True):
+        with self.lock:
+            while data and self.ctl is not None:
+                try:
+                    data = data[os.write(self.ctl, data):]
+                except (IOError, OSError) as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    if e.errno != errno.EAGAIN:
+                        # Worker is gone, proc_read finds out
+                        return False
+                    if not wait:
+                        return False
+                    select.select([], [self.ctl], [], 1.0)
+        return not data
+
+    def stop(self):
+        self.send(protocol.request(QUIT))
+        self.pool.reactor.remove(self.bell)
+        with self.lock:
+            ctl, self.ctl = self.ctl, None
+        if ctl is not None:
+            os.close(ctl)
+            os.close(self.bell)
+        try:
+            os.waitpid(self.pid, 0)
+        except (IOError, OSError):
+            pass
+
+    def proc_read(self):
+        """
+        Reactor: the worker rang, take everything it sent
+        """
+        try:
+            d = os.read(self.bell, 4096)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            d = b""
+        if not d:
+            self.lost()
+            return False
+
+        # The worker only ever writes whole messages
+        messages, used = protocol.split(self.out.read(len(self.out)))
+        changed = set()
+        for kind, payload in messages:
+            self.dispatch(kind, payload, changed)
+
+        pool = self.pool
+        with pool.lock:
+            sessions = [s for slot, s in pool.sessions.items()
+                        if slot // pool.slots == self.index]
+        for session in sessions:
+            # Rings it drained may let the reader go on
+            session.proc_resume()
+        for session in changed:
+            session.proc_notify()
+        return True
+
+    def dispatch(self, kind, payload, changed):
+        decoder, sessions = self.decoder, self.pool.sessions
+        if kind == protocol.FRAME:
+            slot, version, lines, columns, cursor, rows = decoder.frame(payload)
+            session = sessions.get(slot)
+            if session is not None:
+                with session.lock:
+                    # History comes before the frame it scrolled off from
+                    session.frame_total = session.history.total
+                    session.frame = protocol.patch(session.frame, version,
+                                                   lines, columns, cursor,
+                                                   rows)
+                changed.add(session)
+        elif kind == protocol.HISTORY:
+            slot, lines = decoder.history(payload)
+            session = sessions.get(slot)
+            if session is not None:
+                for line in lines:
+                    session.history.append(line)
+        elif kind == protocol.ATTRS:
+            decoder.add_attrs(payload)
+        elif kind == protocol.IMAGE:
+            handle, data = protocol.image(payload)
+            images.add(data)
+        elif kind == EXITED:
+            slot, = marshal.loads(payload)
+            session = self.pool.release(slot)
+            if session is not None:
+                session.exited = True
+                changed.add(session)
+
+    def lost(self):
+        # The worker died, its sessions won't get any further
+        self.pool.reactor.remove(self.bell)
+        pool = self.pool
+        with pool.lock:
+            mine = [slot for slot in pool.sessions
+                    if slot // pool.slots == self.index]
+            sessions = [pool.sessions.pop(slot) for slot in mine]
+            for session in sessions:
+                pool.slot_of.pop(session, None)
+            pool.ending.difference_update(mine)
+            # Nor should new ones end up here
+            pool.free = deque(slot for slot in pool.free
+                              if slot // pool.slots != self.index)
+        for session in sessions:
+            session.exited = True
+            session.proc_notify()
+
+    def run(self, ctl, bell):
+        """
+        Worker process
+        """
+        # Ctrl-C in the terminal is for the main process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # Descriptors of other workers and sessions kept open here would
+        # keep those from noticing the other side went away
+        try:
+            fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+        except OSError:
+            fds = range(3, 1024)
+        for fd in fds:
+            if fd > 2 and fd not in (ctl, bell):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        fcntl.fcntl(bell, fcntl.F_SETFL, os.O_NONBLOCK)
+        # Whatever locks the main process's threads held stay held here,
+        # images and cells get tables of their own; the worker's rows are
+        # all made here
+        TagScreen.images = store = ImageStore()
+        Row.cells = CellTable()
+
+        self.ctl, self.bell = ctl, bell
+        self.inbuf = bytearray()
+        self.encoder = protocol.Encoder()
+        self.store = store
+        self.shards = {}
+        pool = self.pool
+        while True:
+            timeout = None
+            now = time.time()
+            for shard in self.shards.values():
+                if len(shard.ring) or shard.eof:
+                    timeout = 0
+                    break
+                if shard.dirty:
+                    # Output stopped before the frame was due
+                    wait = max(shard.published + pool.publish_interval - now, 0)
+                    timeout = wait if timeout is None else min(timeout, wait)
+            if not self.receive(timeout):
+                return
+
+            for slot, shard in list(self.shards.items()):
+                ring = shard.ring
+                full = len(ring) > ring.capacity * 3 // 4
+                d = ring.read(shard.due(pool.batch))
+                if d:
+                    shard.stream.feed(d)
+                    shard.dirty = True
+                shard.apply()
+                left = len(ring)
+                if shard.eof and not left:
+                    shard.stream.feed(b'\n[ exited ]')
+                    self.publish(slot, shard)
+                    self.put(protocol.request(EXITED, slot))
+                    self.ring_bell()
+                    del self.shards[slot]
+                elif shard.dirty and (time.time() - shard.published >=
+                                      pool.publish_interval):
+                    self.publish(slot, shard)
+                elif full:
+                    # The reader may be waiting for room
+                    self.ring_bell()
+
+    def receive(self, timeout):
+        """
+        Worker process: carry out the commands which came in within
+        timeout, False once the main process is gone
+        """
+        try:
+            r, w, x = select.select([self.ctl], [], [], timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return True
+            raise
+        if not r:
+            return True
+        d = os.read(self.ctl, 65536)
+        if not d:
+            return False
+        self.inbuf += d
+        messages, used = protocol.split(self.inbuf)
+        del self.inbuf[:used]
+
+        pool = self.pool
+        for kind, payload in messages:
+            if kind == DATA:
+                continue
+            if kind == QUIT:
+                return False
+            args = marshal.loads(payload)
+            if kind == ADD:
+                slot, columns, lines = args
+                self.shards[slot] = Shard(self.ring(slot), columns, lines)
+            elif kind in (RESIZE, EOF):
+                shard = self.shards.get(args[0])
+                if shard is not None:
+                    shard.commands.append((args[1], kind, args[2:]))
+                    shard.apply()
+        return True
+
+    def publish(self, slot, shard):
+        """
+        Worker process: send the history and the rows changed since the
+        last time, in messages small enough to always fit the ring
+        """
+        encoder, screen = self.encoder, shard.screen
+        out = []
+        lines = shard.history
+        for i in range(0, len(lines), 256):
+            out.append(encoder.history(slot, lines[i:i + 256]))
+        del lines[:]
+
+        size = (screen.lines, screen.columns)
+        if size != shard.size:
+            changed = list(range(screen.lines))
+            shard.size = size
+        else:
+            changed = sorted(y for y in screen.dirty if y < screen.lines)
+        screen.dirty.clear()
+        c = screen.cursor
+        cursor = (c.x, c.y, c.hidden)
+        if changed or cursor != shard.cursor:
+            shard.version += 1
+            shard.cursor = cursor
+            frame = Frame(shard.version, screen, cursor, None)
+            for i in range(0, max(len(changed), 1), 64):
+                out.append(encoder.frame(slot, frame, changed[i:i + 64]))
+
+        for data in encoder.flush(self.store) + out:
+            self.put(data)
+        self.ring_bell()
+        shard.dirty = False
+        shard.published = time.time()
+
+    def put(self, data):
+        # Worker process
+        while self.out.free() < len(data):
+            # The main process is behind, it has been rung already
+            self.ring_bell()
+            if not self.receive(0.01):
+                raise SystemExit(0)
+        self.out.write(data)
+
+    def ring_bell(self):
+        try:
+            os.write(self.bell, b"x")
+        except (IOError, OSError) as e:
+            if e.errno == errno.EPIPE:
+                raise SystemExit(0)
+            # Full, rung enough
+
+
+class Shard(object):
+    """
+    A session as its worker sees it
+    """
+
+    def __init__(self, ring, columns, lines):
+        self.ring = ring
+        self.stream = TagStream()
+        self.screen = Session.Screen(columns, lines)
+        self.history = self.screen.history = []
+        self.stream.attach(self.screen)
+        self.version = 0
+        self.size = self.cursor = None
+        self.dirty = True
+        self.eof = False
+        self.published = 0
+        # (position, kind, args) of the commands waiting for the parser
+        # to get to their position
+        self.commands = deque()
+
+    def due(self, n):
+        """
+        How much of n bytes can be parsed before the next command
+        """
+        if self.commands:
+            n = min(n, self.commands[0][0] - self.ring.consumed())
+        return max(n, 0)
+
+    def apply(self):
+        commands, consumed = self.commands, self.ring.consumed()
+        while commands and commands[0][0] <= consumed:
+            _position, kind, args = commands.popleft()
+            if kind == RESIZE:
+                columns, lines = args
+                screen = self.screen
+                if (screen.columns, screen.lines) != (columns, lines):
+                    screen.resize(lines, columns)
+                    self.dirty = True
+            elif kind == EOF:
+                self.eof = True
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+
+import pyte
+
+from pyqterm import palette
+from pyqterm.backend import Session, TagStream
+
+
+class CharStream(TagStream):
+    bulk = False
+
+
+# Output pyte draws on its own: no annotations and no bright or 256
+# colors, which only the compact screen understands.  ESC ( B is left
+# out too, pyte 0.4 can't draw after it on python 3
+PIECES = [
+    b"plain ascii text ",
+    u"utf-8 éè │─ 中文 ".encode("utf-8"),
+    b"\r\n", b"\t", b"\x08", b"\x07", b"\x00", b"\x7f", b"\x0e", b"\x0f",
+    b"\x1b[1;31m", b"\x1b[0m", b"\x1b[42m", b"\x1b[7m", b"\x1b[4;33m",
+    b"\x1b[K", b"\x1b[2J", b"\x1b[H", b"\x1b[5;10H", b"\x1b[3A", b"\x1b[4C",
+    b"\x1b[4h", b"\x1b[4l", b"\x1b[?7l", b"\x1b[?7h", b"\x1b[20h",
+    b"\x1b[20l", b"\x1b[2;20r", b"\x1b[r", b"\x1bM", b"\x1bD",
+    b"\x1b[1;\x18x", b"\x1b(0lqqk", b"\x1b[2@", b"\x1b[3P",
+    b"x" * 150,
+]
+
+
+def corpus(seed, size=20000):
+    rnd = random.Random(seed)
+    out, n = [], 0
+    while n < size:
+        out.append(rnd.choice(PIECES))
+        n += len(out[-1])
+    return b"".join(out)
+
+
+def chunks(data, seed):
+    rnd = random.Random(seed)
+    pos = 0
+    while pos < len(data):
+        n = rnd.randint(1, 512)
+        yield data[pos:pos + n]
+        pos += n
+
+
+def attach(screen, stream):
+    stream.attach(screen)
+    return screen, stream
+
+
+def cells(row):
+    return [(c.data, palette.key(c.fg), palette.key(c.bg)) + tuple(c[3:])
+            for c in row]
+
+
+class StreamTest(unittest.TestCase):
+
+    def check(self, stream_class):
+        for seed in range(5):
+            data = corpus(seed)
+            screen, stream = attach(Session.Screen(80, 24), stream_class())
+            reference, parser = attach(pyte.Screen(80, 24), pyte.ByteStream())
+            for chunk in chunks(data, seed):
+                stream.feed(chunk)
+                parser.feed(chunk)
+                for y in range(24):
+                    self.assertEqual(cells(screen[y]), cells(reference[y]),
+                                     "seed %d, row %d" % (seed, y))
+                self.assertEqual((screen.cursor.x, screen.cursor.y),
+                                 (reference.cursor.x, reference.cursor.y))
+                self.assertEqual(screen.mode, reference.mode)
+
+    def test_bulk(self):
+        self.check(TagStream)
+
+    def test_per_character(self):
+        self.check(CharStream)
+
+    def test_bulk_dirty_rows(self):
+        data = corpus(7)
+        a, bulk = attach(Session.Screen(80, 24), TagStream())
+        b, per_character = attach(Session.Screen(80, 24), CharStream())
+        for chunk in chunks(data, 7):
+            bulk.feed(chunk)
+            per_character.feed(chunk)
+            self.assertEqual(sorted(a.dirty), sorted(b.dirty))
+            a.dirty.clear()
+            b.dirty.clear()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import time
+import unittest
+
+from pyqterm.watch import Watch
+
+
+def watch(patterns, **kwargs):
+    hits = []
+    return Watch(None, patterns, hits.append, **kwargs), hits
+
+
+class SplitFeedTest(unittest.TestCase):
+
+    def test_literal_longest_across_feeds(self):
+        w, hits = watch([u"err", u"error"], literal=True)
+        w.feed(b"err")
+        self.assertEqual(hits, [])
+        w.feed(b"or")
+        self.assertEqual([(h.name, h.text, h.start, h.end) for h in hits],
+                         [(u"error", u"error", 0, 5)])
+
+    def test_literal_shorter_once_decided(self):
+        w, hits = watch([u"err", u"error"], literal=True)
+        w.feed(b"err")
+        w.feed(b"x err")
+        self.assertEqual([(h.text, h.start) for h in hits], [(u"err", 0)])
+        w.flush()
+        self.assertEqual([(h.text, h.start) for h in hits],
+                         [(u"err", 0), (u"err", 5)])
+
+    def test_literal_not_held_without_longer_pattern(self):
+        w, hits = watch([u"error", u"ok"], literal=True)
+        w.feed(b"all ok")
+        self.assertEqual([h.text for h in hits], [u"ok"])
+
+    def test_literal_ignore_case(self):
+        w, hits = watch([u"err", u"error"], literal=True, ignore_case=True)
+        w.feed(b"ERR")
+        w.feed(b"OR!")
+        self.assertEqual([(h.name, h.text) for h in hits],
+                         [(u"error", u"ERROR")])
+
+    def test_regex_across_feeds(self):
+        w, hits = watch({"code": u"exit [0-9]+"})
+        w.feed(b"exit 12")
+        self.assertEqual(hits, [])
+        w.feed(b"7\n")
+        self.assertEqual([(h.name, h.text) for h in hits],
+                         [("code", u"exit 127")])
+
+    def test_regex_flush(self):
+        w, hits = watch({"prompt": u"\\$ $"})
+        w.feed(b"user$ ")
+        self.assertEqual(hits, [])
+        w.flush()
+        self.assertEqual([(h.text, h.start) for h in hits], [(u"$ ", 4)])
+        w.flush()
+        self.assertEqual(len(hits), 1)
+
+    def test_reported_once(self):
+        w, hits = watch([u"ok"], literal=True)
+        for chunk in (b"o", b"k o", b"k", b" ok "):
+            w.feed(chunk)
+        self.assertEqual([h.start for h in hits], [0, 3, 6])
+
+    def test_quiet_output(self):
+        w, hits = watch({"prompt": u"[Pp]assword: "})
+        w.linger = 0.01
+        w.feed(b"Password: ")
+        deadline = time.time() + 2
+        while not hits and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([h.name for h in hits], ["prompt"])
+
+
+if __name__ == "__main__":
+    unittest.main()